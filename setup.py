@@ -4,6 +4,7 @@
 """
 from __future__ import print_function
 
+import sys
 from os import path, environ
 from distutils.core import setup
 from setuptools import Extension
@@ -26,12 +27,20 @@ htslib_include_dirs = [
 ]
 htslib_include_dirs = [d for d in htslib_include_dirs if path.exists(str(d)) ]
 
+# Compiled EM kernels use OpenMP threads, which Apple clang does not support
+openmp_args = [] if sys.platform == 'darwin' else ['-fopenmp']
+
 ext = '.pyx' if USE_CYTHON else '.c'
 extensions = [
     Extension("telescope.utils.calignment",
               ["telescope/utils/calignment"+ext],
               include_dirs=htslib_include_dirs,
               ),
+    Extension("telescope.utils.cmodel",
+              ["telescope/utils/cmodel"+ext],
+              extra_compile_args=openmp_args,
+              extra_link_args=openmp_args,
+              ),
 ]
 
 if USE_CYTHON:
@@ -11,6 +11,7 @@ import errno
 from telescope import __version__
 from . import telescope_assign
 from . import telescope_resume
+from . import telescope_merge
 
 
 __author__ = 'Matthew L. Bendall'
@@ -22,6 +23,7 @@ USAGE   = ''' %(prog)s <command> [<args>]
 The most commonly used commands are:
    assign    Reassign ambiguous fragments that map to repetitive elements
    resume    Resume previous run from checkpoint file
+   merge     Merge checkpoint files from separate alignment files
    test      Generate a command line for testing
 '''
 
@@ -82,6 +84,14 @@ def main():
     telescope_resume.BulkResumeOptions.add_arguments(resume_parser)
     resume_parser.set_defaults(func=lambda args: telescope_resume.run(args, sc = False))
 
+    ''' Parser for merging checkpoints '''
+    merge_parser = subparser.add_parser('merge',
+        description='''Merge checkpoint files from separate alignment files''',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    telescope_merge.MergeOptions.add_arguments(merge_parser)
+    merge_parser.set_defaults(func=lambda args: telescope_merge.run(args))
+
     test_parser = subparser.add_parser('test',
         description='''Print a test command''',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -20,7 +20,7 @@ import numpy as np
 from . import utils
 from .utils.helpers import format_minutes as fmtmins
 from .utils.model import Telescope, scTelescope, TelescopeLikelihood
-from .utils.annotation import get_annotation_class
+from .utils.annotation import load_annotation, default_cache_dir
 
 __author__ = 'Matthew L. Bendall'
 __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
@@ -60,6 +60,14 @@ class BulkIDOptions(IDOptions):
             help: GTF attribute that defines a transposable element locus. GTF
                   features that share the same value for --attribute will be
                   considered as part of the same locus.
+        - annotation_cache:
+            help: Directory for compiled annotation indexes. The annotation is
+                  compiled once and reused by runs with the same GTF file,
+                  --attribute and --stranded_mode. Default is
+                  $XDG_CACHE_HOME/telescope or ~/.cache/telescope.
+        - no_annotation_cache:
+            action: store_true
+            help: Do not read or write compiled annotation indexes.
         - no_feature_key:
             default: __no_feature
             help: Used internally to represent alignments. Must be different
@@ -67,7 +75,13 @@ class BulkIDOptions(IDOptions):
         - ncpu:
             default: 1
             type: int
-            help: Number of cores to use. (Multiple cores not supported yet).
+            help: Number of cores to use. Collated BAM files are loaded in
+                  parallel and EM runs on --ncpu threads.
+        - io_threads:
+            default: 1
+            type: int
+            help: Number of threads used by htslib to compress and decompress
+                  BAM files, in each process that reads or writes them.
         - tempdir:
             help: Path to temporary directory. Temporary files will be stored
                   here. Default uses python tempfile package to create the
@@ -91,6 +105,11 @@ class BulkIDOptions(IDOptions):
         - updated_sam:
             action: store_true
             help: Generate an updated alignment file.
+        - compress_checkpoint:
+            action: store_true
+            help: Compress the checkpoint file. Compressed checkpoints are
+                  smaller but are read into memory instead of being
+                  memory-mapped by "telescope resume".
     - Run Modes:
         - reassign_mode:
             default: exclude
@@ -127,7 +146,9 @@ class BulkIDOptions(IDOptions):
                 - intersection-strict
                 - union
             help: Overlap mode. The method used to determine whether a fragment
-                  overlaps feature.
+                  overlaps feature. "intersection-strict" and "union" follow
+                  htseq-count; fragments that overlap no feature or more than
+                  one feature are not assigned.
         - overlap_threshold:
             type: float
             default: 0.2
@@ -139,9 +160,11 @@ class BulkIDOptions(IDOptions):
             choices:
                 - intervaltree
                 - htseq
+                - numpy
             help: Annotation class to use for finding overlaps. Both htseq and
                   intervaltree appear to yield identical results. Performance
-                  differences are TBD.
+                  differences are TBD. numpy stores sorted interval arrays and
+                  yields the same results as intervaltree.
         - stranded_mode:
             type: str
             default: None
@@ -179,6 +202,24 @@ class BulkIDOptions(IDOptions):
         - use_likelihood:
             action: store_true
             help: Use difference in log-likelihood as convergence criteria.
+        - em_accel:
+            default: none
+            choices:
+                - none
+                - squarem
+            help: Acceleration method for EM. "squarem" extrapolates the
+                  estimates from pairs of EM steps and usually converges to
+                  the same estimates in fewer iterations.
+        - em_components:
+            action: store_true
+            help: >
+                  Run EM separately on each connected component of the
+                  fragment-locus graph. Components that require EM are run in
+                  parallel using --ncpu processes. NOTE: fragments that also
+                  align outside the annotation (__no_feature) link all of
+                  their loci through the __no_feature column, so on typical
+                  data most loci are in one large component and this option
+                  has little effect.
         - skip_em:
             action: store_true
             help: Exits after loading alignment and saving checkpoint file.
@@ -221,6 +262,14 @@ class scIDOptions(IDOptions):
             help: GTF attribute that defines a transposable element locus. GTF
                   features that share the same value for --attribute will be
                   considered as part of the same locus.
+        - annotation_cache:
+            help: Directory for compiled annotation indexes. The annotation is
+                  compiled once and reused by runs with the same GTF file,
+                  --attribute and --stranded_mode. Default is
+                  $XDG_CACHE_HOME/telescope or ~/.cache/telescope.
+        - no_annotation_cache:
+            action: store_true
+            help: Do not read or write compiled annotation indexes.
         - no_feature_key:
             default: __no_feature
             help: Used internally to represent alignments. Must be different
@@ -228,7 +277,13 @@ class scIDOptions(IDOptions):
         - ncpu:
             default: 1
             type: int
-            help: Number of cores to use. (Multiple cores not supported yet).
+            help: Number of cores to use. Collated BAM files are loaded in
+                  parallel and EM runs on --ncpu threads.
+        - io_threads:
+            default: 1
+            type: int
+            help: Number of threads used by htslib to compress and decompress
+                  BAM files, in each process that reads or writes them.
         - tempdir:
             help: Path to temporary directory. Temporary files will be stored
                   here. Default uses python tempfile package to create the
@@ -252,6 +307,11 @@ class scIDOptions(IDOptions):
         - updated_sam:
             action: store_true
             help: Generate an updated alignment file.
+        - compress_checkpoint:
+            action: store_true
+            help: Compress the checkpoint file. Compressed checkpoints are
+                  smaller but are read into memory instead of being
+                  memory-mapped by "telescope resume".
     - Run Modes:
         - reassign_mode:
             default: exclude
@@ -295,7 +355,9 @@ class scIDOptions(IDOptions):
                 - intersection-strict
                 - union
             help: Overlap mode. The method used to determine whether a fragment
-                  overlaps feature.
+                  overlaps feature. "intersection-strict" and "union" follow
+                  htseq-count; fragments that overlap no feature or more than
+                  one feature are not assigned.
         - overlap_threshold:
             type: float
             default: 0.2
@@ -307,9 +369,11 @@ class scIDOptions(IDOptions):
             choices:
                 - intervaltree
                 - htseq
+                - numpy
             help: Annotation class to use for finding overlaps. Both htseq and
                   intervaltree appear to yield identical results. Performance
-                  differences are TBD.
+                  differences are TBD. numpy stores sorted interval arrays and
+                  yields the same results as intervaltree.
         - stranded_mode:
             type: str
             default: None
@@ -347,6 +411,24 @@ class scIDOptions(IDOptions):
         - use_likelihood:
             action: store_true
             help: Use difference in log-likelihood as convergence criteria.
+        - em_accel:
+            default: none
+            choices:
+                - none
+                - squarem
+            help: Acceleration method for EM. "squarem" extrapolates the
+                  estimates from pairs of EM steps and usually converges to
+                  the same estimates in fewer iterations.
+        - em_components:
+            action: store_true
+            help: >
+                  Run EM separately on each connected component of the
+                  fragment-locus graph. Components that require EM are run in
+                  parallel using --ncpu processes. NOTE: fragments that also
+                  align outside the annotation (__no_feature) link all of
+                  their loci through the __no_feature column, so on typical
+                  data most loci are in one large component and this option
+                  has little effect.
         - skip_em:
             action: store_true
             help: Exits after loading alignment and saving checkpoint file.
@@ -388,15 +470,17 @@ def run(args, sc = True):
     ts = scTelescope(opts) if sc == True else Telescope(opts)
 
     ''' Load annotation '''
-    Annotation = get_annotation_class(opts.annotation_class)
     lg.info('Loading annotation...')
     stime = time()
-    annot = Annotation(opts.gtffile, opts.attribute, opts.stranded_mode)
+    if opts.no_annotation_cache:
+        cache_dir = None
+    else:
+        cache_dir = opts.annotation_cache or default_cache_dir()
+    annot = load_annotation(opts.annotation_class, opts.gtffile, opts.attribute,
+                            opts.stranded_mode, cache_dir=cache_dir)
     lg.info("Loaded annotation in {}".format(fmtmins(time() - stime)))
     lg.info('Loaded {} features.'.format(len(annot.loci)))
 
-    # annot.save(opts.outfile_path('test_annotation.p'))
-
     ''' Load alignments '''
     lg.info('Loading alignments...')
     stime = time()
@@ -419,7 +503,9 @@ def run(args, sc = True):
     lg.debug('garbage: {:d}'.format(gc.collect()))
 
     ''' Save object checkpoint '''
-    ts.save(opts.outfile_path('checkpoint'))
+    # Written before EM so that "telescope resume" can restart an
+    # interrupted run without loading the alignment again
+    ts.save(opts.outfile_path('checkpoint.ckpt'), opts.compress_checkpoint)
     if opts.skip_em:
         lg.info("Skipping EM...")
         lg.info("telescope assign complete (%s)" % fmtmins(time()-total_time))
@@ -439,6 +525,10 @@ def run(args, sc = True):
     ts_model.em(use_likelihood=opts.use_likelihood, loglev=lg.INFO)
     lg.info("EM completed in %s" % fmtmins(time() - stime))
 
+    ''' Save EM state in checkpoint '''
+    ts.save(opts.outfile_path('checkpoint.ckpt'), opts.compress_checkpoint,
+            ts_model)
+
     # Output final report
     lg.info("Generating Report...")
     ts.output_report(ts_model, opts.outfile_path('run_stats.tsv'), opts.outfile_path('TE_counts.tsv'))
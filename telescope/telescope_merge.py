@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+""" Telescope merge
+
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import logging as lg
+from time import time
+
+from . import utils
+from .utils.helpers import format_minutes as fmtmins
+from .utils.model import Telescope
+from .utils._checkpoint import Checkpoint, merge_checkpoints
+from .telescope_assign import IDOptions
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+class MergeOptions(IDOptions):
+    OPTS = """
+    - Input Options:
+        - checkpoints:
+            positional: True
+            nargs: '+'
+            help: Paths to checkpoint files. Each checkpoint is from
+                  "telescope assign" on a separate alignment file, for
+                  example one sequencing lane, with the same annotation.
+    - Reporting Options:
+        - quiet:
+            action: store_true
+            help: Silence (most) output.
+        - debug:
+            action: store_true
+            help: Print debug messages.
+        - logfile:
+            type: argparse.FileType('r')
+            help: Log output to this file.
+        - outdir:
+            default: .
+            help: Output directory.
+        - exp_tag:
+            default: telescope
+            help: Experiment tag
+        - compress_checkpoint:
+            action: store_true
+            help: Compress the checkpoint file. Compressed checkpoints are
+                  smaller but are read into memory instead of being
+                  memory-mapped by "telescope resume".
+    """
+
+
+def run(args):
+    """ Merge checkpoints into one checkpoint for "telescope resume"
+
+    Args:
+        args: Command line arguments
+
+    Returns:
+
+    """
+    opts = MergeOptions(args, sc=False)
+    utils.configure_logging(opts)
+    lg.info('\n{}\n'.format(opts))
+    total_time = time()
+
+    ''' Load checkpoints '''
+    ckpts = []
+    for filename in opts.checkpoints:
+        lg.info('Loading checkpoint {}...'.format(filename))
+        ckpts.append(Checkpoint.load(filename))
+    if any(c.min_score is None for c in ckpts):
+        lg.warning('Minimum alignment score is not recorded in all '
+                   'checkpoints, scores will not be rescaled. Checkpoints '
+                   'from older versions should be created again.')
+
+    ''' Merge checkpoints '''
+    lg.info('Merging {:d} checkpoints...'.format(len(ckpts)))
+    stime = time()
+    merged = merge_checkpoints(ckpts, opts.version)
+    _ndup = sum(len(c.read_index) for c in ckpts) - len(merged.read_index)
+    if _ndup:
+        lg.warning('{:d} fragments were found in more than one '
+                   'checkpoint'.format(_ndup))
+    lg.info("Merging completed in %s" % fmtmins(time() - stime))
+
+    ts = Telescope.from_checkpoint(merged)
+    ts.opts = opts
+    ts.print_summary(lg.INFO)
+
+    ''' Save merged checkpoint '''
+    ts.save(opts.outfile_path('checkpoint.ckpt'), opts.compress_checkpoint)
+    lg.info("telescope merge complete (%s)" % fmtmins(time() - total_time))
+    return
@@ -31,6 +31,10 @@ class BulkResumeOptions(IDOptions):
         - checkpoint:
             positional: True
             help: Path to checkpoint file.
+        - ncpu:
+            default: 1
+            type: int
+            help: Number of cores to use. EM runs on --ncpu threads.
     - Reporting Options:
         - quiet:
             action: store_true
@@ -100,6 +104,24 @@ class BulkResumeOptions(IDOptions):
         - use_likelihood:
             action: store_true
             help: Use difference in log-likelihood as convergence criteria.
+        - em_accel:
+            default: none
+            choices:
+                - none
+                - squarem
+            help: Acceleration method for EM. "squarem" extrapolates the
+                  estimates from pairs of EM steps and usually converges to
+                  the same estimates in fewer iterations.
+        - em_components:
+            action: store_true
+            help: >
+                  Run EM separately on each connected component of the
+                  fragment-locus graph. Components that require EM are run in
+                  parallel using --ncpu processes. NOTE: fragments that also
+                  align outside the annotation (__no_feature) link all of
+                  their loci through the __no_feature column, so on typical
+                  data most loci are in one large component and this option
+                  has little effect.
     """
 
 class scResumeOptions(IDOptions):
@@ -109,6 +131,10 @@ class scResumeOptions(IDOptions):
         - checkpoint:
             positional: True
             help: Path to checkpoint file.
+        - ncpu:
+            default: 1
+            type: int
+            help: Number of cores to use.
     - Reporting Options:
         - quiet:
             action: store_true
@@ -178,6 +204,24 @@ class scResumeOptions(IDOptions):
         - use_likelihood:
             action: store_true
             help: Use difference in log-likelihood as convergence criteria.
+        - em_accel:
+            default: none
+            choices:
+                - none
+                - squarem
+            help: Acceleration method for EM. "squarem" extrapolates the
+                  estimates from pairs of EM steps and usually converges to
+                  the same estimates in fewer iterations.
+        - em_components:
+            action: store_true
+            help: >
+                  Run EM separately on each connected component of the
+                  fragment-locus graph. Components that require EM are run in
+                  parallel using --ncpu processes. NOTE: fragments that also
+                  align outside the annotation (__no_feature) link all of
+                  their loci through the __no_feature column, so on typical
+                  data most loci are in one large component and this option
+                  has little effect.
     """
 
 def run(args, sc = True):
@@ -213,10 +257,11 @@ def run(args, sc = True):
     ''' Create likelihood '''
     ts_model = TelescopeLikelihood(ts.raw_scores, opts)
 
-    ''' Run Expectation-Maximization '''
+    ''' Run Expectation-Maximization, starting from checkpoint if possible '''
     lg.info('Running Expectation-Maximization...')
     stime = time()
-    ts_model.em(use_likelihood=opts.use_likelihood, loglev=lg.INFO)
+    ts_model.resume_em(ts.em_state, use_likelihood=opts.use_likelihood,
+                       loglev=lg.INFO)
     lg.info("EM completed in %s" % fmtmins(time() - stime))
 
     ''' Output final report '''
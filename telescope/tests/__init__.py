@@ -1,4 +1,21 @@
 __author__ = 'bendall'
 
 import os
+
+import pysam
+
 TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+HEADER = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 100000}]})
+
+
+def make_segment(pos, cigar, tags):
+    """ Aligned segment on chr1 of `HEADER` """
+    a = pysam.AlignedSegment(HEADER)
+    a.query_name = 'read1'
+    a.reference_id = 0
+    a.reference_start = pos
+    a.cigarstring = cigar
+    a.query_sequence = 'A' * a.infer_query_length()
+    a.set_tags(tags)
+    return a
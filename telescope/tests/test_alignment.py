@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+import os
+import argparse
+
+import pysam
+import pytest
+
+from telescope.utils import alignment, model
+from telescope.utils.model import Telescope, Assigner
+from telescope.utils.annotation import load_annotation
+from telescope.telescope_assign import BulkIDOptions
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'data')
+BAMFILE = os.path.join(DATA_DIR, 'alignment.bam')
+GTFFILE = os.path.join(DATA_DIR, 'annotation.gtf')
+
+
+def make_opts(samfile, *argv):
+    """ Options for `telescope assign` with default values """
+    parser = argparse.ArgumentParser()
+    BulkIDOptions.add_arguments(parser)
+    args = parser.parse_args([samfile, GTFFILE] + list(argv))
+    args.version = 'test'
+    return BulkIDOptions(args, sc=False)
+
+
+def load_scores(opts):
+    """ Load alignment and return Telescope object """
+    annot = load_annotation(opts.annotation_class, opts.gtffile,
+                            opts.attribute, opts.stranded_mode)
+    ts = Telescope(opts)
+    ts.load_alignment(annot)
+    return ts
+
+
+def assert_same_scores(ts1, ts2):
+    assert list(ts1.read_index.items()) == list(ts2.read_index.items())
+    assert list(ts1.feat_index.items()) == list(ts2.feat_index.items())
+    assert (ts1.raw_scores != ts2.raw_scores).nnz == 0
+    assert ts1.run_info == ts2.run_info
+
+
+def record_offsets(samfile):
+    """ Virtual offset and query name of every record """
+    ret = []
+    with pysam.AlignmentFile(samfile, check_sq=False) as sf:
+        while True:
+            _voffset = sf.tell()
+            try:
+                ret.append((_voffset, next(sf).query_name))
+            except StopIteration:
+                return ret
+
+
+def fragment_keys(fragiter):
+    return [(code, [(p.r1.query_name, p.r1.flag, p.r1.reference_start,
+                     None if p.r2 is None else p.r2.flag) for p in pairs])
+            for code, pairs in fragiter]
+
+
+def test_bam_record_after():
+    """ Records found after each BGZF block are true record boundaries """
+    _records = record_offsets(BAMFILE)
+    with pysam.AlignmentFile(BAMFILE, check_sq=False) as sf:
+        nref = sf.nreferences
+    with open(BAMFILE, 'rb') as fh:
+        _blocks = {}
+        _coffset = 0
+        while True:
+            data, _next = alignment._bgzf_read_block(fh, _coffset)
+            if not data:
+                break
+            _blocks[_coffset] = (len(data), _next)
+            _coffset = _next
+
+        def normalize(v):
+            ''' Offset at the end of a block is the start of the next one '''
+            _c, _u = v >> 16, v & 0xffff
+            if _u == _blocks[_c][0]:
+                return _blocks[_c][1] << 16
+            return v
+
+        _starts = sorted(normalize(v) for v, _ in _records)
+        nchecked = 0
+        for c in _blocks:
+            if c <= (_records[0][0] >> 16):
+                continue
+            expected = next((v for v in _starts if v >= c << 16), None)
+            assert alignment.bam_record_after(fh, c, nref) == expected
+            nchecked += 1
+    assert nchecked > 10
+
+
+def test_collated_splits():
+    splits = alignment.collated_splits(BAMFILE, 7)
+    assert len(splits) == 7
+    _records = record_offsets(BAMFILE)
+    # Ranges are contiguous and cover the file
+    assert splits[0][0] == _records[0][0]
+    assert splits[-1][1] is None
+    for (_, end), (start, _) in zip(splits, splits[1:]):
+        assert end == start
+
+    # No query name is in more than one range
+    _names = []
+    with pysam.AlignmentFile(BAMFILE, check_sq=False) as sf:
+        for vrange in splits:
+            _names.append({a.query_name
+                           for a in alignment.fetch_range(sf, *vrange)})
+        assert sum(map(len, _names)) == len(set.union(*_names))
+        assert sum(len(list(alignment.fetch_range(sf, *vrange)))
+                   for vrange in splits) == len(_records)
+
+    # Reading the ranges gives the same fragments as one pass
+    with pysam.AlignmentFile(BAMFILE, check_sq=False) as sf:
+        expected = fragment_keys(alignment.fetch_fragments_seq(sf, until_eof=True))
+    ret = []
+    for vrange in splits:
+        with pysam.AlignmentFile(BAMFILE, check_sq=False) as sf:
+            ret.extend(fragment_keys(alignment.fetch_fragments_seq(
+                sf, vrange=vrange)))
+    assert ret == expected
+
+
+def test_load_collated():
+    ts1 = load_scores(make_opts(BAMFILE))
+    ts2 = load_scores(make_opts(BAMFILE, '--ncpu', '3'))
+    assert ts2.is_bam and not ts2.has_index
+    assert_same_scores(ts1, ts2)
+
+
+def score_dict(ts):
+    """ Scores keyed by fragment and feature names """
+    _reads = sorted(ts.read_index, key=ts.read_index.get)
+    _feats = sorted(ts.feat_index, key=ts.feat_index.get)
+    m = ts.raw_scores.tocoo()
+    return {(_reads[i], _feats[j]): v for i, j, v in zip(m.row, m.col, m.data)}
+
+
+def test_load_parallel_sorted(tmp_path, monkeypatch):
+    sorted_bam = str(tmp_path / 'sorted.bam')
+    pysam.sort('-o', sorted_bam, BAMFILE)
+    pysam.index(sorted_bam)
+
+    # Split work units between the mates of some pairs
+    with pysam.AlignmentFile(sorted_bam) as sf:
+        _pairs = [a for a in sf.fetch() if a.is_proper_pair and
+                  a.next_reference_start > a.reference_start + 1]
+    _cuts = [(a.reference_name, a.reference_start + 1) for a in _pairs[::500]]
+    _work_units = alignment.sorted_work_units
+
+    def split_units(samfile, nunits):
+        units = _work_units(samfile, nunits)
+        for chrom, pos in _cuts:
+            for u in list(units):
+                for k, (c, start, end) in enumerate(u):
+                    if c == chrom and start < pos < end:
+                        u[k] = (c, start, pos)
+                        units.append([(c, pos, end)])
+        return units
+
+    monkeypatch.setattr(alignment, 'sorted_work_units', split_units)
+    opts = make_opts(sorted_bam, '--ncpu', '3', '--tempdir', str(tmp_path))
+    ts = load_scores(opts)
+    assert ts.has_index
+
+    # Some mates are in different work units and are paired afterwards
+    annot = load_annotation(opts.annotation_class, opts.gtffile,
+                            opts.attribute, opts.stranded_mode)
+    units = alignment.sorted_work_units(sorted_bam, opts.ncpu * 4)
+    ncarried = sum(len(alignment.fetch_region(sorted_bam, annot,
+                                              ts._worker_opts(), u)[4])
+                   for u in units)
+    assert ncarried > 0
+
+    ts0 = load_scores(make_opts(BAMFILE))
+    assert score_dict(ts) == score_dict(ts0)
+    for k, v in ts0.run_info.items():
+        if k != 'version':
+            assert ts.run_info[k] == v, k
+
+
+@pytest.mark.parametrize('annotation_class', ['intervaltree', 'numpy'])
+@pytest.mark.parametrize('stranded_mode', ['None', 'RF'])
+@pytest.mark.parametrize('overlap_mode',
+                         ['threshold', 'intersection-strict', 'union'])
+def test_assign_batch(overlap_mode, stranded_mode, annotation_class):
+    opts = make_opts(BAMFILE, '--overlap_mode', overlap_mode,
+                     '--stranded_mode', stranded_mode,
+                     '--annotation_class', annotation_class)
+    annot = load_annotation(opts.annotation_class, opts.gtffile,
+                            opts.attribute, opts.stranded_mode)
+    assigner = Assigner(annot, opts.no_feature_key, opts.overlap_mode,
+                        opts.overlap_threshold, opts)
+    with pysam.AlignmentFile(BAMFILE, check_sq=False) as sf:
+        pairs = [p for _, alns in alignment.fetch_fragments_seq(
+                     sf, until_eof=True)
+                 for p in alns if not p.is_unmapped]
+    _assign = assigner.assign_func()
+    expected = [_assign(p) for p in pairs]
+    assert len(set(expected)) > 10
+    assert assigner.assign_batch(pairs) == expected
+
+
+@pytest.mark.parametrize('overlap_mode', ['threshold', 'union'])
+def test_load_fragments_chunks(overlap_mode):
+    """ Loading does not depend on how many fragments are assigned together """
+    opts = make_opts(BAMFILE, '--overlap_mode', overlap_mode)
+    annot = load_annotation(opts.annotation_class, opts.gtffile,
+                            opts.attribute, opts.stranded_mode)
+    assigner = Assigner(annot, opts.no_feature_key, opts.overlap_mode,
+                        opts.overlap_threshold, opts)
+    ret = []
+    for chunksize in [1, 7, 10000]:
+        with pysam.AlignmentFile(BAMFILE, check_sq=False) as sf:
+            ret.append(model._load_fragments(
+                alignment.fetch_fragments_seq(sf, until_eof=True), assigner,
+                opts, chunksize=chunksize))
+    assert ret[0][2]['feat_A'] > 0
+    assert ret[1] == ret[0]
+    assert ret[2] == ret[0]
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from builtins import object
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from telescope.tests import TEST_DATA_DIR
+from telescope.utils.annotation import get_annotation_class, load_annotation
+from telescope.utils._annotation_index import merge_locus_intervals
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+def test_merge_locus_intervals():
+    s, e, l, latest = merge_locus_intervals(
+        [10, 1, 5, 20, 8, 30], [15, 6, 9, 25, 12, 35], [0, 0, 0, 0, 1, 0]
+    )
+    assert s.tolist() == [1, 10, 20, 30, 8]
+    assert e.tolist() == [9, 15, 25, 35, 12]
+    assert l.tolist() == [0, 0, 0, 0, 1]
+    assert latest.tolist() == [2, 0, 3, 5, 4]
+
+
+class TestAnnotationNumpy(object):
+
+    def setup_method(self):
+        gtffile = os.path.join(TEST_DATA_DIR, 'annotation_test.2.gtf')
+        self.A = get_annotation_class('numpy')(open(gtffile), 'locus', 'None')
+        self.gtfrows = [l.strip('\n').split('\t') for l in open(gtffile)]
+
+    def test_intervals(self):
+        assert len(self.A.chroms['chr1']['start']) == 3
+        assert len(self.A.chroms['chr2']['start']) == 4
+        assert len(self.A.chroms['chr3']['start']) == 2
+
+    def test_empty_lookups(self):
+        assert not self.A.intersect_blocks('chr1', [(1, 9999)], '+')
+        assert not self.A.intersect_blocks('chr1', [(20001, 39999)], '+')
+        assert not self.A.intersect_blocks('chr1', [(90001, 90001)], '+')
+        assert not self.A.intersect_blocks('chrX', [(1, 1000000000)], '+')
+
+    def test_simple_lookups(self):
+        for l in self.gtfrows:
+            iv = (int(l[3]), int(l[4]))
+            loc = l[8].split('"')[1]
+            r = self.A.intersect_blocks(l[0], [iv], '+')
+            assert (r[loc] - 1) == (iv[1] - iv[0])
+
+    def test_overlap_lookups(self):
+        r = self.A.intersect_blocks('chr1', [(19990, 40000)], '+')
+        assert r['locus1'] == 11 and r['locus2'] == 1
+        r = self.A.intersect_blocks('chr2', [(44990, 46010)], '+')
+        assert r['locus5'] == 22
+        r = self.A.intersect_blocks('chr3', [(44990, 46010)], '+')
+        assert r['locus8'] == 1021
+
+    def test_subregion(self):
+        sA = self.A.subregion('chr3', 30000, 50000)
+        assert not sA.intersect_blocks('chr1', [(1, 10000)], '+')
+        assert not sA.intersect_blocks('chr3', [(1, 10000)], '+')
+        assert sA.intersect_blocks('chr3', [(40000, 45000)], '+')['locus8'] == 5001
+
+    def test_batch(self):
+        queries = [
+            ('chr1', [(19990, 40000)]),
+            ('chrX', [(1, 100)]),
+            ('chr2', [(44990, 45000), (45990, 46010)]),
+            ('chr3', [(1, 10000), (44990, 46010)]),
+        ]
+        frag, refs, bstart, bend = [], [], [], []
+        for i, (ref, blocks) in enumerate(queries):
+            for b in blocks:
+                frag.append(i)
+                refs.append(ref)
+                bstart.append(b[0])
+                bend.append(b[1])
+        r = self.A.intersect_batch(np.array(frag), np.array(refs),
+                                   np.array(bstart), np.array(bend))
+        assert r == [self.A.intersect_blocks(ref, blocks, '+')
+                     for ref, blocks in queries]
+
+
+def test_index_roundtrip():
+    gtffile = os.path.join(TEST_DATA_DIR, 'annotation_test.2.gtf')
+    A = get_annotation_class('numpy')(open(gtffile), 'locus', 'None')
+    queries = [('chr1', [(19990, 40000)]), ('chr2', [(44990, 46010)]),
+               ('chr3', [(1, 10000), (44990, 46010)])]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        A.save(os.path.join(tmpdir, 'annot.tidx'))
+        for name in ('numpy', 'intervaltree'):
+            B = get_annotation_class(name).load(os.path.join(tmpdir, 'annot.tidx'))
+            assert list(B.loci) == list(A.loci)
+            assert B.feature_length() == A.feature_length()
+            for ref, blocks in queries:
+                assert (B.intersect_blocks(ref, blocks, '+') ==
+                        A.intersect_blocks(ref, blocks, '+'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_load_annotation_cache():
+    gtffile = os.path.join(TEST_DATA_DIR, 'annotation_test.2.gtf')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        A = load_annotation('numpy', gtffile, 'locus', 'None', cache_dir=tmpdir)
+        assert len(os.listdir(tmpdir)) == 1
+        B = load_annotation('numpy', gtffile, 'locus', 'None', cache_dir=tmpdir)
+        assert isinstance(B.chroms['chr1']['start'], np.memmap)
+        assert B.feature_length() == A.feature_length()
+        load_annotation('numpy', gtffile, 'locus', 'RF', cache_dir=tmpdir)
+        assert len(os.listdir(tmpdir)) == 2
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_stranded_lookups():
+    gtffile = os.path.join(TEST_DATA_DIR, 'annotation_test.2.gtf')
+    for name in ('numpy', 'intervaltree'):
+        A = get_annotation_class(name)(open(gtffile), 'locus', 'RF')
+        assert A.intersect_blocks('chr3', [(44990, 46010)], '-')['locus8'] == 1021
+        assert not A.intersect_blocks('chr3', [(44990, 46010)], '+')
+        assert not A.intersect_blocks('chrX', [(1, 100)], '-')
+    A = get_annotation_class('numpy')(open(gtffile), 'locus', 'RF')
+    r = A.intersect_batch(np.array([0, 1]), np.array(['chr3', 'chr3']),
+                          np.array([44990, 44990]), np.array([46010, 46010]),
+                          np.array(['-', '+']))
+    assert r[0]['locus8'] == 1021 and not r[1]
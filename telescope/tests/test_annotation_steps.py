@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from telescope.utils._annotation_steps import LocusSteps, assign_steps_batch
+from telescope.utils._annotation_steps import NO_FEATURE, AMBIGUOUS
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+''' Locus 0 covers 100-199, locus 1 covers 150-249, locus 2 covers 300-399 '''
+STEPS = LocusSteps([100, 150, 300], [200, 250, 400], [0, 1, 2])
+
+
+def test_locus_steps():
+    assert STEPS.bounds.tolist() == [100, 150, 200, 250, 300, 400]
+    assert STEPS.ptr.tolist() == [0, 1, 3, 4, 4, 5]
+    assert STEPS.loci.tolist() == [0, 0, 1, 1, 2]
+
+
+def test_union():
+    assert STEPS.union([(90, 120)]) == {0}
+    assert STEPS.union([(120, 160)]) == {0, 1}
+    assert STEPS.union([(260, 290)]) == set()
+    assert STEPS.union([(120, 130), (310, 320)]) == {0, 2}
+
+
+def test_intersection_strict():
+    assert STEPS.intersection_strict([(110, 140)]) == {0}
+    assert STEPS.intersection_strict([(90, 120)]) == set()
+    assert STEPS.intersection_strict([(160, 190)]) == {0, 1}
+    assert STEPS.intersection_strict([(120, 160)]) == {0}
+    assert STEPS.intersection_strict([(240, 260)]) == set()
+    assert STEPS.intersection_strict([(390, 410)]) == set()
+
+
+def test_assign_steps_batch():
+    blocks = [(110, 140), (90, 120), (160, 190), (120, 160), (240, 260),
+              (310, 320)]
+    frag = np.arange(len(blocks))
+    refs = np.array(['chr1'] * len(blocks))
+    bstart = np.array([b[0] for b in blocks])
+    bend = np.array([b[1] for b in blocks])
+    _steps = lambda ref, strand: STEPS if ref == 'chr1' else None
+
+    r = assign_steps_batch(_steps, 'intersection-strict', frag, refs, bstart, bend)
+    assert r.tolist() == [0, NO_FEATURE, AMBIGUOUS, 0, NO_FEATURE, 2]
+    r = assign_steps_batch(_steps, 'union', frag, refs, bstart, bend)
+    assert r.tolist() == [0, 0, AMBIGUOUS, AMBIGUOUS, 1, 2]
+    r = assign_steps_batch(_steps, 'union', np.array([0, 0]),
+                           np.array(['chr1', 'chr2']), np.array([110, 110]),
+                           np.array([140, 140]))
+    assert r.tolist() == [0]
+    r = assign_steps_batch(_steps, 'intersection-strict', np.array([0, 0]),
+                           np.array(['chr1', 'chr2']), np.array([110, 110]),
+                           np.array([140, 140]))
+    assert r.tolist() == [NO_FEATURE]
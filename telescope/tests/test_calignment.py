@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from telescope.utils.calignment import AlignedPair, FragmentBundler
+from telescope.utils.helpers import merge_blocks
+from telescope.tests import make_segment
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+def test_refblocks_single():
+    r1 = make_segment(100, '10M1D10M5N10M2S', [('AS', -12)])
+    p = AlignedPair(r1)
+    assert p.refblocks == merge_blocks(r1.get_blocks(), 1)
+    assert p.refblocks == [(100, 121), (126, 136)]
+    assert p.alnlen == 31
+    assert p.alnscore == -12
+
+
+def test_refblocks_pair():
+    r1 = make_segment(100, '20M', [('XA', 'chr1,+1,20M,0;'),
+                                   ('ZB', [1, 2, 3]), ('AS', 40)])
+    r2 = make_segment(110, '5S20M', [('NM', 0), ('AS', 300)])
+    p = AlignedPair(r1, r2)
+    assert p.refblocks == [(100, 130)]
+    assert p.alnlen == 30
+    assert p.alnscore == 340
+
+
+def test_alnscore_missing():
+    p = AlignedPair(make_segment(100, '20M', [('NM', 1)]))
+    with pytest.raises(KeyError):
+        p.alnscore
+
+
+def make_mate(name, flag, pos, mpos, isize):
+    a = make_segment(pos, '20M', [('AS', 40)])
+    a.query_name = name
+    a.flag = flag
+    a.next_reference_id = 0
+    a.next_reference_start = mpos
+    a.template_length = isize
+    return a
+
+
+def test_fragment_bundler():
+    alns = [
+        # Properly paired, two alignments with mates in reverse order
+        make_mate('frag1', 99, 100, 200, 120),
+        make_mate('frag1', 99, 500, 600, 120),
+        make_mate('frag1', 147, 600, 500, -120),
+        make_mate('frag1', 147, 200, 100, -120),
+        # Properly paired, mate missing
+        make_mate('frag1', 99, 900, 1000, 120),
+        # Pair with both mates unmapped
+        make_mate('frag2', 77, 0, 0, 0),
+        make_mate('frag2', 141, 0, 0, 0),
+        # Single end
+        make_segment(300, '20M', [('AS', 10)]),
+    ]
+    alns[-1].query_name = 'frag3'
+    bundles = list(FragmentBundler(alns))
+    assert [code for code, pairs in bundles] == [3, 2, 1]
+    frag1 = bundles[0][1]
+    assert [(p.r1.reference_start, p.r2.reference_start if p.r2 else None)
+            for p in frag1] == [(500, 600), (100, 200), (900, None)]
+    assert bundles[1][1][0].r2 is alns[6]
+    assert bundles[2][1][0].r1 is alns[7]
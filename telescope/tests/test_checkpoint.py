@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+from collections import OrderedDict, Counter
+
+import pytest
+import numpy as np
+
+from telescope.utils.sparse_plus import csr_matrix_plus
+from telescope.utils._arrayfile import NameIndex
+from telescope.utils._checkpoint import Checkpoint, merge_checkpoints
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+def is_mapped(a):
+    """ Whether array is a view of a memory-mapped file """
+    while a is not None:
+        if isinstance(a, np.memmap):
+            return True
+        a = a.base
+    return False
+
+
+class TestCheckpoint(object):
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.run_info = OrderedDict([('version', '1.0.3'),
+                                     ('total_fragments', np.int64(5)),
+                                     ('overlap_unique', 2)])
+        self.feat_index = {'__no_feature': 0, 'locA': 1, 'locB': 2}
+        self.feature_length = Counter({'locA': 100, 'locB': 250})
+        self.read_index = {'read3': 0, 'read1': 1, 'read2': 2}
+        self.raw_scores = csr_matrix_plus([[0, 10, 0], [0, 5, 7], [1, 0, 3]])
+
+    def teardown_method(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, ckpt):
+        assert list(ckpt.run_info.items()) == \
+            [('version', '1.0.3'), ('total_fragments', 5), ('overlap_unique', 2)]
+        assert ckpt.feat_index == self.feat_index
+        assert ckpt.feature_length == self.feature_length
+        assert dict(ckpt.read_index) == self.read_index
+        assert (ckpt.raw_scores != self.raw_scores).nnz == 0
+
+    def test_roundtrip(self):
+        fn = os.path.join(self.tmpdir, 'checkpoint.ckpt')
+        Checkpoint(self.run_info, self.feat_index, self.feature_length,
+                   self.read_index, self.raw_scores).save(fn)
+        ckpt = Checkpoint.load(fn)
+        assert is_mapped(ckpt.raw_scores.data)
+        assert isinstance(ckpt.read_index, NameIndex)
+        assert len(ckpt.read_index) == 3 and ckpt.read_index._index is None
+        self.check(ckpt)
+        # Saving a loaded checkpoint keeps fragment names encoded
+        fn2 = os.path.join(self.tmpdir, 'checkpoint2.ckpt')
+        ckpt.save(fn2, compress=True)
+        ckpt2 = Checkpoint.load(fn2)
+        assert not is_mapped(ckpt2.raw_scores.data)
+        self.check(ckpt2)
+
+    def test_em_state(self):
+        fn = os.path.join(self.tmpdir, 'checkpoint.ckpt')
+        em = {'params': {'pi_prior': 0, 'em_epsilon': 1e-7, 'em_accel': 'none'},
+              'lnl': np.float64(-12.5), 'num_iter': 4, 'converged': np.bool_(True),
+              'pi': np.array([0.2, 0.5, 0.3]), 'theta': np.array([0.1, 0.8, 0.1]),
+              'pi_init': np.array([0.3, 0.4, 0.3]),
+              'theta_init': np.array([0.3, 0.4, 0.3]),
+              'za_data': np.array([0.25, 0.75])}
+        Checkpoint(self.run_info, self.feat_index, self.feature_length,
+                   self.read_index, self.raw_scores, em).save(fn)
+        ckpt = Checkpoint.load(fn)
+        self.check(ckpt)
+        assert ckpt.em['params'] == em['params']
+        assert ckpt.em['lnl'] == -12.5 and ckpt.em['num_iter'] == 4
+        assert ckpt.em['converged'] is True
+        for k in ['pi', 'theta', 'pi_init', 'theta_init', 'za_data']:
+            assert np.array_equal(ckpt.em[k], em[k])
+        fn2 = os.path.join(self.tmpdir, 'checkpoint2.ckpt')
+        Checkpoint(self.run_info, self.feat_index, self.feature_length,
+                   self.read_index, self.raw_scores).save(fn2)
+        assert Checkpoint.load(fn2).em is None
+
+    def test_load_npz(self):
+        fn = os.path.join(self.tmpdir, 'checkpoint')
+        np.savez(fn,
+                 _run_info=list(self.run_info.items()),
+                 _flen_list=[0, 100, 250],
+                 _feat_list=['__no_feature', 'locA', 'locB'],
+                 _read_list=['read3', 'read1', 'read2'],
+                 _shape=(3, 3),
+                 _raw_scores_data=self.raw_scores.data,
+                 _raw_scores_indices=self.raw_scores.indices,
+                 _raw_scores_indptr=self.raw_scores.indptr,
+                 _raw_scores_shape=self.raw_scores.shape)
+        self.check(Checkpoint.load(fn + '.npz'))
+
+
+def test_merge_checkpoints():
+    c1 = Checkpoint(
+        OrderedDict([('version', '1.0.3'), ('annotated_features', 3),
+                     ('total_fragments', 4), ('overlap_unique', 1),
+                     ('overlap_ambig', 1)]),
+        {'__no_feature': 0, 'locA': 1, 'locB': 2},
+        Counter({'locA': 100, 'locB': 250}),
+        NameIndex.from_names(['r1', 'r2']),
+        csr_matrix_plus(np.array([[0, 10, 0], [3, 5, 7]], dtype=np.uint16)),
+        min_score=20
+    )
+    c2 = Checkpoint(
+        OrderedDict([('version', '1.0.3'), ('annotated_features', 3),
+                     ('total_fragments', 3), ('overlap_unique', 1),
+                     ('overlap_ambig', 0)]),
+        {'__no_feature': 0, 'locC': 1, 'locA': 2},
+        Counter({'locA': 100, 'locC': 80}),
+        {'r3': 0},
+        csr_matrix_plus(np.array([[0, 0, 4]], dtype=np.uint16)),
+        min_score=15
+    )
+    m = merge_checkpoints([c1, c2], version='1.1')
+    assert m.feat_index == {'__no_feature': 0, 'locA': 1, 'locB': 2, 'locC': 3}
+    assert m.feature_length == Counter({'locA': 100, 'locB': 250, 'locC': 80})
+    assert m.read_index == {'r1': 0, 'r2': 1, 'r3': 2}
+    # Scores of the first checkpoint are shifted by 20 - 15
+    assert m.min_score == 15
+    assert m.raw_scores.toarray().tolist() == \
+        [[0, 15, 0, 0], [8, 10, 12, 0], [0, 4, 0, 0]]
+    assert m.raw_scores.has_sorted_indices
+    assert list(m.run_info.items()) == [
+        ('version', '1.1'), ('annotated_features', 3), ('total_fragments', 7),
+        ('overlap_unique', 2), ('overlap_ambig', 1)]
+
+    # Fragment in both checkpoints has the best score for each feature
+    c2.read_index = {'r2': 0}
+    m = merge_checkpoints([c1, c2])
+    assert m.read_index == {'r1': 0, 'r2': 1}
+    assert m.raw_scores.toarray().tolist() == [[0, 15, 0, 0], [8, 10, 12, 0]]
+    assert m.run_info['version'] == '1.0.3'
+    assert m.run_info['overlap_unique'] == 1
+
+    # Both branches shift scores in a type that holds the shifted scores
+    c1.raw_scores = csr_matrix_plus(
+        np.array([[0, 65534, 0], [3, 5, 7]], dtype=np.uint16))
+    for c2.read_index in [{'r3': 0}, {'r2': 0}]:
+        m = merge_checkpoints([c1, c2])
+        assert m.raw_scores.dtype == np.uint32
+        assert m.raw_scores[0, 1] == 65539
+
+    # No-feature keys must match
+    c2.feat_index = {'__nofeat': 0, 'locC': 1, 'locA': 2}
+    with pytest.raises(ValueError, match='__no_feature, __nofeat'):
+        merge_checkpoints([c1, c2])
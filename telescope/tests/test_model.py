@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+from types import SimpleNamespace
+
+import numpy as np
+import scipy.sparse
+import pytest
+
+from telescope.utils import cmodel
+from telescope.utils.calignment import AlignedPair
+from telescope.utils.model import process_overlap_frag, FragmentTags
+from telescope.utils.model import Reassignment, TelescopeLikelihood
+from telescope.utils.sparse_plus import csr_matrix_plus
+from telescope.utils.helpers import phred, phred_array
+from telescope.tests import make_segment
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+def make_pair(pos, cigar, score):
+    return AlignedPair(make_segment(pos, cigar, [('AS', score)]))
+
+
+def test_process_overlap_frag():
+    pairs = [make_pair(100, '20M', 30), make_pair(200, '20M', 40),
+             make_pair(300, '25M', 30), make_pair(400, '20M', 40)]
+    feats = ['locA', 'locA', 'locB', '__no_feature']
+    maps, primary, topfeat = process_overlap_frag(pairs, feats)
+    assert [m[1] for m in maps] == ['locA', '__no_feature', 'locB']
+    assert primary == [False, True, True, True]
+    assert topfeat == 'locA,__no_feature'
+
+
+def test_fragment_tags_extend():
+    t1 = FragmentTags()
+    t1.add(2, ['locA', 'locB'], [True, True], 'locA')
+    t2 = FragmentTags()
+    t2.add(0, ['locC'], [True], 'locC')
+    t2.add(3, ['locB', 'locB'], [True, False], 'locB')
+    t1.extend(t2, 5)
+    assert len(t1) == 3
+    assert list(t1.ordinals) == [2, 5, 8]
+    assert list(t1.ptr) == [0, 2, 3, 5]
+    assert [t1.names[f] for f in t1.feats] == \
+        ['locA', 'locB', 'locC', 'locB', 'locB']
+    assert list(t1.primary) == [1, 1, 1, 1, 0]
+    assert [t1.names[b] for b in t1.best] == ['locA', 'locC', 'locB']
+
+
+def test_phred_array():
+    p = np.array([0, 0.1, 0.5, 0.9, 0.999999, 1 - 1e-16, 1])
+    assert phred_array(p).tolist() == [phred(x) for x in p]
+
+
+def test_reassignment():
+    z = csr_matrix_plus([[0.5, 0.5, 0], [0.2, 0, 0.8], [0, 1., 0],
+                         [0.95, 0.05, 0]])
+    rowclass = np.array([0, 1, 2, 0, 3, 1])
+    ambig = np.array([[1], [1], [0], [1]], dtype=np.uint8)
+    r = Reassignment(z, rowclass, ambig, thresh=0.9)
+    expected = {
+        'exclude': [1, 1, 2],
+        'average': [2, 2, 2],
+        'conf': [1, 1, 0],
+        'unique': [0, 1, 0],
+        'all': [5, 4, 2],
+    }
+    for method, counts in expected.items():
+        assert np.allclose(r.counts(method), counts)
+        assert np.array_equal(r.counts(method),
+                              r.assignments(method).sum(0).A1)
+    np.random.seed(1)
+    m = r.assignments('choose')
+    assert m.count(1).ravel().tolist() == [1] * 6
+    assert m[[1, 2, 4, 5]].toarray().tolist() == \
+        [[0, 0, 1], [0, 1, 0], [1, 0, 0], [0, 0, 1]]
+    np.random.seed(1)
+    assert r.counts('choose').tolist() == m.sum(0).A1.tolist()
+
+
+def make_model(scores=None, **kwargs):
+    opts = dict(em_epsilon=1e-7, max_iter=100, em_components=False,
+                em_accel='none', ncpu=1, pi_prior=0, theta_prior=200000)
+    opts.update(kwargs)
+    if scores is None:
+        scores = csr_matrix_plus([[100, 95, 0, 0], [0, 0, 100, 0],
+                                  [90, 0, 100, 0], [0, 0, 0, 100],
+                                  [0, 100, 0, 98], [100, 100, 0, 0],
+                                  [100, 0, 0, 0]])
+    return TelescopeLikelihood(scores, SimpleNamespace(**opts))
+
+
+def block_scores():
+    """ Block-diagonal scores; loci 3 and 4 only have unique rows """
+    rng = np.random.RandomState(3)
+    blocks = []
+    for ncol, nrow, density in [(3, 40, 0.6), (2, 10, 0), (3, 30, 0.5)]:
+        b = (rng.rand(nrow, ncol) < density) * rng.randint(90, 101, (nrow, ncol))
+        b[np.arange(nrow), rng.randint(ncol, size=nrow)] = 95
+        blocks.append(b)
+    return csr_matrix_plus(
+        scipy.sparse.block_diag(blocks).toarray().astype(np.uint16))
+
+
+def test_resume_em():
+    tl = make_model()
+    tl.em()
+    state = tl.em_state()
+    # Same parameters: estimates are restored
+    tl2 = make_model()
+    assert tl2.resume_em(state) == 'restored'
+    assert np.array_equal(tl2.pi, tl.pi)
+    assert np.array_equal(tl2.pi_init, tl.pi_init)
+    assert (tl2.z != tl.z).nnz == 0
+    assert tl2.lnl == tl.lnl and tl2.num_iter == tl.num_iter
+    # Other epsilon: EM starts from the saved estimates
+    ref = make_model(em_epsilon=1e-10)
+    ref.em()
+    tl3 = make_model(em_epsilon=1e-10)
+    assert tl3.resume_em(state) == 'warm'
+    assert tl3.num_iter < ref.num_iter
+    assert np.allclose(tl3.pi, ref.pi)
+    assert np.array_equal(tl3.pi_init, ref.pi_init)
+    # Other acceleration: EM is run from the start
+    tl4 = make_model(em_accel='squarem')
+    assert tl4.resume_em(state) == 'full'
+    assert make_model().resume_em(None) == 'full'
+
+
+def test_em_components():
+    scores = block_scores()
+    tl = make_model(scores)
+    tl.em()
+    tc = make_model(scores, em_components=True)
+    tc.em()
+    # Loci 3 and 4 are separate components
+    assert tc.Q.components()[0] == 4
+    assert abs(tc.pi - tl.pi).sum() < tl.epsilon
+    # Convergence is tested on pi, z is about 20 times less precise
+    assert abs(tc.z - tl.z).max() < 100 * tl.epsilon
+    # Component without ambiguous fragments is solved by one EM iteration
+    assert np.array_equal(tc.pi[3:5], tl.pi_init[3:5])
+    assert np.array_equal(tc.pi_init, tl.pi_init)
+    assert np.array_equal(tc.theta[3:5], tl.theta_init[3:5])
+    assert (tc.z[:, 3:5] != tl.z[:, 3:5]).nnz == 0
+
+
+def random_scores(seed, nrow=300, ncol=15, density=0.15):
+    """ Random scores where every row has a value and some rows repeat """
+    rng = np.random.RandomState(seed)
+    m = (rng.rand(nrow, ncol) < density) * rng.randint(80, 101, (nrow, ncol))
+    m[np.arange(nrow), rng.randint(ncol, size=nrow)] = \
+        rng.randint(80, 101, nrow)
+    m = np.vstack([m, m[:nrow // 4]])
+    return csr_matrix_plus(m.astype(np.uint16))
+
+
+def dense_em(scores, use_likelihood=False, epsilon=1e-7, max_iter=100,
+             pi_prior=0, theta_prior=200000):
+    """ EM with dense arrays and one row per fragment """
+    raw = scores.toarray().astype(np.float64)
+    Q = np.expm1(raw / raw.max() * 100.)
+    K = Q.shape[1]
+    Y = (np.count_nonzero(Q, 1) > 1).astype(int)[:, None]
+    wt = Q.max(1)[:, None]
+    pi_wt, theta_wt = pi_prior * wt.max(), theta_prior * wt.max()
+
+    def estep(pi, theta):
+        num = Q * pi * theta ** Y
+        return num / num.sum(1, keepdims=True)
+
+    def calc_lnl(z, pi, theta):
+        return (z * np.log1p(Q * pi * theta ** Y)).sum()
+
+    pi = theta = np.repeat(1. / K, K)
+    lnl, inum = float('inf'), 0
+    while True:
+        z = estep(pi, theta)
+        _theta = ((z * wt * Y).sum(0) + theta_wt) / ((wt * Y).sum() + theta_wt * K)
+        _pi = ((z * wt).sum(0) + pi_wt) / (wt.sum() + pi_wt * K)
+        inum += 1
+        if use_likelihood:
+            _lnl = calc_lnl(z, _pi, _theta)
+            converged = abs(_lnl - lnl) < epsilon
+            lnl = _lnl
+        else:
+            converged = abs(_pi - pi).sum() < epsilon
+        pi, theta = _pi, _theta
+        if converged or inum >= max_iter:
+            break
+    if not use_likelihood:
+        lnl = calc_lnl(z, pi, theta)
+    return pi, theta, z, lnl, inum
+
+
+@pytest.fixture(params=[np.intc, np.int64])
+def kernel_args(request):
+    """ CSR arrays with weighted rows, an empty row and unique rows """
+    rng = np.random.RandomState(7)
+    dense = (rng.rand(12, 5) < 0.5) * rng.rand(12, 5) * 1e3
+    dense[3] = 0
+    m = scipy.sparse.csr_matrix(dense)
+    y = (np.diff(m.indptr) > 1).astype(np.uint8)
+    return dict(dense=dense, data=m.data, indices=m.indices.astype(request.param),
+                indptr=m.indptr.astype(request.param), y=y,
+                pi=rng.dirichlet(np.ones(5)), theta=rng.dirichlet(np.ones(5)),
+                rowwt=rng.rand(12) * (rng.rand(12) < 0.8),
+                nfrags=rng.randint(1, 4, 12).astype(np.float64))
+
+
+def test_estep_kernel(kernel_args):
+    a = kernel_args
+    out = np.empty_like(a['data'])
+    cmodel.estep(a['data'], a['indices'], a['indptr'], a['y'], a['pi'],
+                 a['theta'], out)
+    num = a['dense'] * a['pi'] * a['theta'] ** a['y'][:, None]
+    rowsum = num.sum(1, keepdims=True)
+    expected = np.divide(num, rowsum, out=np.zeros_like(num),
+                         where=rowsum > 0)
+    z = scipy.sparse.csr_matrix((out, a['indices'], a['indptr']),
+                                shape=num.shape).toarray()
+    assert np.allclose(z, expected, rtol=1e-14, atol=0)
+    assert not z[3].any()
+
+
+def test_weighted_colsum_kernel(kernel_args):
+    a = kernel_args
+    out = np.zeros(5)
+    cmodel.weighted_colsum(a['data'], a['indices'], a['indptr'], a['rowwt'],
+                           out)
+    expected = (a['dense'] * a['rowwt'][:, None]).sum(0)
+    assert np.allclose(out, expected, rtol=1e-14, atol=0)
+
+
+def test_lnl_kernel(kernel_args):
+    a = kernel_args
+    zdata = np.random.RandomState(8).rand(len(a['data']))
+    z = scipy.sparse.csr_matrix((zdata, a['indices'], a['indptr']),
+                                shape=a['dense'].shape).toarray()
+    ret = cmodel.lnl(a['data'], zdata, a['indices'], a['indptr'], a['y'],
+                     a['pi'], a['theta'], a['nfrags'])
+    expected = (a['nfrags'][:, None] * z * np.log1p(
+        a['dense'] * a['pi'] * a['theta'] ** a['y'][:, None])).sum()
+    assert np.isclose(ret, expected, rtol=1e-14, atol=0)
+
+
+@pytest.mark.parametrize('use_likelihood', [False, True])
+def test_em_matches_dense(use_likelihood):
+    scores = random_scores(11)
+    pi, theta, z, lnl, inum = dense_em(scores, use_likelihood)
+    tl = make_model(scores)
+    tl.em(use_likelihood=use_likelihood)
+    assert tl.num_iter == inum
+    assert np.allclose(tl.pi, pi, rtol=1e-12, atol=1e-15)
+    assert np.allclose(tl.theta, theta, rtol=1e-12, atol=1e-15)
+    assert np.allclose(tl.z.toarray(), z, rtol=1e-12, atol=1e-15)
+    assert np.isclose(tl.lnl, lnl, rtol=1e-12, atol=0)
+
+
+def test_row_ranges():
+    # Empty matrix
+    assert cmodel.row_ranges(np.zeros(1, dtype=np.intc), 3).tolist() == \
+        [0, 0, 0, 0]
+    # Fewer rows than threads, each row is in exactly one range
+    bounds = cmodel.row_ranges(np.array([0, 2, 5], dtype=np.intc), 4)
+    assert len(bounds) == 5 and bounds[0] == 0 and bounds[-1] == 2
+    assert np.all(np.diff(bounds) >= 0)
+    # Ranges have about the same number of values
+    bounds = cmodel.row_ranges(np.arange(0, 101, dtype=np.intc), 4)
+    assert bounds.tolist() == [0, 25, 50, 75, 100]
+
+
+def test_kernels_empty():
+    _e = np.zeros(0)
+    _i = np.zeros(0, dtype=np.intc)
+    _ptr = np.zeros(1, dtype=np.intc)
+    out = np.zeros(3)
+    cmodel.estep(_e, _i, _ptr, np.zeros(0, dtype=np.uint8), np.ones(3),
+                 np.ones(3), _e, 3)
+    cmodel.weighted_colsum(_e, _i, _ptr, _e, out, 3)
+    assert not out.any()
+    assert cmodel.lnl(_e, _e, _i, _ptr, np.zeros(0, dtype=np.uint8),
+                      np.ones(3), np.ones(3), _e, 3) == 0
+
+
+def test_em_threads():
+    scores = random_scores(5, nrow=2000, ncol=40)
+    runs = []
+    for ncpu in [3, 3, 1]:
+        tl = make_model(scores, ncpu=ncpu)
+        tl.em()
+        runs.append(tl)
+    # Results are reproducible for a given number of threads
+    assert np.array_equal(runs[0].pi, runs[1].pi)
+    assert np.array_equal(runs[0].theta, runs[1].theta)
+    assert (runs[0].z != runs[1].z).nnz == 0
+    assert runs[0].lnl == runs[1].lnl
+    # and only differ by rounding from one thread
+    assert np.allclose(runs[0].pi, runs[2].pi, rtol=1e-12, atol=1e-15)
+    assert np.allclose(runs[0].z.toarray(), runs[2].z.toarray(),
+                       rtol=1e-12, atol=1e-15)
+    assert np.isclose(runs[0].lnl, runs[2].lnl, rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('use_likelihood', [False, True])
+@pytest.mark.parametrize('seed', [1, 2])
+def test_squarem(seed, use_likelihood):
+    scores = random_scores(seed)
+    tl = make_model(scores)
+    tl.em(use_likelihood=use_likelihood)
+    ts = make_model(scores, em_accel='squarem')
+    ts.em(use_likelihood=use_likelihood)
+    assert ts.converged
+    assert ts.num_iter <= tl.num_iter
+    assert abs(ts.pi - tl.pi).sum() < tl.epsilon
+    assert abs(ts.theta - tl.theta).sum() < tl.epsilon
+    assert np.array_equal(ts.pi_init, tl.pi_init)
+    if use_likelihood:
+        assert abs(ts.lnl - tl.lnl) < tl.epsilon
+    else:
+        assert abs(ts.lnl - tl.lnl) < tl.epsilon * abs(tl.lnl)
+
+
+def test_squarem_max_iter():
+    ts = make_model(random_scores(2), em_accel='squarem', max_iter=2)
+    ts.em()
+    assert ts.num_iter == 2 and not ts.converged
+    assert np.isclose(ts.pi.sum(), 1) and np.all(ts.pi >= 0)
+    assert np.isfinite(ts.lnl)
+    assert np.allclose(ts.z.sum(1), 1)
+
+
+def test_split_ambiguous():
+    scores = random_scores(4)
+    tl = make_model(scores)
+    nval = tl.Q.count(1).ravel()
+    assert np.array_equal(tl._yslice, np.flatnonzero(nval > 1))
+    assert (tl._qa != tl.Q[tl._yslice]).nnz == 0
+    assert np.array_equal(tl._qu_col, tl.Q.indices[tl.Q.indptr[:-1][nval == 1]])
+    tl.em()
+    # Unique fragments are assigned with z == 1 exactly
+    z = tl.z.toarray()
+    _unique = scores.count(1).ravel() == 1
+    assert np.array_equal(z[_unique].max(1), np.ones(_unique.sum()))
+    assert np.array_equal(z[_unique].sum(1), np.ones(_unique.sum()))
+    # Ambiguous fragments have the same z as EM over all rows
+    pi, theta, zfull, lnl, inum = dense_em(scores)
+    assert tl.num_iter == inum
+    assert np.allclose(z[~_unique], zfull[~_unique], rtol=1e-12, atol=1e-15)
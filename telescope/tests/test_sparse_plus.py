@@ -5,7 +5,11 @@ __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
 
 from tempfile import TemporaryFile
 
+import numpy as np
+import scipy.sparse
+
 from telescope.utils.sparse_plus import csr_matrix_plus
+from telescope.utils.sparse_plus import CooBuilder
 
 def sparse_equal(m1, m2):
     if m1.shape != m2.shape:
@@ -64,3 +68,97 @@ def test_mplus_save_load():
     outfile.seek(0)
     m2 = csr_matrix_plus.load(outfile)
     assert sparse_equal(m1, m2)
+
+def test_coo_builder_max():
+    triplets = [(0, 2, 5), (2, 1, 3), (0, 2, 7), (1, 0, 1), (0, 2, 6), (2, 1, 2)]
+    expected = scipy.sparse.dok_matrix((4, 3), dtype=np.uint16)
+    b = CooBuilder()
+    for i, j, v in triplets:
+        expected[i, j] = max(expected[i, j], v)
+        b.append(i, j, v)
+    m = b.tocsr(shape=(4, 3))
+    assert type(m) is csr_matrix_plus
+    assert m.dtype == np.uint16
+    assert m.has_sorted_indices
+    assert sparse_equal(m, csr_matrix_plus(expected))
+
+def test_coo_builder_extend():
+    rows, cols, vals = np.array([[0, 2, 0, 1], [2, 1, 2, 0], [5, 3, 7, 1]])
+    a = CooBuilder()
+    for i, j, v in zip(rows, cols, vals):
+        a.append(i, j, v)
+    b = CooBuilder()
+    b.extend(rows[:2], cols[:2], vals[:2])
+    b.extend(rows[2:], cols[2:], vals[2:])
+    assert len(b) == 4
+    assert sparse_equal(a.tocsr(shape=(3, 3)), b.tocsr(shape=(3, 3)))
+
+def test_coo_builder_empty():
+    m = CooBuilder().tocsr(shape=(2, 3))
+    assert m.shape == (2, 3)
+    assert m.nnz == 0
+
+def test_mplus_collapse_rows():
+    m1 = csr_matrix_plus([[1, 0, 2],
+                          [0, 0, 3],
+                          [1, 0, 2],
+                          [0, 3, 0],
+                          [0, 0, 3],
+                          [1, 0, 3]]
+                         )
+    u, counts, inverse = m1.collapse_rows()
+    assert sparse_equal(u, csr_matrix_plus([[1, 0, 2],
+                                            [0, 0, 3],
+                                            [0, 3, 0],
+                                            [1, 0, 3]]))
+    assert list(counts) == [2, 2, 1, 1]
+    assert list(inverse) == [0, 1, 0, 2, 1, 3]
+    assert sparse_equal(u[inverse], m1)
+
+def test_mplus_binmax_row():
+    m1 = csr_matrix_plus([[ 6, 0, 2],
+                          [ 0, 0, 3],
+                          [-1, 0, -2],
+                          [ 0, 0, 0],
+                          [ 4, 6, 6]])
+    a_row = csr_matrix_plus([[1, 0, 0],
+                             [0, 0, 1],
+                             [0, 1, 0],
+                             [0, 0, 0],
+                             [0, 1, 1]])
+    # Implicit zero is the maximum of row 2
+    assert sparse_equal(m1.binmax(1), a_row.multiply(m1 != 0))
+
+def test_mplus_scale_row():
+    m1 = csr_matrix_plus([[10, 0, 20], [0, 0, 0], [40, 50, 80]])
+    a_row = csr_matrix_plus([[0.5, 0, 1.], [0, 0, 0], [0.5, 0.625, 1.]])
+    assert sparse_equal(m1.scale(1), a_row)
+
+def test_mplus_choose_random():
+    m1 = csr_matrix_plus([[1, 0, 1], [0, 0, 1], [1, 1, 1], [0, 0, 0]])
+    np.random.seed(2)
+    ret = m1.choose_random(1)
+    assert ret.count(1).ravel().tolist() == [1, 1, 1, 0]
+    assert sparse_equal(ret.multiply(m1), ret)
+    # One random integer for each row with more than one value
+    np.random.seed(2)
+    expected = np.random.randint(0, [2, 3])
+    assert ret.indices[[0, 2]].tolist() == [[0, 2][expected[0]], expected[1]]
+
+def test_mplus_apply_func():
+    m1 = csr_matrix_plus([[1, 0, 2], [0, 0, 3]])
+    assert sparse_equal(m1.apply_func(lambda x: x * 2), m1.multiply(2))
+    assert sparse_equal(m1.apply_func(lambda x: 1 if x > 1 else 0),
+                        csr_matrix_plus([[0, 0, 1], [0, 0, 1]]))
+
+def test_components():
+    m = csr_matrix_plus([[1, 0, 0, 0, 2],
+                         [0, 0, 3, 0, 0],
+                         [0, 4, 0, 0, 5],
+                         [0, 0, 6, 0, 0]])
+    n, rlab, clab = m.components()
+    # Column 3 has no values and is a component by itself
+    assert n == 3
+    assert rlab[0] == rlab[2] == clab[0] == clab[1] == clab[4]
+    assert rlab[1] == rlab[3] == clab[2]
+    assert len({rlab[0], rlab[1], clab[3]}) == 3
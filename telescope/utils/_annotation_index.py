@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+""" Compiled annotation index
+
+Merged locus intervals are stored in a single binary file that is opened with
+`numpy.memmap`, so loading an index does not parse the GTF or unpickle
+anything. The file is written with `_arrayfile.write_arrays`; it starts with
+a magic string and a JSON header that gives the dtype, shape and offset of
+each array:
+
+    chroms          (in header) Chromosome names
+    chrom_ptr       int64   Intervals for chromosome c are
+                            chrom_ptr[c]:chrom_ptr[c + 1]
+    start, end      int64   Interval positions, end is exclusive
+    maxend          int64   Running maximum of end within each chromosome
+    locus           int64   Locus index for each interval
+    strand          S1      Strand for each interval
+    name_blob       uint8   Locus names, concatenated
+    name_ptr        int64   Locus i is name_blob[name_ptr[i]:name_ptr[i + 1]]
+
+Intervals are sorted by chromosome, start and end.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import object
+
+import os
+import re
+import hashlib
+from collections import namedtuple, OrderedDict
+import logging as lg
+
+import numpy as np
+
+from ._arrayfile import write_arrays, read_arrays, encode_names, decode_names
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+INDEX_MAGIC = b'TELEIDX\x01'
+INDEX_VERSION = 1
+
+GTFRow = namedtuple('GTFRow', ['chrom','source','feature','start','end','score','strand','frame','attribute'])
+
+
+def merge_locus_intervals(starts, ends, lids, order=None):
+    """ Merge overlapping intervals that belong to the same locus
+
+    Intervals are half-open. Two intervals from the same locus are merged if
+    they overlap by at least one position; adjacent intervals are not merged.
+
+    Args:
+        starts (ndarray): Interval start positions
+        ends (ndarray): Interval end positions (exclusive)
+        lids (ndarray): Locus index for each interval
+        order (ndarray): Order in which intervals were added, used to choose
+            the interval whose attributes are kept for each merged interval.
+
+    Returns:
+        tuple: Merged starts, ends, and locus indexes, and the index of the
+            last added interval in each merged interval. Merged intervals are
+            sorted by locus and start position.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    lids = np.asarray(lids, dtype=np.int64)
+    order = np.arange(len(starts)) if order is None else np.asarray(order)
+    if len(starts) == 0:
+        _empty = np.zeros(0, dtype=np.int64)
+        return _empty, _empty.copy(), _empty.copy(), _empty.copy()
+
+    _sort = np.lexsort((starts, lids))
+    s, e, l, o = starts[_sort], ends[_sort], lids[_sort], order[_sort]
+    ''' Running maximum of end position within each locus '''
+    _span = int(e.max()) + 1
+    _runmax = np.maximum.accumulate(l * _span + e) - l * _span
+    ''' Interval starts a new merged interval if it does not overlap the
+        previous intervals of the same locus '''
+    _new = np.ones(len(s), dtype=bool)
+    _new[1:] = (l[1:] != l[:-1]) | (s[1:] >= _runmax[:-1])
+    _first = np.flatnonzero(_new)
+    _last = np.append(_first[1:], len(s)) - 1
+    _latest = np.maximum.reduceat(o, _first)
+    return s[_first], _runmax[_last], l[_first], _latest
+
+
+def read_gtf_intervals(gtf_file, attribute_name, feature_type='exon'):
+    """ Read GTF file and merge intervals of each locus
+
+    Rows are collected for each chromosome and merged with
+    `merge_locus_intervals` once the whole file has been read. The strand of
+    a merged interval is the strand of the last row added to it.
+
+    Args:
+        gtf_file (str or file): Path to GTF file, or open file
+        attribute_name (str): GTF attribute that defines a locus
+        feature_type (str): GTF feature type to include
+
+    Returns:
+        tuple: OrderedDict of locus name to list of GTFRow, and OrderedDict of
+            chromosome name to tuple of (start, end, locus, strand) arrays for
+            merged intervals. Ends are exclusive and locus is the index of
+            the locus in the first OrderedDict.
+    """
+    loci = OrderedDict()
+    _lidx = {}
+    _rows = OrderedDict()
+
+    # GTF filehandle
+    fh = open(gtf_file,'r') if isinstance(gtf_file,str) else gtf_file
+    for rownum, l in enumerate(fh):
+        if l.startswith('#'): continue
+        f = GTFRow(*l.strip('\n').split('\t'))
+        if f.feature != feature_type: continue
+        attr = dict(re.findall('(\w+)\s+"(.+?)";', f.attribute))
+        if attribute_name not in attr:
+            lg.warning('Skipping row %d: missing attribute "%s"' % (rownum, attribute_name))
+            continue
+
+        ''' Add to locus list '''
+        if attr[attribute_name] not in loci:
+            loci[attr[attribute_name]] = list()
+            _lidx[attr[attribute_name]] = len(_lidx)
+        loci[attr[attribute_name]].append(f)
+        ''' Add to rows for chromosome '''
+        if f.chrom not in _rows:
+            _rows[f.chrom] = ([], [], [], [])
+        _rows[f.chrom][0].append(int(f.start))
+        _rows[f.chrom][1].append(int(f.end) + 1)
+        _rows[f.chrom][2].append(_lidx[attr[attribute_name]])
+        _rows[f.chrom][3].append(f.strand)
+
+    intervals = OrderedDict()
+    for chrom, (starts, ends, lids, strands) in _rows.items():
+        s, e, lid, latest = merge_locus_intervals(starts, ends, lids)
+        intervals[chrom] = (s, e, lid, np.array(strands, dtype='S1')[latest])
+    return loci, intervals
+
+
+def gtf_hash(gtf_file, blocksize=1 << 20):
+    """ SHA-1 digest of GTF file content """
+    h = hashlib.sha1()
+    with open(gtf_file, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(blocksize), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def index_key(gtf_file, attribute_name, feature_type, stranded_mode):
+    """ Key identifying the index built from a GTF file and options """
+    h = hashlib.sha1()
+    h.update(gtf_hash(gtf_file).encode())
+    for v in (attribute_name, feature_type, stranded_mode, INDEX_VERSION):
+        h.update(b'\t' + str(v).encode())
+    return h.hexdigest()
+
+
+def default_cache_dir():
+    _base = os.environ.get('XDG_CACHE_HOME',
+                           os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(_base, 'telescope')
+
+
+class AnnotationIndex(object):
+    """ Merged locus intervals stored as flat arrays
+
+    Args:
+        chroms (list of str): Chromosome names
+        arrays (dict of str: ndarray): Arrays described in the module
+            docstring, except for `chroms`.
+        meta (dict): Options used to build the index
+    """
+    ARRAYS = ('chrom_ptr', 'start', 'end', 'maxend', 'locus', 'strand',
+              'name_blob', 'name_ptr')
+
+    def __init__(self, chroms, arrays, meta=None):
+        self.chroms = list(chroms)
+        self.arrays = arrays
+        self.meta = meta if meta is not None else {}
+
+    @classmethod
+    def from_intervals(cls, locus_names, chrom_intervals, meta=None):
+        """ Build index from merged intervals
+
+        Args:
+            locus_names (list of str): Locus names
+            chrom_intervals (OrderedDict): Chromosome name to tuple of
+                (start, end, locus, strand) arrays
+            meta (dict): Options used to build the index
+
+        Returns:
+            AnnotationIndex
+        """
+        _cols = {k: [] for k in ('start', 'end', 'maxend', 'locus', 'strand')}
+        _ptr = [0]
+        for chrom, (s, e, l, st) in chrom_intervals.items():
+            s = np.asarray(s, dtype=np.int64)
+            e = np.asarray(e, dtype=np.int64)
+            _sort = np.lexsort((e, s))
+            _cols['start'].append(s[_sort])
+            _cols['end'].append(e[_sort])
+            _cols['maxend'].append(np.maximum.accumulate(e[_sort])
+                                   if len(e) else e)
+            _cols['locus'].append(np.asarray(l, dtype=np.int64)[_sort])
+            _cols['strand'].append(np.asarray(st, dtype='S1')[_sort])
+            _ptr.append(_ptr[-1] + len(s))
+
+        arrays = {}
+        for k, dtype in (('start', np.int64), ('end', np.int64),
+                         ('maxend', np.int64), ('locus', np.int64),
+                         ('strand', 'S1')):
+            arrays[k] = (np.concatenate(_cols[k]).astype(dtype) if _cols[k]
+                         else np.zeros(0, dtype=dtype))
+        arrays['chrom_ptr'] = np.array(_ptr, dtype=np.int64)
+        arrays['name_blob'], arrays['name_ptr'] = encode_names(locus_names)
+        return cls(chrom_intervals.keys(), arrays, meta)
+
+    def locus_names(self):
+        return decode_names(self.arrays['name_blob'], self.arrays['name_ptr'])
+
+    def chrom_intervals(self):
+        """ Arrays of (start, end, maxend, locus, strand) for each chromosome
+
+        Returns:
+            OrderedDict: Chromosome name to dict of arrays. Arrays are views
+                of the index arrays.
+        """
+        ret = OrderedDict()
+        _ptr = self.arrays['chrom_ptr']
+        for c, chrom in enumerate(self.chroms):
+            _s = slice(int(_ptr[c]), int(_ptr[c + 1]))
+            ret[chrom] = {k: self.arrays[k][_s]
+                          for k in ('start', 'end', 'maxend', 'locus', 'strand')}
+        return ret
+
+    def save(self, filename):
+        """ Write index to file
+
+        The file is written to a temporary name in the same directory and then
+        renamed, so concurrent runs never see a partial index.
+        """
+        header = {'version': INDEX_VERSION, 'meta': self.meta,
+                  'chroms': self.chroms}
+        write_arrays(filename, INDEX_MAGIC, header,
+                     OrderedDict((k, self.arrays[k]) for k in self.ARRAYS))
+
+    @classmethod
+    def load(cls, filename):
+        """ Open index file, arrays are memory-mapped """
+        try:
+            header, arrays = read_arrays(filename, INDEX_MAGIC)
+        except ValueError:
+            raise ValueError('%s is not an annotation index' % filename)
+        if header['version'] != INDEX_VERSION:
+            raise ValueError('Unsupported annotation index version %s'
+                             % header['version'])
+        return cls(header['chroms'], arrays, header['meta'])
@@ -3,64 +3,60 @@ from __future__ import print_function
 from __future__ import absolute_import
 from builtins import object
 
-import re
-from collections import defaultdict, namedtuple, Counter, OrderedDict
+from collections import defaultdict, Counter, OrderedDict
 import logging as lg
-import pickle
 
 
 from intervaltree import Interval, IntervalTree
 
+from ._annotation_index import AnnotationIndex, read_gtf_intervals
+from ._annotation_steps import LocusSteps, assign_steps_batch
+
 
 __author__ = 'Matthew L. Bendall'
 __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
 
 
-GTFRow = namedtuple('GTFRow', ['chrom','source','feature','start','end','score','strand','frame','attribute'])
-
 def overlap_length(a,b):
     return max(0, min(a.end,b.end) - max(a.begin,b.begin))
 
-def merge_intervals(a, b, d=None):
-    return Interval(min(a.begin,b.begin), max(a.end,b.end), d)
-
 class _AnnotationIntervalTree(object):
 
     def __init__(self, gtf_file, attribute_name, stranded_mode, feature_type='exon'):
         lg.debug('Using intervaltree for annotation.')
-        self.loci = OrderedDict()
         self.key = attribute_name
+        self.feature_type = feature_type
+        self.stranded_mode = stranded_mode
         self.itree = defaultdict(IntervalTree)
         self.run_stranded = True if stranded_mode != 'None' else False
 
-        # GTF filehandle
-        fh = open(gtf_file,'rU') if isinstance(gtf_file,str) else gtf_file
-        for rownum, l in enumerate(fh):
-            if l.startswith('#'): continue
-            f = GTFRow(*l.strip('\n').split('\t'))
-            if f.feature != feature_type: continue
-            attr = dict(re.findall('(\w+)\s+"(.+?)";', f.attribute))
-            attr['strand'] = f.strand
-            if self.key not in attr:
-                lg.warning('Skipping row %d: missing attribute "%s"' % (rownum, self.key))
-                continue
-
-            ''' Add to locus list '''
-            if attr[self.key] not in self.loci:
-                self.loci[attr[self.key]] = list()
-            self.loci[attr[self.key]].append(f)
-            ''' Add to interval tree '''
-            new_iv = Interval(int(f.start), int(f.end)+1, attr)
-            # Merge overlapping intervals from same locus
-            if True:
-                overlap = self.itree[f.chrom].overlap(new_iv)
-                if len(overlap) > 0:
-                    mergeable = [iv for iv in overlap if iv.data[self.key]==attr[self.key]]
-                    if mergeable:
-                        assert len(mergeable) == 1, "Error"
-                        new_iv = merge_intervals(mergeable[0], new_iv, {self.key: attr[self.key], 'strand': attr['strand']})
-                        self.itree[f.chrom].remove(mergeable[0])
-            self.itree[f.chrom].add(new_iv)
+        self.loci, _intervals = read_gtf_intervals(gtf_file, self.key, feature_type)
+        self.locus_names = list(self.loci.keys())
+        ''' Build each tree once from merged intervals '''
+        for chrom, (starts, ends, lids, strands) in _intervals.items():
+            self.itree[chrom] = IntervalTree(
+                Interval(b, e, {self.key: self.locus_names[l], 'strand': st.decode()})
+                for b, e, l, st in zip(starts.tolist(), ends.tolist(),
+                                       lids.tolist(), strands.tolist())
+            )
+        self._build_strand_trees()
+
+    def _build_strand_trees(self):
+        """ Separate tree for each chromosome and strand
+
+        Used for stranded queries so that intervals on the other strand are
+        never visited.
+        """
+        self.stree = {}
+        self._steps = {}
+        if not self.run_stranded:
+            return
+        for chrom, tree in self.itree.items():
+            _bystrand = defaultdict(list)
+            for iv in tree:
+                _bystrand[iv.data['strand']].append(iv)
+            for strand, ivs in _bystrand.items():
+                self.stree[(chrom, strand)] = IntervalTree(ivs)
 
     def feature_length(self):
         """ Get feature lengths
@@ -78,6 +74,8 @@ class _AnnotationIntervalTree(object):
     def subregion(self, ref, start_pos=None, end_pos=None):
         _subannot = type(self).__new__(type(self))
         _subannot.key = self.key
+        _subannot.locus_names = self.locus_names
+        _subannot.run_stranded = self.run_stranded
         _subannot.itree = defaultdict(IntervalTree)
 
         if ref in self.itree:
@@ -87,35 +85,91 @@ class _AnnotationIntervalTree(object):
             if end_pos is not None:
                 _subtree.chop(end_pos, _subtree.end() + 1)
             _subannot.itree[ref] = _subtree
+        _subannot._build_strand_trees()
         return _subannot
 
     def intersect_blocks(self, ref, blocks, frag_strand):
         _result = Counter()
+        if self.run_stranded:
+            tree = self.stree.get((ref, frag_strand))
+        else:
+            tree = self.itree.get(ref)
+        if tree is None:
+            return _result
         for b_start, b_end in blocks:
             query = Interval(b_start, (b_end + 1))
-            for iv in self.itree[ref].overlap(query):
-                if self.run_stranded == True:
-                    if iv.data['strand'] == frag_strand:
-                        _result[iv.data[self.key]] += overlap_length(iv, query)
-                else:
-                    _result[iv.data[self.key]] += overlap_length(iv, query)
+            for iv in tree.overlap(query):
+                _result[iv.data[self.key]] += overlap_length(iv, query)
         return _result
 
     def save(self, filename):
-        with open(filename, 'wb') as outh:
-            pickle.dump({
-                'key': self.key,
-                'loci': self.loci,
-                'itree': self.itree,
-            }, outh)
+        """ Write annotation to a compiled index file """
+        _lidx = {n: i for i, n in enumerate(self.loci)}
+        _intervals = OrderedDict()
+        for chrom, tree in self.itree.items():
+            _ivs = list(tree)
+            _intervals[chrom] = (
+                [iv.begin for iv in _ivs], [iv.end for iv in _ivs],
+                [_lidx[iv.data[self.key]] for iv in _ivs],
+                [iv.data['strand'] for iv in _ivs],
+            )
+        meta = {'class': 'intervaltree', 'key': self.key,
+                'feature_type': self.feature_type,
+                'stranded_mode': self.stranded_mode}
+        AnnotationIndex.from_intervals(list(self.loci), _intervals, meta).save(filename)
 
     @classmethod
     def load(cls, filename):
-        with open(filename, 'rb') as fh:
-            loader = pickle.load(fh)
-        obj = cls.__new__(cls)
-        obj.key = loader['key']
-        obj.loci = loader['loci']
-        obj.itree = loader['itree']
+        """ Load annotation from a compiled index file
 
+        The `loci` of a loaded annotation only holds the locus names, the GTF
+        rows are not stored.
+        """
+        index = AnnotationIndex.load(filename)
+        obj = cls.__new__(cls)
+        obj.key = index.meta['key']
+        obj.feature_type = index.meta['feature_type']
+        obj.stranded_mode = index.meta['stranded_mode']
+        obj.run_stranded = True if obj.stranded_mode != 'None' else False
+        _names = obj.locus_names = index.locus_names()
+        obj.loci = OrderedDict.fromkeys(_names)
+        obj.itree = defaultdict(IntervalTree)
+        for chrom, arr in index.chrom_intervals().items():
+            obj.itree[chrom] = IntervalTree(
+                Interval(b, e, {obj.key: _names[l], 'strand': st.decode()})
+                for b, e, l, st in zip(arr['start'].tolist(), arr['end'].tolist(),
+                                       arr['locus'].tolist(), arr['strand'].tolist())
+            )
+        obj._build_strand_trees()
         return obj
+
+    def steps(self, ref, strand=None):
+        """ Step representation of loci for a chromosome and strand
+
+        Returns:
+            LocusSteps: Steps, or None if there are no intervals
+        """
+        _key = (ref, strand) if self.run_stranded else ref
+        if _key not in self._steps:
+            tree = self.stree.get(_key) if self.run_stranded else self.itree.get(ref)
+            if not tree:
+                self._steps[_key] = None
+            else:
+                _lidx = {n: i for i, n in enumerate(self.locus_names)}
+                _ivs = list(tree)
+                self._steps[_key] = LocusSteps(
+                    [iv.begin for iv in _ivs], [iv.end for iv in _ivs],
+                    [_lidx[iv.data[self.key]] for iv in _ivs]
+                )
+        return self._steps[_key]
+
+    def assign_steps_batch(self, mode, frag, refs, block_start, block_end,
+                           strand=None, nfrags=None):
+        """ Assign many fragments with an HTSeq overlap mode
+
+        See `_annotation_steps.assign_steps_batch`. Returned locus indexes
+        refer to `locus_names`.
+        """
+        return assign_steps_batch(self.steps, mode, frag, refs, block_start,
+                                  block_end, strand if self.run_stranded else None,
+                                  nfrags)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import object
+
+from collections import Counter, OrderedDict
+from bisect import bisect_left, bisect_right
+import logging as lg
+
+import numpy as np
+
+from ._annotation_index import AnnotationIndex, read_gtf_intervals
+from ._annotation_steps import LocusSteps, assign_steps_batch
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+class _AnnotationNumpy(object):
+    """ Annotation stored as sorted interval arrays
+
+    Merged locus intervals on each chromosome are stored as arrays of start
+    positions, end positions (exclusive), and locus indexes, sorted by start
+    position. `maxend[i]` is the largest end position of intervals 0 to i, so
+    the intervals overlapping a query [qstart, qend) are found between
+    `searchsorted(maxend, qstart, 'right')` and `searchsorted(start, qend)`.
+    """
+
+    def __init__(self, gtf_file, attribute_name, stranded_mode, feature_type='exon'):
+        lg.debug('Using numpy for annotation.')
+        self.key = attribute_name
+        self.feature_type = feature_type
+        self.stranded_mode = stranded_mode
+        self.run_stranded = True if stranded_mode != 'None' else False
+
+        self.loci, _intervals = read_gtf_intervals(gtf_file, self.key, feature_type)
+        self.locus_names = list(self.loci.keys())
+        self.chroms = OrderedDict(
+            (chrom, self._chrom_arrays(*ivs)) for chrom, ivs in _intervals.items()
+        )
+        self._lists = {}
+        self._parts = {}
+        self._steps = {}
+
+    @staticmethod
+    def _chrom_arrays(starts, ends, lids, strands):
+        """ Sort intervals by start position and calculate maximum end """
+        _sort = np.lexsort((ends, starts))
+        ends = ends[_sort]
+        return {
+            'start': starts[_sort],
+            'end': ends,
+            'maxend': np.maximum.accumulate(ends) if len(ends) else ends,
+            'locus': lids[_sort],
+            'strand': np.asarray(strands, dtype='S1')[_sort],
+        }
+
+    def _partition(self, ref, strand):
+        """ Interval arrays queried for a chromosome and fragment strand
+
+        In stranded mode each chromosome is split into a separate set of
+        arrays for each strand, created the first time it is queried.
+
+        Returns:
+            dict: Interval arrays, or None if there are no intervals
+        """
+        if not self.run_stranded:
+            return self.chroms.get(ref)
+        if (ref, strand) not in self._parts:
+            arr = self.chroms.get(ref)
+            if arr is None:
+                self._parts[(ref, strand)] = None
+            else:
+                _m = arr['strand'] == strand.encode()
+                self._parts[(ref, strand)] = self._chrom_arrays(
+                    arr['start'][_m], arr['end'][_m], arr['locus'][_m],
+                    arr['strand'][_m]
+                )
+        return self._parts[(ref, strand)]
+
+    def _chrom_lists(self, ref, strand):
+        """ Python lists of the interval arrays, used for single queries
+
+        Lists are created the first time a chromosome is queried.
+        """
+        _key = (ref, strand) if self.run_stranded else ref
+        if _key not in self._lists:
+            arr = self._partition(ref, strand)
+            self._lists[_key] = None if arr is None else (
+                arr['start'].tolist(), arr['end'].tolist(),
+                arr['maxend'].tolist(),
+                [self.locus_names[i] for i in arr['locus']],
+            )
+        return self._lists[_key]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lists'] = {}
+        state['_parts'] = {}
+        state['_steps'] = {}
+        return state
+
+    def save(self, filename):
+        """ Write annotation to a compiled index file """
+        _intervals = OrderedDict(
+            (chrom, (arr['start'], arr['end'], arr['locus'], arr['strand']))
+            for chrom, arr in self.chroms.items()
+        )
+        meta = {'class': 'numpy', 'key': self.key,
+                'feature_type': self.feature_type,
+                'stranded_mode': self.stranded_mode}
+        AnnotationIndex.from_intervals(self.locus_names, _intervals, meta).save(filename)
+
+    @classmethod
+    def load(cls, filename):
+        """ Open compiled index file
+
+        Interval arrays are memory-mapped. The `loci` of a loaded annotation
+        only holds the locus names, the GTF rows are not stored.
+        """
+        index = AnnotationIndex.load(filename)
+        obj = cls.__new__(cls)
+        obj.key = index.meta['key']
+        obj.feature_type = index.meta['feature_type']
+        obj.stranded_mode = index.meta['stranded_mode']
+        obj.run_stranded = True if obj.stranded_mode != 'None' else False
+        obj.locus_names = index.locus_names()
+        obj.loci = OrderedDict.fromkeys(obj.locus_names)
+        obj.chroms = index.chrom_intervals()
+        obj._lists = {}
+        obj._parts = {}
+        obj._steps = {}
+        return obj
+
+    def feature_length(self):
+        """ Get feature lengths
+
+        Returns:
+            (dict of str: int): Feature names to feature lengths
+
+        """
+        ret = Counter()
+        for chrom, arr in self.chroms.items():
+            _len = np.bincount(arr['locus'], arr['end'] - arr['start'],
+                               minlength=len(self.locus_names))
+            for i in np.flatnonzero(np.bincount(arr['locus'])):
+                ret[self.locus_names[i]] += int(_len[i])
+        return ret
+
+    def subregion(self, ref, start_pos=None, end_pos=None):
+        _subannot = type(self).__new__(type(self))
+        _subannot.key = self.key
+        _subannot.loci = self.loci
+        _subannot.locus_names = self.locus_names
+        _subannot.feature_type = self.feature_type
+        _subannot.stranded_mode = self.stranded_mode
+        _subannot.run_stranded = self.run_stranded
+        _subannot.chroms = OrderedDict()
+        _subannot._lists = {}
+        _subannot._parts = {}
+        _subannot._steps = {}
+
+        if ref in self.chroms:
+            arr = self.chroms[ref]
+            s, e = arr['start'], arr['end']
+            if start_pos is not None:
+                s = np.maximum(s, start_pos)
+            if end_pos is not None:
+                e = np.minimum(e, end_pos)
+            _keep = s < e
+            _subannot.chroms[ref] = self._chrom_arrays(
+                s[_keep], e[_keep], arr['locus'][_keep], arr['strand'][_keep]
+            )
+        return _subannot
+
+    def intersect_blocks(self, ref, blocks, frag_strand):
+        _result = Counter()
+        _lists = self._chrom_lists(ref, frag_strand)
+        if _lists is None:
+            return _result
+        starts, ends, maxend, names = _lists
+        for b_start, b_end in blocks:
+            qend = b_end + 1
+            for i in range(bisect_right(maxend, b_start), bisect_left(starts, qend)):
+                if ends[i] <= b_start:
+                    continue
+                _result[names[i]] += min(ends[i], qend) - max(starts[i], b_start)
+        return _result
+
+    def overlap_arrays(self, frag, refs, block_start, block_end, strand=None):
+        """ Find overlaps for many alignment blocks at once
+
+        Args:
+            frag (ndarray): Fragment index for each block
+            refs (ndarray): Reference name for each block
+            block_start (ndarray): Start position of each block
+            block_end (ndarray): End position of each block (inclusive)
+            strand (ndarray): Fragment strand for each block, only used if
+                running in stranded mode.
+
+        Returns:
+            tuple: Fragment indexes, locus indexes, and overlap lengths, with
+                one entry for each fragment and locus that overlap. Locus
+                indexes refer to `locus_names`.
+        """
+        frag = np.asarray(frag, dtype=np.int64)
+        refs = np.asarray(refs)
+        qstart = np.asarray(block_start, dtype=np.int64)
+        qend = np.asarray(block_end, dtype=np.int64) + 1
+        if self.run_stranded:
+            strand = np.asarray(strand)
+            _groups = sorted(set(zip(refs.tolist(), strand.tolist())))
+        else:
+            strand = None
+            _groups = [(r, None) for r in np.unique(refs)]
+
+        _frags, _loci, _lens = [], [], []
+        for ref, st in _groups:
+            arr = self._partition(ref, st)
+            if arr is None:
+                continue
+            _b = np.flatnonzero(refs == ref) if st is None else \
+                np.flatnonzero((refs == ref) & (strand == st))
+            lo = np.searchsorted(arr['maxend'], qstart[_b], 'right')
+            hi = np.searchsorted(arr['start'], qend[_b], 'left')
+            ''' One row for each block and candidate interval '''
+            _n = np.maximum(hi - lo, 0)
+            _bidx = np.repeat(_b, _n)
+            _offset = np.arange(_n.sum()) - np.repeat(np.cumsum(_n) - _n, _n)
+            _iidx = np.repeat(lo, _n) + _offset
+            _olen = (np.minimum(arr['end'][_iidx], qend[_bidx]) -
+                     np.maximum(arr['start'][_iidx], qstart[_bidx]))
+            _keep = _olen > 0
+            _frags.append(frag[_bidx[_keep]])
+            _loci.append(arr['locus'][_iidx[_keep]])
+            _lens.append(_olen[_keep])
+
+        if not _frags:
+            _empty = np.zeros(0, dtype=np.int64)
+            return _empty, _empty.copy(), _empty.copy()
+        _frags = np.concatenate(_frags)
+        _loci = np.concatenate(_loci)
+        _lens = np.concatenate(_lens)
+        ''' Sum overlaps for each fragment and locus '''
+        _key, _inv = np.unique(_frags * len(self.locus_names) + _loci,
+                               return_inverse=True)
+        _sums = np.bincount(_inv, _lens).astype(np.int64)
+        return (_key // len(self.locus_names), _key % len(self.locus_names),
+                _sums)
+
+    def intersect_batch(self, frag, refs, block_start, block_end, strand=None,
+                        nfrags=None):
+        """ Intersect blocks for many fragments at once
+
+        Args:
+            frag (ndarray): Fragment index for each block
+            refs (ndarray): Reference name for each block
+            block_start (ndarray): Start position of each block
+            block_end (ndarray): End position of each block (inclusive)
+            strand (ndarray): Fragment strand for each block
+            nfrags (int): Number of fragments. Default is max(frag) + 1.
+
+        Returns:
+            list of Counter: Overlap with each locus for each fragment, the
+                same as calling `intersect_blocks` on each fragment.
+        """
+        if nfrags is None:
+            nfrags = int(np.max(frag)) + 1 if len(frag) else 0
+        ret = [Counter() for _ in range(nfrags)]
+        for fi, li, ol in zip(*(a.tolist() for a in self.overlap_arrays(
+                frag, refs, block_start, block_end, strand))):
+            ret[fi][self.locus_names[li]] = ol
+        return ret
+
+    def steps(self, ref, strand=None):
+        """ Step representation of loci for a chromosome and strand
+
+        Returns:
+            LocusSteps: Steps, or None if there are no intervals
+        """
+        _key = (ref, strand) if self.run_stranded else ref
+        if _key not in self._steps:
+            arr = self._partition(ref, strand)
+            self._steps[_key] = None if arr is None or len(arr['start']) == 0 \
+                else LocusSteps(arr['start'], arr['end'], arr['locus'])
+        return self._steps[_key]
+
+    def assign_steps_batch(self, mode, frag, refs, block_start, block_end,
+                           strand=None, nfrags=None):
+        """ Assign many fragments with an HTSeq overlap mode
+
+        See `_annotation_steps.assign_steps_batch`. Returned locus indexes
+        refer to `locus_names`.
+        """
+        return assign_steps_batch(self.steps, mode, frag, refs, block_start,
+                                  block_end, strand if self.run_stranded else None,
+                                  nfrags)
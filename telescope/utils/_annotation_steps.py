@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+""" Step representation of annotation for HTSeq overlap modes
+
+A chromosome is divided into steps at every interval start and end, so that
+the set of loci overlapping each position is constant within a step (like
+`HTSeq.GenomicArrayOfSets`). For a fragment, the set S(i) of loci is looked
+up for every aligned position i:
+
+    union                   union of S(i) for all i
+    intersection-strict     intersection of S(i) for all i, empty if any
+                            position does not overlap a locus
+
+A fragment is assigned to a locus if the resulting set contains exactly one
+locus. Fragments with an empty set (no feature) or with more than one locus
+(ambiguous) are not assigned.
+
+Blocks use the same coordinates as `intersect_blocks`: block (start, end)
+covers positions start to end, inclusive.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import object
+
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+STEP_MODES = ('union', 'intersection-strict')
+
+''' Values returned by batch assignment for unassigned fragments '''
+NO_FEATURE = -1
+AMBIGUOUS = -2
+
+
+def _expand_ranges(lo, hi):
+    """ Index of each range and each value in ranges [lo, hi) """
+    _n = np.maximum(hi - lo, 0)
+    _ridx = np.repeat(np.arange(len(lo)), _n)
+    _vals = np.repeat(lo - (np.cumsum(_n) - _n), _n) + np.arange(_n.sum())
+    return _ridx, _vals
+
+
+class LocusSteps(object):
+    """ Loci overlapping each step of one chromosome
+
+    Step k covers positions bounds[k] to bounds[k + 1] - 1, and is overlapped
+    by loci[ptr[k]:ptr[k + 1]]. Positions before bounds[0] or after
+    bounds[-1] - 1 do not overlap any locus.
+
+    Args:
+        starts (ndarray): Interval start positions
+        ends (ndarray): Interval end positions (exclusive)
+        lids (ndarray): Locus index for each interval
+    """
+    def __init__(self, starts, ends, lids):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        lids = np.asarray(lids, dtype=np.int64)
+        self.bounds = np.unique(np.concatenate([starts, ends]))
+        _nsteps = max(len(self.bounds) - 1, 0)
+        _iv, _step = _expand_ranges(np.searchsorted(self.bounds, starts),
+                                    np.searchsorted(self.bounds, ends))
+        ''' Unique loci for each step, sorted by step '''
+        _width = int(lids.max()) + 1 if len(lids) else 1
+        _pairs = np.unique(_step * _width + lids[_iv])
+        self.loci = _pairs % _width
+        self.ptr = np.zeros(_nsteps + 1, dtype=np.int64)
+        np.cumsum(np.bincount(_pairs // _width, minlength=_nsteps),
+                  out=self.ptr[1:])
+        self._bounds_list = self.bounds.tolist()
+        self._ptr_list = self.ptr.tolist()
+        self._loci_list = self.loci.tolist()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_bounds_list', '_ptr_list', '_loci_list'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bounds_list = self.bounds.tolist()
+        self._ptr_list = self.ptr.tolist()
+        self._loci_list = self.loci.tolist()
+
+    def _step_sets(self, blocks):
+        """ Locus sets for the steps covered by blocks
+
+        Returns:
+            tuple: List of locus sets, and whether every position is within
+                the steps.
+        """
+        bounds, ptr, loci = self._bounds_list, self._ptr_list, self._loci_list
+        covered = True
+        sets = []
+        for b_start, b_end in blocks:
+            qend = b_end + 1
+            if b_start < bounds[0] or qend > bounds[-1]:
+                covered = False
+            lo = max(bisect_right(bounds, b_start) - 1, 0)
+            hi = min(bisect_left(bounds, qend), len(ptr) - 1)
+            for k in range(lo, hi):
+                sets.append(loci[ptr[k]:ptr[k + 1]])
+        return sets, covered
+
+    def union(self, blocks):
+        """ Union of locus sets for all positions in blocks """
+        ret = set()
+        for s in self._step_sets(blocks)[0]:
+            ret.update(s)
+        return ret
+
+    def intersection_strict(self, blocks):
+        """ Intersection of locus sets for all positions in blocks """
+        sets, covered = self._step_sets(blocks)
+        if not covered or not sets:
+            return set()
+        ret = set(sets[0])
+        for s in sets[1:]:
+            ret.intersection_update(s)
+            if not ret:
+                break
+        return ret
+
+    def block_steps(self, qstart, qend):
+        """ Steps covered by many blocks
+
+        Args:
+            qstart (ndarray): Block start positions
+            qend (ndarray): Block end positions (exclusive)
+
+        Returns:
+            tuple: Block index and step index for each block and step, and
+                whether each block is within the steps.
+        """
+        covered = (qstart >= self.bounds[0]) & (qend <= self.bounds[-1])
+        lo = np.maximum(np.searchsorted(self.bounds, qstart, 'right') - 1, 0)
+        hi = np.minimum(np.searchsorted(self.bounds, qend, 'left'),
+                        len(self.ptr) - 1)
+        _bidx, _step = _expand_ranges(lo, hi)
+        return _bidx, _step, covered
+
+
+def assign_steps_batch(get_steps, mode, frag, refs, block_start, block_end,
+                       strand=None, nfrags=None):
+    """ Assign many fragments with an HTSeq overlap mode
+
+    Args:
+        get_steps (function): Returns LocusSteps for (ref, strand), or None
+        mode (str): "union" or "intersection-strict"
+        frag (ndarray): Fragment index for each block
+        refs (ndarray): Reference name for each block
+        block_start (ndarray): Start position of each block
+        block_end (ndarray): End position of each block (inclusive)
+        strand (ndarray): Fragment strand for each block, or None
+        nfrags (int): Number of fragments. Default is max(frag) + 1.
+
+    Returns:
+        ndarray: Assigned locus index for each fragment, NO_FEATURE or
+            AMBIGUOUS.
+    """
+    if mode not in STEP_MODES:
+        raise ValueError('mode must be one of %s' % ', '.join(STEP_MODES))
+    frag = np.asarray(frag, dtype=np.int64)
+    refs = np.asarray(refs)
+    qstart = np.asarray(block_start, dtype=np.int64)
+    qend = np.asarray(block_end, dtype=np.int64) + 1
+    if nfrags is None:
+        nfrags = int(frag.max()) + 1 if len(frag) else 0
+    if strand is None:
+        _groups = [(r, None) for r in np.unique(refs).tolist()]
+    else:
+        strand = np.asarray(strand)
+        _groups = sorted(set(zip(refs.tolist(), strand.tolist())))
+
+    uncovered = np.zeros(nfrags, dtype=bool)
+    _fsteps, _floci = [], []
+    for ref, st in _groups:
+        _b = np.flatnonzero(refs == ref) if st is None else \
+            np.flatnonzero((refs == ref) & (strand == st))
+        steps = get_steps(ref, st)
+        if steps is None or len(steps.ptr) < 2:
+            uncovered[frag[_b]] = True
+            continue
+        _bidx, _step, _covered = steps.block_steps(qstart[_b], qend[_b])
+        uncovered[frag[_b[~_covered]]] = True
+        ''' Unique (fragment, step) pairs and loci for each pair '''
+        _nsteps = len(steps.ptr) - 1
+        _fs = np.unique(frag[_b[_bidx]] * _nsteps + _step)
+        _f, _s = _fs // _nsteps, _fs % _nsteps
+        _fsteps.append(_f)
+        _sidx, _lpos = _expand_ranges(steps.ptr[_s], steps.ptr[_s + 1])
+        _floci.append(np.stack([_f[_sidx], steps.loci[_lpos]]))
+
+    ret = np.full(nfrags, NO_FEATURE, dtype=np.int64)
+    if not _floci:
+        return ret
+    _fl = np.concatenate(_floci, axis=1)
+    _width = int(_fl[1].max()) + 1 if _fl.shape[1] else 1
+    _key, _count = np.unique(_fl[0] * _width + _fl[1], return_counts=True)
+    _f, _l = _key // _width, _key % _width
+    if mode == 'intersection-strict':
+        ''' Locus is in the intersection if it overlaps every step '''
+        _nsteps = np.bincount(np.concatenate(_fsteps), minlength=nfrags)
+        _keep = (_count == _nsteps[_f]) & ~uncovered[_f]
+        _f, _l = _f[_keep], _l[_keep]
+    _nloci = np.bincount(_f, minlength=nfrags)
+    ret[_nloci > 1] = AMBIGUOUS
+    _single = _nloci[_f] == 1
+    ret[_f[_single]] = _l[_single]
+    return ret
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+""" Binary files of named arrays
+
+A file starts with a magic string, the length of a JSON header (uint64), and
+the header. Arrays follow, each starting at a multiple of ARRAY_ALIGN bytes
+from the end of the header. The "arrays" entry of the header gives the
+dtype, length and offset of each array:
+
+    "arrays": {"name": [dtype, length, offset], ...}
+
+Uncompressed arrays are opened with `numpy.memmap`. Compressed arrays are
+stored with zlib and have two more values, the number of stored bytes and
+"zlib"; they are decompressed into memory when the file is read.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import object
+
+import os
+import json
+import zlib
+import struct
+import tempfile
+from collections.abc import Mapping
+
+import numpy as np
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+ARRAY_ALIGN = 64
+
+
+def _aligned(n):
+    return -(-n // ARRAY_ALIGN) * ARRAY_ALIGN
+
+
+def _json_default(o):
+    ''' Numpy scalars in the header are written as python values '''
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError('%r is not JSON serializable' % (o,))
+
+
+def write_arrays(filename, magic, header, arrays, compress=False):
+    """ Write arrays to file
+
+    The file is written to a temporary name in the same directory and then
+    renamed, so concurrent runs never see a partial file.
+
+    Args:
+        filename (str): Path to file
+        magic (bytes): Magic string identifying the file type
+        header (dict): Header values, written as JSON
+        arrays (OrderedDict of str: ndarray): Arrays to write, in order
+        compress (bool): Compress arrays with zlib
+    """
+    header = dict(header, arrays={})
+    _data = []
+    _offset = 0
+    for k, a in arrays.items():
+        a = np.ascontiguousarray(a)
+        if compress:
+            _buf = zlib.compress(a.tobytes())
+            header['arrays'][k] = [a.dtype.str, len(a), _offset, len(_buf),
+                                   'zlib']
+        else:
+            _buf = a
+            header['arrays'][k] = [a.dtype.str, len(a), _offset]
+        _data.append(_buf)
+        _offset += _aligned(len(_buf) if compress else a.nbytes)
+    _hdr = json.dumps(header, default=_json_default).encode()
+    _start = _aligned(len(magic) + 8 + len(_hdr))
+
+    outdir = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=outdir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outh:
+            outh.write(magic + struct.pack('<Q', len(_hdr)) + _hdr)
+            for k, _buf in zip(arrays, _data):
+                outh.seek(_start + header['arrays'][k][2])
+                outh.write(_buf if compress else _buf.tobytes())
+            outh.truncate(_start + _offset)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def is_array_file(filename, magic):
+    """ Whether file starts with magic string """
+    with open(filename, 'rb') as fh:
+        return fh.read(len(magic)) == magic
+
+
+def read_arrays(filename, magic):
+    """ Read header and arrays from file
+
+    Returns:
+        (dict, dict of str: ndarray): Header and arrays. Uncompressed arrays
+            are memory-mapped.
+    """
+    with open(filename, 'rb') as fh:
+        if fh.read(len(magic)) != magic:
+            raise ValueError('%s is not a %r file' % (filename, magic))
+        _hlen, = struct.unpack('<Q', fh.read(8))
+        header = json.loads(fh.read(_hlen).decode())
+        _start = _aligned(len(magic) + 8 + _hlen)
+        arrays = {}
+        for k, v in header['arrays'].items():
+            dtype, n, off = v[:3]
+            if n == 0:
+                arrays[k] = np.zeros(0, dtype=dtype)
+            elif len(v) > 3:
+                fh.seek(_start + off)
+                arrays[k] = np.frombuffer(zlib.decompress(fh.read(v[3])),
+                                          dtype=dtype).copy()
+            else:
+                arrays[k] = np.memmap(filename, dtype=dtype, mode='r',
+                                      offset=_start + off, shape=(n,))
+    return header, arrays
+
+
+def encode_names(names):
+    """ Concatenate names into a byte array with offsets
+
+    Returns:
+        (ndarray, ndarray): Bytes of all names (uint8), and offsets (int64);
+            name i is blob[ptr[i]:ptr[i + 1]].
+    """
+    _names = [n.encode() for n in names]
+    blob = np.frombuffer(b''.join(_names), dtype=np.uint8)
+    ptr = np.zeros(len(_names) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, _names), dtype=np.int64,
+                          count=len(_names)), out=ptr[1:])
+    return blob, ptr
+
+
+def decode_names(blob, ptr):
+    """ List of names from `encode_names` arrays """
+    _blob = np.asarray(blob).tobytes()
+    _ptr = np.asarray(ptr).tolist()
+    return [_blob[_ptr[i]:_ptr[i + 1]].decode() for i in range(len(_ptr) - 1)]
+
+
+class NameIndex(Mapping):
+    """ Mapping of name to index, stored as `encode_names` arrays
+
+    Names are only decoded, and the dictionary built, when a name is first
+    looked up, so an index that is only counted or saved again never creates
+    a python string for each name.
+    """
+    def __init__(self, blob, ptr):
+        self.blob = blob
+        self.ptr = ptr
+        self._index = None
+
+    @classmethod
+    def from_names(cls, names):
+        return cls(*encode_names(names))
+
+    def names(self):
+        """ Names in index order """
+        return decode_names(self.blob, self.ptr)
+
+    def _lookup(self):
+        if self._index is None:
+            self._index = {n: i for i, n in enumerate(self.names())}
+        return self._index
+
+    def __getitem__(self, name):
+        return self._lookup()[name]
+
+    def __contains__(self, name):
+        return name in self._lookup()
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __len__(self):
+        return len(self.ptr) - 1
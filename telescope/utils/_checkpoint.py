@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+""" Checkpoint files
+
+A checkpoint holds everything needed to run EM and write the reports again
+without reading the alignments. It is written with
+`_arrayfile.write_arrays`; the header holds the run info and the arrays are:
+
+    feat_blob, feat_ptr     Feature names, see `_arrayfile.encode_names`
+    feat_length     int64   Length of each feature
+    read_blob, read_ptr     Fragment names
+    data            Alignment scores (raw_scores) as a CSR matrix
+    indices
+    indptr
+
+The header entry "min_score" is the minimum alignment score of the run;
+raw scores are alignment scores minus this value, plus one and the aligned
+length, so checkpoints of separate runs can be merged on one scale (see
+`merge_checkpoints`).
+
+Checkpoints saved after EM also hold the EM state: the header entry "em" has
+the EM parameters, log-likelihood, number of iterations and whether EM
+converged, and the arrays em_pi, em_theta, em_pi_init, em_theta_init and
+em_za_data hold the estimates (see `TelescopeLikelihood.em_state`).
+
+Arrays are memory-mapped when the checkpoint is loaded unless it was saved
+with compression, and fragment names are only decoded when a name is looked
+up. Checkpoints written with `numpy.savez` by older versions can be loaded.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import object
+
+from collections import OrderedDict, Counter
+
+import numpy as np
+
+from .sparse_plus import csr_matrix_plus as csr_matrix
+from .sparse_plus import CooBuilder
+from .helpers import str2int
+from ._arrayfile import write_arrays, read_arrays, is_array_file
+from ._arrayfile import encode_names, NameIndex
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+CHECKPOINT_MAGIC = b'TELECKP\x01'
+CHECKPOINT_VERSION = 1
+
+EM_ARRAYS = ('pi', 'theta', 'pi_init', 'theta_init', 'za_data')
+
+
+def _index_names(index):
+    """ Names of a name to index mapping, in index order """
+    if isinstance(index, NameIndex):
+        return index.names()
+    ret = [None] * len(index)
+    for n, i in index.items():
+        ret[i] = n
+    return ret
+
+
+class Checkpoint(object):
+    """ Contents of a checkpoint file
+
+    Args:
+        run_info (OrderedDict): Information about the run
+        feat_index (dict of str: int): Column of each feature
+        feature_length (dict of str: int): Length of each feature
+        read_index (Mapping of str: int): Row of each fragment
+        raw_scores (csr_matrix_plus): Alignment scores
+        em (dict): EM state from `TelescopeLikelihood.em_state`, or None if
+            EM has not been run
+        min_score (int): Minimum alignment score, or None if unknown
+    """
+    def __init__(self, run_info, feat_index, feature_length, read_index,
+                 raw_scores, em=None, min_score=None):
+        self.run_info = run_info
+        self.feat_index = feat_index
+        self.feature_length = feature_length
+        self.read_index = read_index
+        self.raw_scores = raw_scores
+        self.em = em
+        self.min_score = min_score
+
+    def save(self, filename, compress=False):
+        """ Write checkpoint to file
+
+        Args:
+            filename (str): Path to checkpoint file
+            compress (bool): Compress arrays with zlib. Compressed arrays are
+                read into memory instead of being memory-mapped.
+        """
+        _feats = _index_names(self.feat_index)
+        arrays = OrderedDict()
+        arrays['feat_blob'], arrays['feat_ptr'] = encode_names(_feats)
+        arrays['feat_length'] = np.array(
+            [self.feature_length[f] for f in _feats], dtype=np.int64
+        )
+        if isinstance(self.read_index, NameIndex):
+            arrays['read_blob'] = self.read_index.blob
+            arrays['read_ptr'] = self.read_index.ptr
+        else:
+            arrays['read_blob'], arrays['read_ptr'] = \
+                encode_names(_index_names(self.read_index))
+        arrays['data'] = self.raw_scores.data
+        arrays['indices'] = self.raw_scores.indices
+        arrays['indptr'] = self.raw_scores.indptr
+        header = {
+            'version': CHECKPOINT_VERSION,
+            'run_info': list(self.run_info.items()),
+            'shape': list(self.raw_scores.shape),
+        }
+        if self.min_score is not None:
+            header['min_score'] = self.min_score
+        if self.em is not None:
+            header['em'] = {k: v for k, v in self.em.items()
+                            if k not in EM_ARRAYS}
+            for k in EM_ARRAYS:
+                arrays['em_' + k] = self.em[k]
+        write_arrays(filename, CHECKPOINT_MAGIC, header, arrays, compress)
+
+    @classmethod
+    def load(cls, filename):
+        """ Read checkpoint file """
+        if not is_array_file(filename, CHECKPOINT_MAGIC):
+            return cls._load_npz(filename)
+        header, arrays = read_arrays(filename, CHECKPOINT_MAGIC)
+        if header['version'] != CHECKPOINT_VERSION:
+            raise ValueError('Unsupported checkpoint version %s'
+                             % header['version'])
+        _feats = NameIndex(arrays['feat_blob'], arrays['feat_ptr']).names()
+        feature_length = Counter(dict(zip(_feats,
+                                          arrays['feat_length'].tolist())))
+        raw_scores = csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=tuple(header['shape'])
+        )
+        em = None
+        if 'em' in header:
+            em = dict(header['em'])
+            em.update((k, arrays['em_' + k]) for k in EM_ARRAYS)
+        return cls(OrderedDict(header['run_info']),
+                   {n: i for i, n in enumerate(_feats)},
+                   feature_length,
+                   NameIndex(arrays['read_blob'], arrays['read_ptr']),
+                   raw_scores, em, header.get('min_score'))
+
+    @classmethod
+    def _load_npz(cls, filename):
+        """ Read checkpoint written with `numpy.savez` """
+        loader = np.load(filename)
+        run_info = OrderedDict()
+        for r in range(loader['_run_info'].shape[0]):
+            k = loader['_run_info'][r, 0]
+            v = str2int(loader['_run_info'][r, 1])
+            run_info[k] = v
+        feature_length = Counter()
+        for f, fl in zip(loader['_feat_list'], loader['_flen_list']):
+            feature_length[f] = fl
+        read_index = {n: i for i, n in enumerate(loader['_read_list'])}
+        feat_index = {n: i for i, n in enumerate(loader['_feat_list'])}
+        assert tuple(loader['_shape']) == (len(read_index), len(feat_index))
+        raw_scores = csr_matrix((
+            loader['_raw_scores_data'],
+            loader['_raw_scores_indices'],
+            loader['_raw_scores_indptr']),
+            shape=loader['_raw_scores_shape']
+        )
+        return cls(run_info, feat_index, feature_length, read_index,
+                   raw_scores)
+
+
+def merge_checkpoints(ckpts, version=None):
+    """ Merge checkpoints of separately loaded alignment files
+
+    Feature and fragment indexes are the union of the indexes, in the order
+    that names first appear. Scores are shifted to the smallest minimum
+    alignment score of the checkpoints. If fragment names are unique, the
+    score matrices are concatenated one checkpoint at a time, so that
+    memory-mapped scores are read once. A fragment found in more than one
+    checkpoint has one row with the best score for each feature, as when
+    alignments are loaded, but is still counted by each run.
+
+    Counters in run_info are summed, except that "overlap_unique" and
+    "overlap_ambig" are recalculated from the merged scores and
+    "annotated_features" is the largest value.
+
+    Args:
+        ckpts (list of Checkpoint): Checkpoints to merge
+        version (str): Version of merged run. Default is version of the first
+            checkpoint.
+
+    Returns:
+        Checkpoint: Merged checkpoint, without EM state
+    """
+    ''' Union of feature indexes '''
+    _featlists = [_index_names(c.feat_index) for c in ckpts]
+    _nfkeys = {f[0] for f in _featlists}
+    if len(_nfkeys) > 1:
+        raise ValueError('Checkpoints have different no-feature keys: %s'
+                         % ', '.join(sorted(_nfkeys)))
+    feat_index = {}
+    feature_length = Counter()
+    colmaps = []
+    for c, _feats in zip(ckpts, _featlists):
+        colmaps.append(np.array(
+            [feat_index.setdefault(f, len(feat_index)) for f in _feats],
+            dtype=np.intc
+        ))
+        for f in _feats:
+            if f not in feature_length and f in c.feature_length:
+                feature_length[f] = c.feature_length[f]
+
+    ''' Union of fragment indexes '''
+    read_index = {}
+    rowmaps = []
+    for c in ckpts:
+        rowmaps.append(np.fromiter(
+            (read_index.setdefault(n, len(read_index))
+             for n in _index_names(c.read_index)),
+            dtype=np.intc, count=len(c.read_index)
+        ))
+    shape = (len(read_index), len(feat_index))
+
+    ''' Shift scores to a common minimum alignment score '''
+    _mins = [c.min_score for c in ckpts]
+    if None in _mins:
+        min_score, offsets = None, [0] * len(ckpts)
+    else:
+        min_score = min(_mins)
+        offsets = [m - min_score for m in _mins]
+    _maxscore = max([int(c.raw_scores.data.max()) + o
+                     for c, o in zip(ckpts, offsets) if c.raw_scores.nnz],
+                    default=0)
+    dtype = np.promote_types(
+        np.result_type(*[c.raw_scores.dtype for c in ckpts]),
+        np.min_scalar_type(_maxscore)
+    )
+
+    if shape[0] == sum(len(c.read_index) for c in ckpts):
+        ''' Fragment names are unique, concatenate rows '''
+        _nnz = sum(c.raw_scores.nnz for c in ckpts)
+        _itype = np.intc if _nnz <= np.iinfo(np.intc).max else np.int64
+        data = np.empty(_nnz, dtype=dtype)
+        indices = np.empty(_nnz, dtype=_itype)
+        indptr = np.zeros(shape[0] + 1, dtype=_itype)
+        _pos, _row = 0, 0
+        for c, cmap, off in zip(ckpts, colmaps, offsets):
+            m = c.raw_scores
+            np.add(m.data, off, out=data[_pos:_pos + m.nnz], dtype=dtype)
+            indices[_pos:_pos + m.nnz] = cmap[m.indices]
+            indptr[_row + 1:_row + m.shape[0] + 1] = m.indptr[1:] + _pos
+            _pos += m.nnz
+            _row += m.shape[0]
+        raw_scores = csr_matrix((data, indices, indptr), shape=shape)
+        raw_scores.sort_indices()
+    else:
+        ''' Combine rows of fragments found in more than one checkpoint '''
+        _m = CooBuilder(dtype=dtype)
+        for c, rmap, cmap, off in zip(ckpts, rowmaps, colmaps, offsets):
+            m = c.raw_scores
+            _m.extend(np.repeat(rmap, np.diff(m.indptr)), cmap[m.indices],
+                      np.add(m.data, off, dtype=dtype))
+        raw_scores = _m.tocsr(shape=shape)
+
+    ''' Combine run information '''
+    run_info = OrderedDict()
+    for c in ckpts:
+        for k, v in c.run_info.items():
+            if k not in run_info:
+                run_info[k] = v
+            elif k == 'annotated_features':
+                run_info[k] = max(run_info[k], v)
+            elif isinstance(v, (int, np.integer)) and \
+                    isinstance(run_info[k], (int, np.integer)):
+                run_info[k] += v
+    if version is not None:
+        run_info['version'] = version
+    _unique = int(np.count_nonzero(np.diff(raw_scores.indptr) == 1))
+    run_info['overlap_unique'] = _unique
+    run_info['overlap_ambig'] = shape[0] - _unique
+
+    return Checkpoint(run_info, feat_index, feature_length, read_index,
+                      raw_scores, min_score=min_score)
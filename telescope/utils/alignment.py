@@ -7,12 +7,18 @@ from __future__ import (absolute_import, division,
 from builtins import *
 
 import os
+import struct
+import tempfile
+import zlib
+from array import array
 from collections import Counter
+from itertools import islice
 import logging as lg
 
+import numpy as np
 import pysam
 
-from telescope.utils.calignment import AlignedPair
+from telescope.utils.calignment import AlignedPair, FragmentBundler
 # from ._alignment import AlignedPair
 from . import model
 from . import BIG_INT
@@ -112,10 +118,41 @@ def mate_in_region(aln, regtup):
 
 
 """ Sequential read"""
-def fetch_bundle(samfile, **kwargs):
-    """ Iterate over alignment over reads with same ID """
-    samiter = samfile.fetch(**kwargs)
-    bundle = [ next(samiter) ]
+def fetch_range(samfile, start, end=None):
+    """ Iterate over alignments between two virtual offsets
+
+    Args:
+        samfile (:obj:`pysam.AlignmentFile`): BAM file
+        start (int): Virtual offset of first alignment
+        end (int): Virtual offset where iteration stops. If None, iterate until
+            end of file.
+
+    Yields:
+        :obj:`pysam.AlignedSegment`: Alignments starting before `end`
+    """
+    samfile.seek(start)
+    while end is None or samfile.tell() < end:
+        try:
+            aln = next(samfile)
+        except StopIteration:
+            return
+        yield aln
+
+
+def fetch_bundle(samfile, vrange=None, **kwargs):
+    """ Iterate over alignment over reads with same ID
+
+    If `vrange` is provided, only alignments between the two virtual offsets
+    are included (see `fetch_range`), otherwise kwargs are passed to fetch.
+    """
+    if vrange is None:
+        samiter = samfile.fetch(**kwargs)
+    else:
+        samiter = fetch_range(samfile, *vrange)
+    try:
+        bundle = [ next(samiter) ]
+    except StopIteration:
+        return
     for aln in samiter:
         if aln.query_name == bundle[0].query_name:
             bundle.append(aln)
@@ -145,25 +182,190 @@ def pair_bundle(alniter):
         yield AlignedPair(aln)
 
 
-def fetch_fragments_seq(samfile, **kwargs):
-    b_iter = fetch_bundle(samfile, **kwargs)
-    for alns in b_iter:
-        if not alns[0].is_paired:
-            _code = CODE_INT['SU'] if alns[0].is_unmapped else CODE_INT['SM']
-            yield (_code, [AlignedPair(a) for a in alns])
-        else:
-            if alns[0].is_proper_pair:
-                yield (CODE_INT['PM'], list(pair_bundle(alns)))
-            else:
-                if len(alns) == 2 and all(a.is_unmapped for a in alns):
-                    yield (CODE_INT['PU'], [AlignedPair(alns[0], alns[1]), ])
-                else:
-                    yield (CODE_INT['PX'], [AlignedPair(a) for a in alns])
+def fetch_fragments_seq(samfile, vrange=None, **kwargs):
+    """ Iterate over fragments in a collated alignment file
+
+    Alignments are bundled by query name and paired by the compiled
+    `FragmentBundler`, see `fetch_bundle` and `pair_bundle`.
+
+    Yields:
+        tuple: Fragment code and list of :obj:`AlignedPair`
+    """
+    if vrange is None:
+        samiter = samfile.fetch(**kwargs)
+    else:
+        samiter = fetch_range(samfile, *vrange)
+    return FragmentBundler(samiter)
+
+""" Split collated BAM """
+
+# BGZF block header up to BSIZE, see SAM specification section 4.1
+_BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+_BGZF_EXTRA = b'\x06\x00BC\x02\x00'
+_BGZF_HEADER_SIZE = 18
+# Fixed-length fields of a BAM record, starting with block_size
+_BAM_FIXED = struct.Struct('<iiiBBHHHiiii')
+
+
+def bgzf_next_block(fh, pos, filesize):
+    """ Find the start of the first BGZF block at or after a file position
+
+    A candidate block is accepted if it is followed by another block or by the
+    end of the file.
+
+    Args:
+        fh: BAM file opened in binary mode
+        pos (int): File position where search starts
+        filesize (int): Size of the file
+
+    Returns:
+        int: File offset of the block, or None if there is no block
+    """
+    chunksize = 1 << 17
+    while pos < filesize:
+        fh.seek(pos)
+        buf = fh.read(chunksize + _BGZF_HEADER_SIZE)
+        i = buf.find(_BGZF_MAGIC)
+        while i != -1 and i < chunksize:
+            if buf[i + 10:i + 16] == _BGZF_EXTRA:
+                fh.seek(pos + i + 16)
+                _bsize = struct.unpack('<H', fh.read(2))[0] + 1
+                _next = pos + i + _bsize
+                fh.seek(_next)
+                if _next == filesize or fh.read(4) == _BGZF_MAGIC:
+                    return pos + i
+            i = buf.find(_BGZF_MAGIC, i + 1)
+        pos += chunksize
+    return None
+
+
+def _bgzf_read_block(fh, coffset):
+    """ Decompress the BGZF block at a file offset
+
+    Returns:
+        (bytes, int): Uncompressed data and the offset of the next block
+    """
+    fh.seek(coffset)
+    header = fh.read(_BGZF_HEADER_SIZE)
+    if len(header) < _BGZF_HEADER_SIZE:
+        return b'', coffset
+    _bsize = struct.unpack('<H', header[16:18])[0] + 1
+    cdata = fh.read(_bsize - _BGZF_HEADER_SIZE)
+    # Compressed data is followed by CRC32 and ISIZE
+    return zlib.decompress(cdata[:-8], -15), coffset + _bsize
+
+
+def _is_bam_record(buf, u, nref, nchain=3):
+    """ Check whether a BAM record plausibly starts at position u of buf
+
+    The fixed-length fields and read name are checked for consistency, and the
+    check is repeated for up to `nchain` following records in buf.
+    """
+    for _ in range(nchain + 1):
+        if u + _BAM_FIXED.size > len(buf):
+            # Remaining data is too short to check
+            return True
+        (bsize, refid, pos, l_name, _mapq, _bin, n_cigar, _flag, l_seq,
+         next_refid, next_pos, _tlen) = _BAM_FIXED.unpack_from(buf, u)
+        if not (-1 <= refid < nref and -1 <= next_refid < nref):
+            return False
+        if pos < -1 or next_pos < -1 or l_name < 2 or l_seq < 0:
+            return False
+        if bsize < 32 + l_name + 4 * n_cigar + (l_seq + 1) // 2 + l_seq:
+            return False
+        _name = buf[u + 36:u + 36 + l_name]
+        if len(_name) == l_name:
+            if _name[-1] != 0:
+                return False
+            if not all(33 <= c <= 126 and c != 64 for c in _name[:-1]):
+                return False
+        u += 4 + bsize
+    return True
+
+
+def bam_record_after(fh, coffset, nref):
+    """ Find the first BAM record that starts in or after a BGZF block
+
+    Args:
+        fh: BAM file opened in binary mode
+        coffset (int): File offset of a BGZF block
+        nref (int): Number of reference sequences in the header
+
+    Returns:
+        int: Virtual offset of the record, or None if no record is found
+    """
+    while True:
+        block, _next = _bgzf_read_block(fh, coffset)
+        if not block:
+            return None
+        # Include the following blocks to check records that span blocks
+        buf, _bnext = block, _next
+        for _ in range(2):
+            _bdata, _bnext = _bgzf_read_block(fh, _bnext)
+            buf += _bdata
+        for u in range(len(block)):
+            if _is_bam_record(buf, u, nref):
+                return (coffset << 16) | u
+        coffset = _next
+
+
+def collated_splits(samfile, nsplits):
+    """ Divide a collated BAM file into ranges of virtual offsets
+
+    The file is divided into `nsplits` byte ranges of about the same size. Each
+    split point is moved to the next BGZF block, then to the first record in
+    the block, and finally to the first record with a different query name, so
+    that all alignments for a fragment are in the same range.
+
+    Args:
+        samfile (str): Path to BAM file, collated by query name
+        nsplits (int): Number of byte ranges
+
+    Returns:
+        list: (start, end) virtual offsets for each range. The last range has
+            end = None and continues to the end of the file.
+    """
+    filesize = os.path.getsize(samfile)
+    with pysam.AlignmentFile(samfile, check_sq=False) as sf, \
+            open(samfile, 'rb') as fh:
+        bounds = [sf.tell()]
+        nref = sf.nreferences
+        for k in range(1, nsplits):
+            _coffset = bgzf_next_block(fh, filesize * k // nsplits, filesize)
+            if _coffset is None or _coffset <= (bounds[-1] >> 16):
+                continue
+            _voffset = bam_record_after(fh, _coffset, nref)
+            if _voffset is None:
+                continue
+
+            ''' Move to the first record with a different query name '''
+            sf.seek(_voffset)
+            try:
+                _qname = next(sf).query_name
+                while True:
+                    _voffset = sf.tell()
+                    if next(sf).query_name != _qname:
+                        break
+            except StopIteration:
+                continue
+            if _voffset > bounds[-1]:
+                bounds.append(_voffset)
+    return list(zip(bounds, bounds[1:] + [None]))
+
 
 """ Parallel Read """
 
-def fetch_pairs_sorted(alniter, regtup=None):
-    readcache = {}
+def fetch_pairs_sorted(alniter, readcache=None):
+    """ Pair alignments from a coordinate-sorted BAM file
+
+    Proper pairs are yielded when the second mate is found. If `readcache` is
+    provided, alignments whose mate was not found are left in it so that they
+    can be paired with alignments from other regions. Otherwise they are
+    yielded unpaired, as in `pair_bundle`.
+    """
+    _yield_cached = readcache is None
+    if readcache is None:
+        readcache = {}
     for aln in alniter:
         if not aln.is_paired:
             _code = CODE_INT['SU'] if aln.is_unmapped else CODE_INT['SM']
@@ -183,38 +385,265 @@ def fetch_pairs_sorted(alniter, regtup=None):
                 _code = CODE_INT['PX*'] if aln.is_unmapped else CODE_INT['PX']
                 yield (_code, AlignedPair(aln))
 
-    for aln in readcache.values():
-        #TODO: deal with these somehow
-        yield ('cached', AlignedPair(aln))
+    if _yield_cached:
+        for aln in readcache.values():
+            yield (CODE_INT['PM'], AlignedPair(aln))
 
-def fetch_region(samfile, annotation, opts, region):
-    lg.info('processing {}:{}-{}'.format(*region))
 
-    _nfkey = opts['no_feature_key']
-    _omode, _othresh = opts['overlap_mode'], opts['overlap_threshold']
-    _tempdir = opts['tempdir']
+def sorted_work_units(samfile, nunits):
+    """ Divide an indexed BAM file into work units with similar read counts
 
-    assign = model.Assigner(annotation, _nfkey, _omode, _othresh).assign_func()
+    Read counts for each contig are taken from the index. Contigs with more
+    reads than the target size are divided into equal windows, assuming reads
+    are evenly distributed along the contig, and smaller contigs are batched
+    together. Unmapped reads without coordinates are a separate unit with
+    region ("*", 0, 0).
 
-    _minAS, _maxAS = BIG_INT, -BIG_INT
-    _unaligned = 0
-
-    mfile = os.path.join(_tempdir, 'tmp_map.{}.{}.{}.txt'.format(*region))
+    Args:
+        samfile (str): Path to coordinate-sorted, indexed BAM file
+        nunits (int): Approximate number of work units
 
-    fh = open(mfile, 'w')
+    Returns:
+        list: Work units, largest first. Each unit is a list of regions
+            (chrom, start, end).
+    """
     with pysam.AlignmentFile(samfile) as sf:
-        samiter = sf.fetch(*region, multiple_iterators=True)
-        regtup = (sf.get_tid(region[0]), region[1], region[2])
-        for ci, aln in fetch_pairs_sorted(samiter, regtup):
+        _stats = sf.get_index_statistics()
+        _lengths = dict(zip(sf.references, sf.lengths))
+        _nocoord = sf.nocoordinate
+
+    _total = sum(s.total for s in _stats) + _nocoord
+    target = max(1, -(-_total // max(1, nunits)))
+    units = []
+    batch, batch_reads = [], 0
+    for s in _stats:
+        if s.total == 0:
+            continue
+        _len = _lengths[s.contig]
+        if s.total >= target:
+            nwin = -(-s.total // target)
+            winsize = -(-_len // nwin)
+            for start in range(0, _len, winsize):
+                _region = (s.contig, start, min(start + winsize, _len))
+                units.append((s.total / nwin, [_region]))
+        else:
+            batch.append((s.contig, 0, _len))
+            batch_reads += s.total
+            if batch_reads >= target:
+                units.append((batch_reads, batch))
+                batch, batch_reads = [], 0
+    if batch:
+        units.append((batch_reads, batch))
+    if _nocoord:
+        units.append((_nocoord, [('*', 0, 0)]))
+
+    units.sort(key=lambda u: u[0], reverse=True)
+    return [u[1] for u in units]
+
+
+class MappingChunk(object):
+    """ Columnar binary file for mappings from one work unit
+
+    Each mapping has a fragment code, read id, feature id, alignment score and
+    alignment length. Read and feature names are interned, so ids refer to
+    the order in which names first appear. Columns and names are saved as
+    separate .npy files with a common prefix, which can be memory-mapped by
+    `load_mapping_chunks`.
+    """
+    FIELDS = [
+        ('codes', 'B', np.uint8),
+        ('reads', 'i', np.intc),
+        ('feats', 'i', np.intc),
+        ('scores', 'i', np.intc),
+        ('lengths', 'i', np.intc),
+    ]
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._cols = {f: array(t) for f, t, _ in self.FIELDS}
+        self._reads = {}
+        self._feats = {}
+
+    def __len__(self):
+        return len(self._cols['codes'])
+
+    def append(self, code, rid, fid, score, alen):
+        self._cols['codes'].append(code)
+        self._cols['reads'].append(self._reads.setdefault(rid, len(self._reads)))
+        self._cols['feats'].append(self._feats.setdefault(fid, len(self._feats)))
+        self._cols['scores'].append(score)
+        self._cols['lengths'].append(alen)
+
+    def save(self):
+        """ Write columns and names, returns the file prefix """
+        for f, _, dtype in self.FIELDS:
+            np.save('{}.{}.npy'.format(self.prefix, f),
+                    np.frombuffer(self._cols[f], dtype=dtype))
+        for f, names in [('read_names', self._reads),
+                         ('feat_names', self._feats)]:
+            _enc = np.array([n.encode('utf-8') for n in names], dtype=bytes)
+            np.save('{}.{}.npy'.format(self.prefix, f), _enc)
+        return self.prefix
+
+
+def load_mapping_chunks(prefixes):
+    """ Load and concatenate mapping chunks
+
+    Read ids from all chunks are replaced by global ids, in order of first
+    appearance, without processing individual mappings in Python.
+
+    Args:
+        prefixes (list): File prefixes of chunks saved by `MappingChunk`
+
+    Returns:
+        (dict, list, list): Concatenated columns, with "reads" and "feats"
+            replaced by global ids, read names and feature names
+    """
+    cols = {f: [] for f, _, _ in MappingChunk.FIELDS}
+    _rnames, _roffset = [], 0
+    _fidx = {}
+    for p in prefixes:
+        _load = lambda f: np.load('{}.{}.npy'.format(p, f), mmap_mode='r')
+        _chunk_rnames = _load('read_names')
+        _fmap = np.array([_fidx.setdefault(n.decode('utf-8'), len(_fidx))
+                          for n in _load('feat_names')], dtype=np.intc)
+        cols['codes'].append(_load('codes'))
+        cols['reads'].append(_load('reads') + _roffset)
+        cols['feats'].append(_fmap[_load('feats')])
+        cols['scores'].append(_load('scores'))
+        cols['lengths'].append(_load('lengths'))
+        _rnames.append(_chunk_rnames)
+        _roffset += len(_chunk_rnames)
+
+    cols = {f: np.concatenate(cols[f]) if cols[f] else np.zeros(0, dtype)
+            for f, _, dtype in MappingChunk.FIELDS}
+
+    ''' Global read ids in order of first appearance '''
+    if _rnames:
+        _allnames = np.concatenate(_rnames)
+    else:
+        _allnames = np.zeros(0, dtype=bytes)
+    _uniq, _first, _inv = np.unique(_allnames, return_index=True,
+                                    return_inverse=True)
+    _order = np.argsort(_first)
+    _rank = np.empty(len(_uniq), dtype=np.intc)
+    _rank[_order] = np.arange(len(_uniq), dtype=np.intc)
+    cols['reads'] = _rank[_inv][cols['reads']]
+    read_names = [n.decode('utf-8') for n in _uniq[_order]]
+    feat_names = sorted(_fidx, key=_fidx.get)
+    return cols, read_names, feat_names
+
+
+def _write_region_mappings(pairiter, assigner, chunk, chunksize=10000):
+    """ Add mapping for each aligned pair to chunk
+
+    Aligned pairs are assigned `chunksize` at a time with
+    `Assigner.assign_batch`.
+
+    Returns:
+        (tuple, int): Minimum and maximum alignment scores, and number of
+            unaligned reads with aligned mates
+    """
+    _minAS, _maxAS = BIG_INT, -BIG_INT
+    _unaligned = 0
+    pairiter = iter(pairiter)
+    while True:
+        _pairs = list(islice(pairiter, chunksize))
+        if not _pairs:
+            break
+        _mapped = []
+        for ci, aln in _pairs:
             if aln.is_unmapped:
                 assert CODES[ci][0] == 'PX*'
                 _unaligned += 1
+            else:
+                _mapped.append((ci, aln))
+
+        _feats = assigner.assign_batch([aln for _, aln in _mapped])
+        for (ci, aln), feat in zip(_mapped, _feats):
+            _score = aln.alnscore
+            _minAS = min(_minAS, _score)
+            _maxAS = max(_maxAS, _score)
+            chunk.append(ci, aln.query_id, feat, _score, aln.alnlen)
+    return (_minAS, _maxAS), _unaligned
+
+
+def fetch_region(samfile, annotation, opts, regions):
+    """ Find mappings for alignments that start in a set of regions
+
+    Alignments are assigned to the region containing their start position, so
+    each alignment is processed once even if it spans regions. Mates that are
+    not found in the regions are returned so that they can be paired by
+    `resolve_mates`.
+
+    Args:
+        samfile (str): Path to coordinate-sorted, indexed BAM file
+        annotation: Annotation object
+        opts: Options for Assigner, with tempdir
+        regions (list): Regions (chrom, start, end)
+
+    Returns:
+        (str, tuple, int, int, list): Prefix of mapping chunk, minimum and maximum
+            alignment scores, number of unaligned reads with aligned mates,
+            number of unmapped fragments without coordinates, and alignments
+            without mates as SAM strings
+    """
+    lg.debug('processing {:d} regions from {}:{}-{}'.format(
+        len(regions), *regions[0]))
+    assigner = model.Assigner(annotation, opts.no_feature_key,
+                              opts.overlap_mode, opts.overlap_threshold, opts)
+
+    _minAS, _maxAS = BIG_INT, -BIG_INT
+    _unaligned = _unmapped = 0
+    readcache = {}
+
+    chunk = MappingChunk(os.path.join(
+        tempfile.mkdtemp(prefix='tmp_map.', dir=opts.tempdir), 'map'))
+    with pysam.AlignmentFile(samfile, threads=opts.io_threads) as sf:
+        for chrom, start, end in regions:
+            if chrom == '*':
+                for aln in sf.fetch('*'):
+                    if not aln.is_paired:
+                        _unmapped += 1
+                    elif aln.mate_is_unmapped:
+                        _unmapped += aln.is_read1
+                    else:
+                        _unaligned += 1
                 continue
+            samiter = (a for a in sf.fetch(chrom, start, end)
+                       if a.reference_start >= start)
+            pairiter = fetch_pairs_sorted(samiter, readcache)
+            scorerange, _pxu = _write_region_mappings(pairiter, assigner, chunk)
+            _minAS = min(_minAS, scorerange[0])
+            _maxAS = max(_maxAS, scorerange[1])
+            _unaligned += _pxu
+        carried = [a.to_string() for a in readcache.values()]
+
+    return chunk.save(), (_minAS, _maxAS), _unaligned, _unmapped, carried
 
-            m = (ci, aln.query_id, assign(aln), aln.alnscore, aln.alnlen)
-            _minAS = min(_minAS, m[3])
-            _maxAS = max(_maxAS, m[3])
-            print('\t'.join(map(str, m)), file=fh)
 
-    fh.close()
-    return mfile, (_minAS, _maxAS), _unaligned
+def resolve_mates(samfile, annotation, opts, carried):
+    """ Pair alignments whose mates were in other work units
+
+    Args:
+        samfile (str): Path to BAM file, used for the header
+        annotation: Annotation object
+        opts: Options for Assigner, with tempdir
+        carried (list): Alignments without mates as SAM strings, from
+            `fetch_region`
+
+    Returns:
+        (str, tuple, int): Prefix of mapping chunk, minimum and maximum
+            alignment scores, and number of unaligned reads with aligned mates
+    """
+    assigner = model.Assigner(annotation, opts.no_feature_key,
+                              opts.overlap_mode, opts.overlap_threshold, opts)
+    chunk = MappingChunk(os.path.join(
+        tempfile.mkdtemp(prefix='tmp_map.', dir=opts.tempdir), 'map'))
+    with pysam.AlignmentFile(samfile, threads=opts.io_threads) as sf:
+        alniter = (pysam.AlignedSegment.fromstring(s, sf.header)
+                   for s in carried)
+        pairiter = fetch_pairs_sorted(alniter)
+        scorerange, _unaligned = _write_region_mappings(pairiter, assigner,
+                                                        chunk)
+    return chunk.save(), scorerange, _unaligned
@@ -2,6 +2,11 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
+import os
+import logging as lg
+
+from ._annotation_index import index_key, default_cache_dir
+
 __author__ = 'Matthew L. Bendall'
 __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
 
@@ -22,5 +27,53 @@ def get_annotation_class(annotation_class_name):
     elif annotation_class_name == 'intervaltree':
         from ._annotation_intervaltree import _AnnotationIntervalTree
         return _AnnotationIntervalTree
+    elif annotation_class_name == 'numpy':
+        from ._annotation_numpy import _AnnotationNumpy
+        return _AnnotationNumpy
     else:
-        raise NotImplementedError('Choices are "htseq" or "intervaltree".')
+        raise NotImplementedError('Choices are "htseq", "intervaltree", or "numpy".')
+
+
+def load_annotation(annotation_class_name, gtf_file, attribute_name,
+                    stranded_mode, feature_type='exon', cache_dir=None):
+    """ Load annotation, using a compiled index if available
+
+    The index is identified by the content of the GTF file, the attribute,
+    the feature type and the stranded mode. If an index with the same key
+    exists in `cache_dir` it is loaded instead of parsing the GTF file,
+    otherwise the GTF file is parsed and a new index is written.
+
+    Args:
+        annotation_class_name (str): Name of annotation class.
+        gtf_file (str): Path to GTF file
+        attribute_name (str): GTF attribute that defines a locus
+        stranded_mode (str): Stranded mode
+        feature_type (str): GTF feature type to include
+        cache_dir (str): Directory for compiled indexes. If None, indexes are
+            not used.
+
+    Returns:
+        Annotation object
+    """
+    Annotation = get_annotation_class(annotation_class_name)
+    if cache_dir is None:
+        return Annotation(gtf_file, attribute_name, stranded_mode, feature_type)
+
+    key = index_key(gtf_file, attribute_name, feature_type, stranded_mode)
+    index_file = os.path.join(cache_dir, '%s.tidx' % key)
+    if os.path.exists(index_file):
+        try:
+            annot = Annotation.load(index_file)
+            lg.info('Loaded annotation index {}'.format(index_file))
+            return annot
+        except (ValueError, OSError) as e:
+            lg.warning('Could not load annotation index {}: {}'.format(index_file, e))
+
+    annot = Annotation(gtf_file, attribute_name, stranded_mode, feature_type)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        annot.save(index_file)
+        lg.info('Wrote annotation index {}'.format(index_file))
+    except OSError as e:
+        lg.warning('Could not write annotation index {}: {}'.format(index_file, e))
+    return annot
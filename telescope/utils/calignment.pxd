@@ -7,4 +7,11 @@ cdef class AlignedPair:
     cdef public AlignedSegment r1
     cdef public AlignedSegment r2
 
+    # Cached values, computed on first access
+    cdef list _refblocks
+    cdef int _alnlen
+    cdef int _alnscore
+    cdef bint _has_score
+
+    cdef _set_refblocks(self)
     cpdef int write(self, AlignmentFile outfile)
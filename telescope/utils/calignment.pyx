@@ -3,20 +3,115 @@ from calignment cimport AlignedPair
 
 # from pysam.libcalignedsegment cimport AlignedSegment
 # from pysam.libcalignedsegment cimport AlignmentFile
-
-
-from telescope.utils.helpers import merge_blocks
+from libc.stdint cimport uint8_t, int8_t, int16_t, uint16_t, int32_t, uint32_t, int64_t
+from libc.stdlib cimport malloc, free
+from libc.string cimport strcmp
+from pysam.libchtslib cimport bam1_t, bam_get_qname, bam_get_cigar, bam_cigar_op, bam_cigar_oplen
+from pysam.libchtslib cimport bam_get_aux, bam_get_l_aux
+from pysam.libchtslib cimport BAM_CMATCH, BAM_CEQUAL, BAM_CDIFF
+from pysam.libchtslib cimport BAM_CDEL, BAM_CREF_SKIP
 
 
 __author__ = 'Matthew L. Bendall'
 __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
 
 
+cdef int _aligned_blocks(bam1_t *b, int64_t *out):
+    """ Reference blocks of aligned bases, same as AlignedSegment.get_blocks
+
+    Writes start and end of each block to out, which must have room for
+    2 * n_cigar values.
+
+    Returns:
+        int: Number of blocks
+    """
+    cdef uint32_t *cigar = bam_get_cigar(b)
+    cdef int64_t pos = b.core.pos
+    cdef int64_t oplen
+    cdef uint32_t k
+    cdef int op, n = 0
+    for k in range(b.core.n_cigar):
+        op = bam_cigar_op(cigar[k])
+        oplen = bam_cigar_oplen(cigar[k])
+        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
+            out[2 * n] = pos
+            out[2 * n + 1] = pos + oplen
+            n += 1
+            pos += oplen
+        elif op == BAM_CDEL or op == BAM_CREF_SKIP:
+            pos += oplen
+    return n
+
+
+cdef inline int64_t _le_int(const uint8_t *p, int size, bint signed):
+    """ Little-endian integer of 1, 2 or 4 bytes """
+    cdef uint32_t v = 0
+    cdef int k
+    for k in range(size):
+        v |= (<uint32_t> p[k]) << (8 * k)
+    if not signed:
+        return v
+    if size == 1:
+        return <int8_t> v
+    if size == 2:
+        return <int16_t> v
+    return <int32_t> v
+
+
+cdef int _aux_size(char t):
+    """ Size of aux value of type t, 0 for strings and arrays """
+    if t == b'A' or t == b'c' or t == b'C':
+        return 1
+    if t == b's' or t == b'S':
+        return 2
+    if t == b'i' or t == b'I' or t == b'f':
+        return 4
+    if t == b'd':
+        return 8
+    return 0
+
+
+cdef int _aux_score(AlignedSegment r) except? -2147483648:
+    """ Value of AS tag, read from the aux data of the BAM record """
+    cdef bam1_t *b = r._delegate
+    cdef const uint8_t *p = bam_get_aux(b)
+    cdef const uint8_t *end = p + bam_get_l_aux(b)
+    cdef char t
+    cdef int size
+    cdef uint32_t count
+    while p + 3 <= end:
+        t = p[2]
+        if p[0] == b'A' and p[1] == b'S':
+            if t == b'c' or t == b's' or t == b'i':
+                return _le_int(p + 3, _aux_size(t), True)
+            if t == b'C' or t == b'S' or t == b'I':
+                return _le_int(p + 3, _aux_size(t), False)
+            return int(r.get_tag('AS'))
+        p += 3
+        if t == b'Z' or t == b'H':
+            while p < end and p[0] != 0:
+                p += 1
+            p += 1
+        elif t == b'B':
+            if p + 5 > end:
+                break
+            count = <uint32_t> _le_int(p + 1, 4, False)
+            p += 5 + count * _aux_size(p[0])
+        else:
+            size = _aux_size(t)
+            if size == 0:
+                break
+            p += size
+    raise KeyError("tag 'AS' not present")
+
+
 cdef class AlignedPair:
 
     def __cinit__(self, AlignedSegment r1, AlignedSegment r2 = None):
         self.r1 = r1
         self.r2 = r2
+        self._refblocks = None
+        self._has_score = False
 
     def __dealloc__(self):
         del self.r1
@@ -79,20 +174,180 @@ cdef class AlignedPair:
     def query_id(self):
         return self.r1.query_name
 
+    cdef _set_refblocks(self):
+        """ Merge blocks of both reads, same as merge_blocks(blocks, 1) """
+        cdef bam1_t *b1 = self.r1._delegate
+        cdef bam1_t *b2 = self.r2._delegate if self.r2 is not None else NULL
+        cdef uint32_t nc1 = b1.core.n_cigar
+        cdef uint32_t nc2 = b2.core.n_cigar if b2 != NULL else 0
+        cdef int64_t *blk = <int64_t *> malloc(2 * (nc1 + nc2 + 1) * sizeof(int64_t))
+        cdef int n1, n2 = 0, i = 0, j = 0, k
+        cdef int64_t s, e, cs = 0, ce = 0
+        cdef bint started = False
+        if blk == NULL:
+            raise MemoryError()
+        try:
+            n1 = _aligned_blocks(b1, blk)
+            if b2 != NULL:
+                n2 = _aligned_blocks(b2, blk + 2 * n1)
+            self._refblocks = []
+            self._alnlen = 0
+            ''' Blocks of each read are sorted, take the smaller start '''
+            while i < n1 or j < n2:
+                if j >= n2 or (i < n1 and blk[2 * i] <= blk[2 * (n1 + j)]):
+                    k = i
+                    i += 1
+                else:
+                    k = n1 + j
+                    j += 1
+                s, e = blk[2 * k], blk[2 * k + 1]
+                if not started:
+                    cs, ce, started = s, e, True
+                elif s - ce > 1:
+                    self._refblocks.append((cs, ce))
+                    self._alnlen += ce - cs
+                    cs, ce = s, e
+                elif e > ce:
+                    ce = e
+            if started:
+                self._refblocks.append((cs, ce))
+                self._alnlen += ce - cs
+        finally:
+            free(blk)
+
     @property
     def refblocks(self):
-        if self.r2 is None:
-            return merge_blocks(self.r1.get_blocks(), 1)
-        else:
-            blocks = self.r1.get_blocks() + self.r2.get_blocks()
-            return merge_blocks(blocks, 1)
+        """ Merged reference blocks of both reads. Computed once, the
+            returned list should not be modified.
+        """
+        if self._refblocks is None:
+            self._set_refblocks()
+        return self._refblocks
+
     @property
     def alnlen(self):
-        return sum(b[1]-b[0] for b in self.refblocks)
+        if self._refblocks is None:
+            self._set_refblocks()
+        return self._alnlen
 
     @property
     def alnscore(self):
-        if self.r2 is None:
-            return self.r1.get_tag('AS')
+        if not self._has_score:
+            if self.r2 is None:
+                self._alnscore = _aux_score(self.r1)
+            else:
+                self._alnscore = _aux_score(self.r1) + _aux_score(self.r2)
+            self._has_score = True
+        return self._alnscore
+
+
+# Fragment codes, same order as alignment.CODES
+cdef enum:
+    CODE_SU = 0
+    CODE_SM = 1
+    CODE_PU = 2
+    CODE_PM = 3
+    CODE_PX = 4
+
+# BAM flags
+cdef enum:
+    FLAG_PAIRED = 0x1
+    FLAG_PROPER_PAIR = 0x2
+    FLAG_UNMAP = 0x4
+    FLAG_READ1 = 0x40
+
+
+cdef object _pair_key(bam1_t *b, bint mate):
+    """ Integer key for pairing alignments with the same query name
+
+    The key of an alignment (mate=False) is equal to the key of its mate
+    computed with mate=True. Fields are the same as alignment.readkey and
+    alignment.matekey, without the query name.
+    """
+    cdef bint r1 = (b.core.flag & FLAG_READ1) != 0
+    cdef int64_t isize = b.core.isize if b.core.isize >= 0 else -b.core.isize
+    if mate:
+        r1 = not r1
+        return ((((<object> r1 << 32 | (b.core.mtid + 1)) << 32 | (b.core.tid + 1))
+                 << 64 | (b.core.mpos + 1)) << 64 | (b.core.pos + 1)) << 64 | isize
+    return ((((<object> r1 << 32 | (b.core.tid + 1)) << 32 | (b.core.mtid + 1))
+             << 64 | (b.core.pos + 1)) << 64 | (b.core.mpos + 1)) << 64 | isize
+
+
+cdef class FragmentBundler:
+    """ Iterate over fragments in a collated alignment file
+
+    Consecutive alignments with the same query name are bundled, and each
+    bundle is yielded as (code, [AlignedPair]) like
+    alignment.fetch_fragments_seq. Names, flags and mate positions are read
+    from the bam1_t records, and mates in properly paired bundles are found
+    with integer keys. Pairs are yielded in the same order as
+    alignment.pair_bundle.
+
+    Args:
+        samiter: Iterator over pysam.AlignedSegment
+    """
+    cdef object samiter
+    cdef AlignedSegment _next
+
+    def __cinit__(self, samiter):
+        self.samiter = iter(samiter)
+        self._next = None
+
+    def __iter__(self):
+        return self
+
+    cdef list _bundle(self):
+        """ Alignments with the same query name as the next alignment """
+        cdef AlignedSegment aln
+        cdef list bundle
+        cdef char *qname
+        if self._next is None:
+            self._next = next(self.samiter)
+        bundle = [self._next]
+        qname = bam_get_qname(self._next._delegate)
+        self._next = None
+        for aln in self.samiter:
+            if strcmp(bam_get_qname(aln._delegate), qname) == 0:
+                bundle.append(aln)
+            else:
+                self._next = aln
+                break
+        return bundle
+
+    def __next__(self):
+        cdef list bundle = self._bundle()
+        cdef AlignedSegment aln, a0 = bundle[0], a1
+        cdef uint16_t flag = a0._delegate.core.flag
+        if not flag & FLAG_PAIRED:
+            return (CODE_SU if flag & FLAG_UNMAP else CODE_SM,
+                    [AlignedPair(aln) for aln in bundle])
+        if flag & FLAG_PROPER_PAIR:
+            return (CODE_PM, _pair_bundle(bundle))
+        if len(bundle) == 2:
+            a1 = bundle[1]
+            if flag & FLAG_UNMAP and a1._delegate.core.flag & FLAG_UNMAP:
+                return (CODE_PU, [AlignedPair(a0, a1)])
+        return (CODE_PX, [AlignedPair(aln) for aln in bundle])
+
+
+cdef list _pair_bundle(list bundle):
+    """ Pair mates within a bundle, same as alignment.pair_bundle """
+    cdef dict readcache = {}
+    cdef list ret = []
+    cdef AlignedSegment aln, mate
+    for aln in bundle:
+        if not aln._delegate.core.flag & FLAG_PAIRED:
+            ret.append(AlignedPair(aln))
+            continue
+        mate = readcache.pop(_pair_key(aln._delegate, True), None)
+        if mate is not None:
+            if aln._delegate.core.flag & FLAG_READ1:
+                ret.append(AlignedPair(aln, mate))
+            else:
+                ret.append(AlignedPair(mate, aln))
         else:
-            return self.r1.get_tag('AS') + self.r2.get_tag('AS')
+            readcache[_pair_key(aln._delegate, False)] = aln
+    for aln in readcache.values():
+        ret.append(AlignedPair(aln))
+    return ret
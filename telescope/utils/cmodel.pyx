@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+""" Compiled kernels for TelescopeLikelihood
+
+Each kernel works directly on the arrays of a CSR matrix (data, indices,
+indptr) so that no temporary sparse matrices are created. Matrices for z share
+indices and indptr with Q, so z is stored as a single data array.
+
+Rows are divided into `nthreads` contiguous ranges with about the same number
+of nonzero values, and each range is processed by one thread without the GIL.
+Sums are accumulated separately for each range and added in order, so results
+only depend on the number of threads.
+"""
+from cython.parallel cimport prange
+from libc.math cimport log1p
+
+import numpy as np
+
+
+__author__ = 'Matthew L. Bendall'
+__copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
+
+
+ctypedef fused index_t:
+    int
+    long long
+
+
+def row_ranges(indptr, int nthreads):
+    """ Divide rows into ranges with about the same number of nonzero values
+
+    Args:
+        indptr: Row pointers of CSR matrix
+        nthreads: Number of ranges
+
+    Returns:
+        ndarray: Row boundaries, range t is [bounds[t], bounds[t + 1])
+    """
+    indptr = np.asarray(indptr)
+    nthreads = max(1, nthreads)
+    nrow = len(indptr) - 1
+    _targets = np.linspace(0, indptr[nrow], nthreads + 1)
+    bounds = np.searchsorted(indptr, _targets).astype(np.intp)
+    bounds[0], bounds[nthreads] = 0, nrow
+    return np.minimum(bounds, nrow)
+
+
+def estep(const double[::1] qdata, const index_t[::1] indices,
+          const index_t[::1] indptr, const unsigned char[::1] y,
+          const double[::1] pi, const double[::1] theta, double[::1] out,
+          int nthreads=1):
+    """ Calculate the expected values of z
+
+        E(z[i,j]) = ( pi[j] * theta[j]**Y[i] * Q[i,j] ) / sum_j(...)
+
+    Args:
+        qdata: Data array of Q
+        indices: Column indices of Q
+        indptr: Row pointers of Q
+        y: Ambiguity indicator for each row
+        pi: Current estimate of pi
+        theta: Current estimate of theta
+        out: Array for values of z, same length as qdata. Can be the data
+            array of the previous z.
+        nthreads: Number of threads
+    """
+    cdef Py_ssize_t[::1] bounds = row_ranges(indptr, nthreads)
+    cdef Py_ssize_t t, i, k, nrange = bounds.shape[0] - 1
+    cdef index_t j
+    cdef double v, rowsum
+
+    for t in prange(nrange, nogil=True, schedule='static', chunksize=1,
+                    num_threads=nrange):
+        for i in range(bounds[t], bounds[t + 1]):
+            rowsum = 0.
+            for k in range(indptr[i], indptr[i + 1]):
+                j = indices[k]
+                if y[i]:
+                    v = qdata[k] * (pi[j] * theta[j])
+                else:
+                    v = qdata[k] * pi[j]
+                out[k] = v
+                rowsum = rowsum + v
+            # Rows that sum to zero are left as zero
+            rowsum = 1. / rowsum if rowsum != 0. else 0.
+            for k in range(indptr[i], indptr[i + 1]):
+                out[k] *= rowsum
+
+
+def weighted_colsum(const double[::1] zdata, const index_t[::1] indices,
+                    const index_t[::1] indptr, const double[::1] rowwt,
+                    double[::1] out, int nthreads=1):
+    """ Calculate the column sums of z, with each row multiplied by a weight
+
+    Args:
+        zdata: Data array of z
+        indices: Column indices of z
+        indptr: Row pointers of z
+        rowwt: Weight for each row. Rows with zero weight are skipped.
+        out: Array for column sums, initialized to zero
+        nthreads: Number of threads
+    """
+    cdef Py_ssize_t[::1] bounds = row_ranges(indptr, nthreads)
+    cdef Py_ssize_t t, i, k, nrange = bounds.shape[0] - 1
+    cdef Py_ssize_t ncol = out.shape[0]
+    cdef double w
+    # Column sums for each range of rows
+    cdef double[:, ::1] partial = np.zeros((nrange, ncol))
+
+    for t in prange(nrange, nogil=True, schedule='static', chunksize=1,
+                    num_threads=nrange):
+        for i in range(bounds[t], bounds[t + 1]):
+            w = rowwt[i]
+            if w == 0.:
+                continue
+            for k in range(indptr[i], indptr[i + 1]):
+                partial[t, indices[k]] += zdata[k] * w
+
+    for t in range(nrange):
+        for k in range(ncol):
+            out[k] += partial[t, k]
+
+
+def lnl(const double[::1] qdata, const double[::1] zdata,
+        const index_t[::1] indices, const index_t[::1] indptr,
+        const unsigned char[::1] y, const double[::1] pi,
+        const double[::1] theta, const double[::1] nfrags, int nthreads=1):
+    """ Calculate the log-likelihood
+
+        sum_i( nfrags[i] * sum_j( z[i,j] * log(1 + pi[j] * theta[j]**Y[i] * Q[i,j]) ) )
+
+    Args:
+        qdata: Data array of Q
+        zdata: Data array of z, with the same indices and indptr as Q
+        indices: Column indices of Q
+        indptr: Row pointers of Q
+        y: Ambiguity indicator for each row
+        pi: Estimate of pi
+        theta: Estimate of theta
+        nfrags: Number of fragments represented by each row
+        nthreads: Number of threads
+
+    Returns:
+        float: log-likelihood
+    """
+    cdef Py_ssize_t[::1] bounds = row_ranges(indptr, nthreads)
+    cdef Py_ssize_t t, i, k, nrange = bounds.shape[0] - 1
+    cdef index_t j
+    cdef double v, rowsum, total = 0.
+    # Log-likelihood for each range of rows
+    cdef double[::1] partial = np.zeros(nrange)
+
+    for t in prange(nrange, nogil=True, schedule='static', chunksize=1,
+                    num_threads=nrange):
+        for i in range(bounds[t], bounds[t + 1]):
+            rowsum = 0.
+            for k in range(indptr[i], indptr[i + 1]):
+                j = indices[k]
+                if y[i]:
+                    v = qdata[k] * (pi[j] * theta[j])
+                else:
+                    v = qdata[k] * pi[j]
+                rowsum = rowsum + zdata[k] * log1p(v)
+            partial[t] += rowsum * nfrags[i]
+
+    for t in range(nrange):
+        total += partial[t]
+    return total
@@ -37,6 +37,27 @@ def phred(P):
     return int(round(-10 * np.log10(1 - P))) if P < 1.0 else 255
 
 
+def phred_array(P):
+    """ Calculate phred quality scores for an array of probabilities
+
+    Same as `phred` applied to each element.
+
+    Args:
+        P (ndarray): Probabilities between 0 and 1, inclusive
+
+    Returns:
+        ndarray: Phred scores
+
+    Examples:
+        >>> phred_array(np.array([0.9, 0.999999, 0, 1])).tolist()
+        [10, 60, 0, 255]
+    """
+    P = np.asarray(P, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        _q = np.round(-10 * np.log10(1 - P))
+    return np.where(P < 1.0, _q, 255).astype(np.int64)
+
+
 def eprob(Q):
     """ Calculate probability/accuracy value for given phred quality score
 
@@ -8,8 +8,11 @@ import os
 import logging as lg
 from collections import OrderedDict, defaultdict, Counter
 import gc
+import argparse
 from multiprocessing import Pool
 import functools
+from itertools import islice
+from array import array
 
 import pandas as pd
 import numpy as np
@@ -17,10 +20,13 @@ import scipy
 import pysam
 
 from .sparse_plus import csr_matrix_plus as csr_matrix
+from .sparse_plus import CooBuilder, _recip0, _data_index
+from ._checkpoint import Checkpoint
 from .colors import c2str, D2PAL, GPAL
-from .helpers import str2int, region_iter, phred
+from .helpers import region_iter, phred_array
 
 from . import alignment
+from . import cmodel
 from . import BIG_INT
 
 __author__ = 'Matthew L. Bendall'
@@ -28,39 +34,103 @@ __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
 
 
 def process_overlap_frag(pairs, overlap_feats):
-    ''' Find the best alignment for each locus '''
+    ''' Find the best alignment for each locus
+
+    Returns:
+        (list, list, str): Mappings (fragment, feature, score, length), whether
+            each alignment is the best for its feature, and the best
+            feature(s), comma separated. These are the ZT and ZB tags written
+            by `Telescope.update_sam`.
+    '''
     assert all(pairs[0].query_id == p.query_id for p in pairs)
     ''' Organize by feature'''
     byfeature = defaultdict(list)
-    for pair, feat in zip(pairs, overlap_feats):
-        byfeature[feat].append(pair)
+    for i, feat in enumerate(overlap_feats):
+        byfeature[feat].append(i)
 
     _maps = []
-    for feat, falns in byfeature.items():
+    _primary = [False] * len(pairs)
+    for feat, fidx in byfeature.items():
         # Sort alignments by score + length
-        falns.sort(key=lambda x: x.alnscore + x.alnlen,
+        fidx.sort(key=lambda i: pairs[i].alnscore + pairs[i].alnlen,
                   reverse=True)
         # Add best alignment to mappings
-        _topaln = falns[0]
+        _topaln = pairs[fidx[0]]
         _maps.append(
             (_topaln.query_id, feat, _topaln.alnscore, _topaln.alnlen)
         )
-        # Set tag for feature (ZF) and whether it is best (ZT)
-        _topaln.set_tag('ZF', feat)
-        _topaln.set_tag('ZT', 'PRI')
-        for aln in falns[1:]:
-            aln.set_tag('ZF', feat)
-            aln.set_tag('ZT', 'SEC')
+        _primary[fidx[0]] = True
 
     # Sort mappings by score
     _maps.sort(key=lambda x: x[2], reverse=True)
     # Top feature(s), comma separated
     _topfeat = ','.join(t[1] for t in _maps if t[2] == _maps[0][2])
-    # Add best feature tag (ZB) to all alignments
-    for p in pairs:
-        p.set_tag('ZB', _topfeat)
 
-    return _maps
+    return _maps, _primary, _topfeat
+
+
+class FragmentTags(object):
+    """ Tags for the alignments of fragments that overlap the annotation
+
+    Fragments are identified by their ordinal in the alignment file, so that
+    `Telescope.update_sam` can read the original file again instead of a copy
+    of the overlapping fragments. Tags are stored in flat arrays:
+
+        ordinals        Ordinal of each overlapping fragment, increasing
+        ptr             Mapped alignments of fragment k are ptr[k]:ptr[k + 1]
+        feats           Feature (ZF) of each mapped alignment
+        primary         Whether each mapped alignment is the best (ZT)
+        best            Best feature(s) (ZB) of each fragment
+
+    Features are indexes into `names`.
+    """
+    def __init__(self):
+        self.ordinals = array('q')
+        self.ptr = array('q', [0])
+        self.feats = array('i')
+        self.primary = array('b')
+        self.best = array('i')
+        self.names = []
+        self._nameidx = {}
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def _name(self, name):
+        if name not in self._nameidx:
+            self._nameidx[name] = len(self.names)
+            self.names.append(name)
+        return self._nameidx[name]
+
+    def add(self, ordinal, feats, primary, best):
+        """ Add tags for one fragment
+
+        Args:
+            ordinal (int): Ordinal of fragment in the alignment file
+            feats (list of str): Feature of each mapped alignment
+            primary (list of bool): Whether each alignment is the best
+            best (str): Best feature(s) of the fragment
+        """
+        self.ordinals.append(ordinal)
+        self.feats.extend(self._name(f) for f in feats)
+        self.primary.extend(primary)
+        self.ptr.append(len(self.feats))
+        self.best.append(self._name(best))
+
+    def extend(self, other, offset):
+        """ Append tags from fragments that follow these in the file
+
+        Args:
+            other (FragmentTags): Tags to append
+            offset (int): Ordinal of the first fragment in `other`
+        """
+        _remap = [self._name(n) for n in other.names]
+        _base = len(self.feats)
+        self.ordinals.extend(o + offset for o in other.ordinals)
+        self.ptr.extend(p + _base for p in other.ptr[1:])
+        self.feats.extend(_remap[f] for f in other.feats)
+        self.primary.extend(other.primary)
+        self.best.extend(_remap[b] for b in other.best)
 
 
 def _print_progress(nfrags, infolev=2500000):
@@ -71,6 +141,115 @@ def _print_progress(nfrags, infolev=2500000):
     else:
          lg.debug(msg)
 
+def _assign_chunks(fragiter, assigner, chunksize):
+    """ Assign the mapped alignments of fragments in chunks
+
+    Yields:
+        (int, list, list, list): Code, alignments, mapped alignments and the
+            feature of each mapped alignment, for each fragment
+    """
+    fragiter = iter(fragiter)
+    while True:
+        chunk = list(islice(fragiter, chunksize))
+        if not chunk:
+            return
+        _mapped = [[a for a in alns if not a.is_unmapped] for _, alns in chunk]
+        _feats = iter(assigner.assign_batch([a for m in _mapped for a in m]))
+        for (ci, alns), mapped in zip(chunk, _mapped):
+            yield ci, alns, mapped, list(islice(_feats, len(mapped)))
+
+
+def _load_fragments(fragiter, assigner, opts, tags=None, barcodes=None,
+                    progress=True, chunksize=10000):
+    """ Find overlapping features for each fragment
+
+    Fragments are read in chunks, and the mapped alignments of each chunk are
+    assigned together with `Assigner.assign_batch`.
+
+    Args:
+        fragiter: Iterator over (code, [AlignedPair]) for each fragment
+        assigner (Assigner): Assigns features to alignments
+        opts: Options with no_feature_key and barcode_tag
+        tags (FragmentTags): Tags for fragments with overlap are added if
+            not None
+        barcodes (dict): Cell barcode for each fragment is added if not None
+        progress (bool): Log number of processed fragments
+        chunksize (int): Number of fragments assigned together
+
+    Returns:
+        (list, tuple, Counter): Mappings (code, fragment, feature, score,
+            length), minimum and maximum alignment scores, and counts
+    """
+    _nfkey = opts.no_feature_key
+
+    _mappings = []
+    alninfo = Counter()
+    _minAS, _maxAS = BIG_INT, -BIG_INT
+    for ci, alns, _mapped, overlap_feats in _assign_chunks(fragiter, assigner,
+                                                           chunksize):
+        alninfo['total_fragments'] += 1
+        if progress and alninfo['total_fragments'] % 500000 == 0:
+            _print_progress(alninfo['total_fragments'])
+
+        ''' Count code '''
+        _code = alignment.CODES[ci][0]
+        alninfo[_code] += 1
+
+        ''' Check whether fragment is mapped '''
+        if _code == 'SU' or _code == 'PU':
+            continue
+
+        ''' If running with single cell data, add cell '''
+        if barcodes is not None and alns[0].r1.has_tag(opts.barcode_tag):
+            barcodes[alns[0].query_id] = dict(alns[0].r1.get_tags()).get(opts.barcode_tag)
+
+        ''' Fragment is ambiguous if multiple mappings'''
+        _ambig = len(_mapped) > 1
+
+        ''' Update min and max scores '''
+        _scores = [a.alnscore for a in _mapped]
+        _minAS = min(_minAS, *_scores)
+        _maxAS = max(_maxAS, *_scores)
+
+        ''' Check whether fragment overlaps annotation '''
+        has_overlap = any(f != _nfkey for f in overlap_feats)
+
+        ''' Fragment has no overlap '''
+        if not has_overlap:
+            alninfo['nofeat_{}'.format('A' if _ambig else 'U')] += 1
+            continue
+
+        ''' Fragment overlaps with annotation '''
+        alninfo['feat_{}'.format('A' if _ambig else 'U')] += 1
+
+        ''' Find the best alignment for each locus '''
+        _maps, _primary, _topfeat = process_overlap_frag(_mapped, overlap_feats)
+        for m in _maps:
+            _mappings.append((ci, m[0], m[1], m[2], m[3]))
+
+        if tags is not None:
+            tags.add(alninfo['total_fragments'] - 1, overlap_feats, _primary,
+                     _topfeat)
+
+    return _mappings, (_minAS, _maxAS), alninfo
+
+
+def _load_split(args):
+    """ Load one range of a collated BAM, see Telescope._load_collated """
+    annotation, opts, vrange, update_sam, single_cell = args
+    assigner = Assigner(annotation, opts.no_feature_key, opts.overlap_mode,
+                        opts.overlap_threshold, opts)
+    _barcodes = {} if single_cell else None
+    _tags = FragmentTags() if update_sam else None
+    with pysam.AlignmentFile(opts.samfile, check_sq=False,
+                             threads=opts.io_threads) as sf:
+        _fragiter = alignment.fetch_fragments_seq(sf, vrange=vrange)
+        _maps, scorerange, alninfo = _load_fragments(
+            _fragiter, assigner, opts, _tags, _barcodes, progress=False
+        )
+    return _maps, scorerange, alninfo, _barcodes, _tags
+
+
 class Telescope(object):
     """
 
@@ -85,17 +264,17 @@ class Telescope(object):
         self.feat_index = {}           # {"feature_name": column_index}
         self.shape = None              # Fragments x Features
         self.raw_scores = None         # Initial alignment scores
-
-        # BAM with non overlapping fragments (or unmapped)
-        self.other_bam = opts.outfile_path('other.bam')
-        # BAM with overlapping fragments
-        self.tmp_bam = opts.outfile_path('tmp_tele.bam')
+        self.frag_tags = None          # Tags for updated SAM, FragmentTags
+        self.em_state = None           # EM state loaded from checkpoint
+        self.min_score = None          # Minimum alignment score
 
         # Set the version
         self.run_info['version'] = self.opts.version
 
         with pysam.AlignmentFile(self.opts.samfile, check_sq=False) as sf:
             self.has_index = sf.has_index()
+            # Collated BAM files can be loaded in parallel, see _load_collated
+            self.is_bam = sf.is_bam
             if self.has_index:
                 self.run_info['nmap_idx'] = sf.mapped
                 self.run_info['nunmap_idx'] = sf.unmapped
@@ -105,46 +284,42 @@ class Telescope(object):
 
         return
 
-    def save(self, filename):
-        _feat_list = sorted(self.feat_index, key=self.feat_index.get)
-        _flen_list = [self.feature_length[f] for f in _feat_list]
-        np.savez(filename,
-                 _run_info = list(self.run_info.items()),
-                 _flen_list = _flen_list,
-                 _feat_list = _feat_list,
-                 _read_list = sorted(self.read_index, key=self.read_index.get),
-                 _shape = self.shape,
-                 _raw_scores_data = self.raw_scores.data,
-                 _raw_scores_indices=self.raw_scores.indices,
-                 _raw_scores_indptr=self.raw_scores.indptr,
-                 _raw_scores_shape=self.raw_scores.shape,
-                 )
+    def save(self, filename, compress=False, model=None):
+        """ Write checkpoint file, see `_checkpoint.Checkpoint`
+
+        Args:
+            filename (str): Path to checkpoint file
+            compress (bool): Compress arrays
+            model (TelescopeLikelihood): Model after EM. The EM state is
+                saved so that `telescope resume` can skip EM.
+        """
+        Checkpoint(self.run_info, self.feat_index, self.feature_length,
+                   self.read_index, self.raw_scores,
+                   None if model is None else model.em_state(),
+                   self.min_score).save(filename, compress)
 
     @classmethod
     def load(cls, filename):
-        loader = np.load(filename)
+        """ Read checkpoint file
+
+        Fragment names are loaded as a `NameIndex`, which is only decoded
+        when a name is looked up.
+        """
+        return cls.from_checkpoint(Checkpoint.load(filename))
+
+    @classmethod
+    def from_checkpoint(cls, ckpt):
+        """ Create object from `_checkpoint.Checkpoint` """
         obj = cls.__new__(cls)
-        ''' Run info '''
-        obj.run_info = OrderedDict()
-        for r in range(loader['_run_info'].shape[0]):
-            k = loader['_run_info'][r, 0]
-            v = str2int(loader['_run_info'][r, 1])
-            obj.run_info[k] = v
-        obj.feature_length = Counter()
-        for f,fl in zip(loader['_feat_list'], loader['_flen_list']):
-            obj.feature_length[f] = fl
-        ''' Read and feature indexes '''
-        obj.read_index = {n: i for i, n in enumerate(loader['_read_list'])}
-        obj.feat_index = {n: i for i, n in enumerate(loader['_feat_list'])}
+        obj.run_info = ckpt.run_info
+        obj.feature_length = ckpt.feature_length
+        obj.read_index = ckpt.read_index
+        obj.feat_index = ckpt.feat_index
         obj.shape = len(obj.read_index), len(obj.feat_index)
-        assert tuple(loader['_shape']) == obj.shape
-
-        obj.raw_scores = csr_matrix((
-            loader['_raw_scores_data'],
-            loader['_raw_scores_indices'],
-            loader['_raw_scores_indptr'] ),
-            shape=loader['_raw_scores_shape']
-        )
+        assert ckpt.raw_scores.shape == obj.shape
+        obj.raw_scores = ckpt.raw_scores
+        obj.em_state = ckpt.em
+        obj.min_score = ckpt.min_score
         return obj
 
     def get_random_seed(self):
@@ -156,8 +331,11 @@ class Telescope(object):
         self.run_info['annotated_features'] = len(annotation.loci)
         self.feature_length = annotation.feature_length().copy()
 
-        if self.opts.ncpu > 1:
+        if self.opts.ncpu > 1 and self.has_index:
             maps, scorerange, alninfo = self._load_parallel(annotation)
+        elif self.opts.ncpu > 1 and self.is_bam:
+            maps, scorerange, alninfo = self._load_collated(annotation)
+            lg.debug(str(alninfo))
         else:
             maps, scorerange, alninfo = self._load_sequential(annotation)
             lg.debug(str(alninfo))
@@ -172,141 +350,169 @@ class Telescope(object):
         for f in run_fields:
             self.run_info[f] = alninfo[f]
 
+    def _worker_opts(self):
+        """ Options needed by loading workers, since opts is not picklable """
+        return argparse.Namespace(
+            samfile=self.opts.samfile,
+            no_feature_key=self.opts.no_feature_key,
+            overlap_mode=self.opts.overlap_mode,
+            overlap_threshold=self.opts.overlap_threshold,
+            stranded_mode=self.opts.stranded_mode,
+            barcode_tag=getattr(self.opts, 'barcode_tag', None),
+            tempdir=self.opts.tempdir,
+            io_threads=self.opts.io_threads,
+        )
+
     def _load_parallel(self, annotation):
+        """ Load a coordinate-sorted, indexed BAM file in parallel
+
+        The file is divided into work units with similar numbers of reads (see
+        `alignment.sorted_work_units`) that are scheduled dynamically over
+        the worker processes, largest first. Mates that are not found in the
+        same work unit are paired afterwards by `alignment.resolve_mates`.
+        """
         lg.info('Loading alignments in parallel...')
-        regions = region_iter(self.ref_names,
-                              self.ref_lengths,
-                              max(self.ref_lengths) # Do not split contigs
-                              )
-
-        opt_d = {
-            'no_feature_key': self.opts.no_feature_key,
-            'overlap_mode': self.opts.overlap_mode,
-            'overlap_threshold': self.opts.overlap_threshold,
-            'tempdir': self.opts.tempdir
-        }
+        if self.opts.updated_sam:
+            lg.warning('--updated_sam requires a collated alignment file, '
+                       'updated SAM will not be written.')
+            self.opts.updated_sam = False
+
+        units = alignment.sorted_work_units(self.opts.samfile,
+                                            self.opts.ncpu * 4)
+        lg.debug('divided alignment file into {:d} work units'.format(
+            len(units)))
+        _wopts = self._worker_opts()
         _minAS, _maxAS = BIG_INT, -BIG_INT
         alninfo = Counter()
         mfiles = []
+        carried = []
         pool = Pool(processes = self.opts.ncpu)
         _loadfunc = functools.partial(alignment.fetch_region,
                                       self.opts.samfile,
                                       annotation,
-                                      opt_d,
+                                      _wopts,
                                       )
-        result = pool.map_async(_loadfunc, regions)
-        mappings = []
-        for mfile, scorerange, _pxu in result.get():
+        results = pool.map(_loadfunc, units, chunksize=1)
+        pool.close()
+        for mfile, scorerange, _pxu, _unmapped, _carried in results:
             alninfo['unmap_x'] += _pxu
+            alninfo['unmapped'] += _unmapped
             _minAS = min(scorerange[0], _minAS)
             _maxAS = max(scorerange[1], _maxAS)
             mfiles.append(mfile)
+            carried.extend(_carried)
+
+        ''' Pair mates from different work units '''
+        lg.debug('resolving {:d} alignments without mates'.format(len(carried)))
+        mfile, scorerange, _pxu = alignment.resolve_mates(
+            self.opts.samfile, annotation, _wopts, carried
+        )
+        alninfo['unmap_x'] += _pxu
+        _minAS = min(scorerange[0], _minAS)
+        _maxAS = max(scorerange[1], _maxAS)
+        mfiles.append(mfile)
 
-        _miter = self._mapping_fromfiles(mfiles)
-        return _miter, (_minAS, _maxAS), alninfo
+        _maps = alignment.load_mapping_chunks(mfiles)
+        return _maps, (_minAS, _maxAS), alninfo
 
-    def _mapping_fromfiles(self, files):
-        for f in files:
-            lines = (l.strip('\n').split('\t') for l in open(f, 'rU'))
-            for code, rid, fid, ascr, alen in lines:
-                yield (int(code), rid, fid, int(ascr), int(alen))
+    def _load_collated(self, annotation):
+        """ Load a collated BAM file in parallel
 
-    def _load_sequential(self, annotation):
+        The file is divided into ranges of virtual offsets that start at a new
+        query name (see `alignment.collated_splits`), and each range is loaded
+        by a worker process as in `_load_sequential`. Results are merged in
+        file order, so they are identical to loading sequentially.
+        """
+        lg.info('Loading alignments in parallel...')
         _update_sam = self.opts.updated_sam
-        _nfkey = self.opts.no_feature_key
-        _omode, _othresh = self.opts.overlap_mode, self.opts.overlap_threshold
+        splits = alignment.collated_splits(self.opts.samfile,
+                                           self.opts.ncpu * 4)
+        lg.debug('divided alignment file into {:d} ranges'.format(len(splits)))
 
-        _mappings = []
-        assign = Assigner(annotation, _nfkey, _omode, _othresh, self.opts).assign_func()
+        _wopts = self._worker_opts()
+        tasks = [(annotation, _wopts, vrange, _update_sam, self.single_cell)
+                 for vrange in splits]
 
-        """ Load unsorted reads """
+        pool = Pool(processes=self.opts.ncpu)
+        results = pool.map(_load_split, tasks, chunksize=1)
+        pool.close()
+
+        ''' Merge results in file order '''
+        _mappings = []
+        _minAS, _maxAS = BIG_INT, -BIG_INT
         alninfo = Counter()
-        with pysam.AlignmentFile(self.opts.samfile, check_sq=False) as sf:
-            # Create output temporary files
+        if _update_sam:
+            self.frag_tags = FragmentTags()
+        for _maps, scorerange, _alninfo, _barcodes, _tags in results:
             if _update_sam:
-                bam_u = pysam.AlignmentFile(self.other_bam, 'wb', template=sf)
-                bam_t = pysam.AlignmentFile(self.tmp_bam, 'wb', template=sf)
-
-            _minAS, _maxAS = BIG_INT, -BIG_INT
-            for ci, alns in alignment.fetch_fragments_seq(sf, until_eof=True):
-                alninfo['total_fragments'] += 1
-                if alninfo['total_fragments'] % 500000 == 0:
-                    _print_progress(alninfo['total_fragments'])
-
-                ''' Count code '''
-                _code = alignment.CODES[ci][0]
-                alninfo[_code] += 1
-
-                ''' Check whether fragment is mapped '''
-                if _code == 'SU' or _code == 'PU':
-                    if _update_sam: alns[0].write(bam_u)
-                    continue
-
-                ''' If running with single cell data, add cell '''
-                if self.single_cell == True and alns[0].r1.has_tag(self.opts.barcode_tag):
-                    self.read_barcodes[alns[0].query_id] = dict(alns[0].r1.get_tags()).get(self.opts.barcode_tag)
-
-                ''' Fragment is ambiguous if multiple mappings'''
-                _mapped = [a for a in alns if not a.is_unmapped]
-                _ambig = len(_mapped) > 1
+                self.frag_tags.extend(_tags, alninfo['total_fragments'])
+            _mappings.extend(_maps)
+            _minAS = min(_minAS, scorerange[0])
+            _maxAS = max(_maxAS, scorerange[1])
+            alninfo.update(_alninfo)
+            if self.single_cell:
+                self.read_barcodes.update(_barcodes)
 
-                ''' Update min and max scores '''
-                _scores = [a.alnscore for a in _mapped]
-                _minAS = min(_minAS, *_scores)
-                _maxAS = max(_maxAS, *_scores)
-
-                ''' Check whether fragment overlaps annotation '''
-                overlap_feats = list(map(assign, _mapped))
-                has_overlap = any(f != _nfkey for f in overlap_feats)
-
-                ''' Fragment has no overlap '''
-                if not has_overlap:
-                    alninfo['nofeat_{}'.format('A' if _ambig else 'U')] += 1
-                    if _update_sam:
-                        [p.write(bam_u) for p in alns]
-                    continue
-
-                ''' Fragment overlaps with annotation '''
-                alninfo['feat_{}'.format('A' if _ambig else 'U')] += 1
+        return _mappings, (_minAS, _maxAS), alninfo
 
-                ''' Find the best alignment for each locus '''
-                for m in process_overlap_frag(_mapped, overlap_feats):
-                    _mappings.append((ci, m[0], m[1], m[2], m[3]))
+    def _load_sequential(self, annotation):
+        _update_sam = self.opts.updated_sam
+        _nfkey = self.opts.no_feature_key
+        _omode, _othresh = self.opts.overlap_mode, self.opts.overlap_threshold
 
-                if _update_sam:
-                    [p.write(bam_t) for p in alns]
+        assigner = Assigner(annotation, _nfkey, _omode, _othresh, self.opts)
+        _barcodes = self.read_barcodes if self.single_cell else None
 
-        ''' Loading complete '''
+        """ Load unsorted reads """
         if _update_sam:
-            bam_u.close()
-            bam_t.close()
+            self.frag_tags = FragmentTags()
+        with pysam.AlignmentFile(self.opts.samfile, check_sq=False,
+                                 threads=self.opts.io_threads) as sf:
+            _fragiter = alignment.fetch_fragments_seq(sf, until_eof=True)
+            ret = _load_fragments(_fragiter, assigner, self.opts,
+                                  self.frag_tags, _barcodes)
 
         # lg.info('Alignment Info: {}'.format(alninfo))
-        return _mappings, (_minAS, _maxAS), alninfo
+        return ret
 
     def _mapping_to_matrix(self, miter, scorerange, alninfo):
+        """ Build alignment score matrix from mappings
+
+        Args:
+            miter: Mappings (code, fragment, feature, score, length), or
+                columns, read names and feature names from
+                `alignment.load_mapping_chunks` when loaded in parallel
+            scorerange (tuple): Minimum and maximum alignment scores
+            alninfo (Counter): Counts from loading
+        """
         _isparallel = 'total_fragments' not in alninfo
         minAS, maxAS = scorerange
         lg.debug('min alignment score: {}'.format(minAS))
         lg.debug('max alignment score: {}'.format(maxAS))
+        self.min_score = minAS
         # Function to rescale integer alignment scores
         # Scores should be greater than zero
         rescale = {s: (s - minAS + 1) for s in range(minAS, maxAS + 1)}
 
-        # Construct dok matrix with mappings
-        dim = (1000000000, 10000000)
-
-        rcodes = defaultdict(Counter)
-        _m1 = scipy.sparse.dok_matrix(dim, dtype=np.uint16)
+        # Collect mappings, keeping the best score for each read and feature
+        _m1 = CooBuilder(dtype=np.uint16)
         _ridx = self.read_index
         _fidx = self.feat_index
         _fidx[self.opts.no_feature_key] = 0
 
-        for code, rid, fid, ascr, alen in miter:
-            i = _ridx.setdefault(rid, len(_ridx))
-            j = _fidx.setdefault(fid, len(_fidx))
-            _m1[i, j] = max(_m1[i, j], (rescale[ascr] + alen))
-            if _isparallel: rcodes[code][i] += 1
+        if _isparallel:
+            cols, read_names, feat_names = miter
+            _rows = cols['reads'] + len(_ridx)
+            _ridx.update((n, i) for i, n in enumerate(read_names, len(_ridx)))
+            _fmap = np.array([_fidx.setdefault(f, len(_fidx))
+                              for f in feat_names], dtype=np.intc)
+            _m1.extend(_rows, _fmap[cols['feats']],
+                       cols['scores'] - minAS + 1 + cols['lengths'])
+        else:
+            for code, rid, fid, ascr, alen in miter:
+                i = _ridx.setdefault(rid, len(_ridx))
+                j = _fidx.setdefault(fid, len(_fidx))
+                _m1.append(i, j, rescale[ascr] + alen)
 
         ''' Map barcodes to read indices '''
         if self.single_cell == True:
@@ -317,16 +523,19 @@ class Telescope(object):
 
         ''' Update counts '''
         if _isparallel:
-            # Default for nunmap_idx is zero
-            unmap_both = self.run_info.get('nunmap_idx', 0) - alninfo['unmap_x']
-            alninfo['unmapped'] = old_div(unmap_both, 2)
+            # Unmapped fragments are counted while loading
             for cs, desc in alignment.CODES:
                 ci = alignment.CODE_INT[cs]
-                if cs not in alninfo and ci in rcodes:
-                    alninfo[cs] = len(rcodes[ci])
-                if cs in ['SM','PM','PX'] and ci in rcodes:
-                    _a = sum(v>1 for k,v in rcodes[ci].items())
-                    alninfo['unique'] += (len(rcodes[ci]) - _a)
+                # Number of mappings for each read with this code
+                _nmaps = np.bincount(_rows[cols['codes'] == ci])
+                _nreads = np.count_nonzero(_nmaps)
+                if _nreads == 0:
+                    continue
+                if cs not in alninfo:
+                    alninfo[cs] = _nreads
+                if cs in ['SM','PM','PX']:
+                    _a = np.count_nonzero(_nmaps > 1)
+                    alninfo['unique'] += (_nreads - _a)
                     alninfo['ambig'] += _a
             alninfo['total_fragments'] = alninfo['unmapped'] + \
                                          alninfo['PM'] + alninfo['PX'] + \
@@ -344,17 +553,18 @@ class Telescope(object):
                 alninfo[desc] = alninfo[cs]
                 del alninfo[cs]
 
-        """ Trim extra rows and columns from matrix """
-        _m1 = _m1[:len(_ridx), :len(_fidx)]
+        """ Build matrix with one row per read and one column per feature """
+        _m1 = _m1.tocsr(shape=(len(_ridx), len(_fidx)))
 
         """ Remove rows with only __nofeature """
         rownames = np.array(sorted(_ridx, key=_ridx.get))
         assert _fidx[self.opts.no_feature_key] == 0, "No feature key is not first column!"
-        # Remove nofeature column then find rows with nonzero values
-        _nz = scipy.sparse.csc_matrix(_m1)[:,1:].sum(1).nonzero()[0]
+        # Find rows with nonzero values outside the nofeature column
+        _rows = np.repeat(np.arange(_m1.shape[0]), np.diff(_m1.indptr))
+        _nz = np.unique(_rows[_m1.indices > 0])
         # Subset scores and read names
-        self.raw_scores = csr_matrix(csr_matrix(_m1)[_nz, ])
-        _ridx = {v:i for i,v in enumerate(rownames[_nz])}
+        self.raw_scores = csr_matrix(_m1[_nz, ])
+        self.read_index = _ridx = {v:i for i,v in enumerate(rownames[_nz])}
         # Set the shape
         self.shape = (len(_ridx), len(_fidx))
         # Ambiguous mappings
@@ -428,17 +638,21 @@ class Telescope(object):
                                              'init_prop']
                                     )
 
+        # Reassignments from the final and initial assignment weights
+        _final = tl.reassignments(_rprob)
+        _init = tl.reassignments(_rprob, initial=True)
+
         # Report information for run statistics
         _stats_report0 = {
             'transcript': _fnames,                                          # transcript
             'transcript_length': [_flens[f] for f in _fnames],              # tx_len
-            'final_conf': tl.reassign('conf', _rprob).sum(0).A1,            # final_conf
+            'final_conf': _final.counts('conf'),                            # final_conf
             'final_prop': tl.pi,                                            # final_prop
-            'init_aligned': tl.reassign('all', initial=True).sum(0).A1,     # init_aligned
-            'unique_count': tl.reassign('unique').sum(0).A1,                # unique_count
-            'init_best': tl.reassign('exclude', initial=True).sum(0).A1,    # init_best
-            'init_best_random': tl.reassign('choose', initial=True).sum(0).A1,  # init_best_random
-            'init_best_avg': tl.reassign('average', initial=True).sum(0).A1,    # init_best_avg
+            'init_aligned': _init.counts('all'),                            # init_aligned
+            'unique_count': _final.counts('unique'),                        # unique_count
+            'init_best': _init.counts('exclude'),                           # init_best
+            'init_best_random': _init.counts('choose'),                     # init_best_random
+            'init_best_avg': _init.counts('average'),                       # init_best_avg
             'init_prop': tl.pi_init                                             # init_prop
         }
 
@@ -454,7 +668,7 @@ class Telescope(object):
         # Report information for transcript counts
         _counts0 = {
             'transcript': _fnames,  # transcript
-            'count': tl.reassign(_rmethod, _rprob).sum(0).A1 # final_count
+            'count': _final.counts(_rmethod) # final_count
         }
 
         # Rotate the report
@@ -477,46 +691,90 @@ class Telescope(object):
         return
 
     def update_sam(self, tl, filename):
+        """ Write alignments of fragments that overlap the annotation
+
+        The original alignment file is read again, and fragments are matched
+        to the tags recorded while loading (`frag_tags`) by their ordinal.
+        Reading stops after the last overlapping fragment.
+
+        MAPQ, XP and color of the best alignment for each fragment and feature
+        are calculated for all nonzero entries of z before reading, so each
+        alignment only needs the position of its entry in the row of z.
+        """
         _rmethod, _rprob = self.opts.reassign_mode, self.opts.conf_prob
-        _fnames = sorted(self.feat_index, key=self.feat_index.get)
+        _tags = self.frag_tags
+        _ordinals = _tags.ordinals
 
         mat = csr_matrix(tl.reassign(_rmethod, _rprob))
         # best_feats = {i: _fnames for i, j in zip(*mat.nonzero())}
 
-        with pysam.AlignmentFile(self.tmp_bam, check_sq=False) as sf:
+        ''' Values for each entry of z '''
+        z = tl.z
+        _ncol = z.shape[1]
+        _zrows = np.repeat(np.arange(z.shape[0], dtype=np.int64),
+                           np.diff(z.indptr))
+        _mrows = np.repeat(np.arange(mat.shape[0], dtype=np.int64),
+                           np.diff(mat.indptr))
+        _mkeys = (_mrows * _ncol + mat.indices)[mat.data > 0]
+        _assigned = np.isin(_zrows * _ncol + z.indices, _mkeys)
+        _mapq = phred_array(z.data).tolist()
+        _xp = np.round(z.data * 100).astype(np.int64).tolist()
+        ''' Colors: 0 is reassigned, 1 is prob >= 0.2, 2 is prob < 0.2 '''
+        _color = np.where(_assigned, 0, np.where(z.data >= 0.2, 1, 2)).tolist()
+        _colors = [c2str(D2PAL['vermilion']), c2str(D2PAL['yellow']),
+                   c2str(GPAL[2])]
+        _seccolor = c2str((248, 248, 248))
+        _indptr, _indices = z.indptr, z.indices
+        ''' Column of z for each feature in tags '''
+        _tagcol = [self.feat_index.get(n, -1) for n in _tags.names]
+
+        _threads = self.opts.io_threads
+        with pysam.AlignmentFile(self.opts.samfile, check_sq=False,
+                                 threads=_threads) as sf:
             header = sf.header
             header['PG'].append({
                 'PN': 'telescope', 'ID': 'telescope',
                 'VN': self.run_info['version'],
                 'CL': ' '.join(sys.argv),
             })
-            outsam = pysam.AlignmentFile(filename, 'wb', header=header)
-            for code, pairs in alignment.fetch_fragments_seq(sf, until_eof=True):
-                if len(pairs) == 0: continue
+            outsam = pysam.AlignmentFile(filename, 'wb', header=header,
+                                         threads=_threads)
+            k = 0
+            _fragiter = alignment.fetch_fragments_seq(sf, until_eof=True)
+            for ordinal, (code, pairs) in enumerate(_fragiter):
+                if k == len(_ordinals):
+                    break
+                if ordinal != _ordinals[k]:
+                    continue
+                _j = _tags.ptr[k]
+                _topfeat = _tags.names[_tags.best[k]]
+                k += 1
                 ridx = self.read_index[pairs[0].query_id]
+                _lo = int(_indptr[ridx])
+                _rowcols = _indices[_lo:_indptr[ridx + 1]].tolist()
                 for aln in pairs:
                     if aln.is_unmapped:
                         aln.write(outsam)
                         continue
-                    assert aln.r1.has_tag('ZT'), 'Missing ZT tag'
-                    if aln.r1.get_tag('ZT') == 'SEC':
+                    _fcode = _tags.feats[_j]
+                    _primary = _tags.primary[_j]
+                    _j += 1
+                    aln.set_tag('ZF', _tags.names[_fcode])
+                    aln.set_tag('ZT', 'PRI' if _primary else 'SEC')
+                    aln.set_tag('ZB', _topfeat)
+                    if not _primary:
                         aln.set_flag(pysam.FSECONDARY)
-                        aln.set_tag('YC', c2str((248, 248, 248)))
+                        aln.set_tag('YC', _seccolor)
                         aln.set_mapq(0)
                     else:
-                        fidx = self.feat_index[aln.r1.get_tag('ZF')]
-                        prob = tl.z[ridx, fidx]
-                        aln.set_mapq(phred(prob))
-                        aln.set_tag('XP', int(round(prob*100)))
-                        if mat[ridx, fidx] > 0:
+                        _pos = _lo + _rowcols.index(_tagcol[_fcode])
+                        aln.set_mapq(_mapq[_pos])
+                        aln.set_tag('XP', _xp[_pos])
+                        if _color[_pos] == 0:
                             aln.unset_flag(pysam.FSECONDARY)
-                            aln.set_tag('YC',c2str(D2PAL['vermilion']))
                         else:
                             aln.set_flag(pysam.FSECONDARY)
-                            if prob >= 0.2:
-                                aln.set_tag('YC', c2str(D2PAL['yellow']))
-                            else:
-                                aln.set_tag('YC', c2str(GPAL[2]))
+                        aln.set_tag('YC', _colors[_color[_pos]])
                     aln.write(outsam)
             outsam.close()
 
@@ -612,6 +870,16 @@ class scTelescope(Telescope):
         _methods = ['conf', 'all', 'unique', 'exclude', 'choose', 'average']
         _bcidx = {bcode: rows for bcode, rows in self.barcode_read_indices.items() if len(rows) > 0}
         _bcodes = [_bcode for _bcode, _rows in _bcidx.items()]
+        # Matrix with one row per cell, m[i, j] = 1 iff fragment j is in cell i
+        _cellrows = [np.asarray(_rows, dtype=np.int64) for _rows in _bcidx.values()]
+        _cellptr = np.cumsum([0] + [len(_rows) for _rows in _cellrows])
+        _cellmat = scipy.sparse.csr_matrix(
+            (np.ones(_cellptr[-1]),
+             np.concatenate(_cellrows) if _cellrows else np.zeros(0, dtype=np.int64),
+             _cellptr),
+            shape=(len(_bcidx), tl.N)
+        )
+        _reassign = tl.reassignments(_rprob)
         for _method in _methods:
             if _method != _rmethod and not self.opts.use_every_reassign_mode:
                 continue
@@ -619,15 +887,132 @@ class scTelescope(Telescope):
                 counts_outfile = counts_filename[:counts_filename.rfind('.')] + '_' + _method + '.tsv'
             else:
                 counts_outfile = counts_filename
-            _assignments = tl.reassign(_method, _rprob)
-            _cell_count_matrix = scipy.sparse.dok_matrix((len(_bcidx), _assignments.shape[1]))
-            for i, (_bcode, _rows) in enumerate(_bcidx.items()):
-                _cell_count_matrix[i, :] = _assignments[_rows, :].sum(0).A1
-            _cell_count_df = pd.DataFrame(_cell_count_matrix.todense(),
+            _assignments = _reassign.assignments(_method)
+            _cell_count_matrix = _cellmat @ _assignments
+            _cell_count_df = pd.DataFrame(_cell_count_matrix.toarray(),
                                           columns = _fnames,
                                           index = _bcodes)
             _cell_count_df.to_csv(counts_outfile, sep = '\t')
 
+def _em_subproblem(args):
+    """ Run EM for one component, see TelescopeLikelihood._em_components """
+    model, use_likelihood = args
+    inum, converged = model._em_iterate(use_likelihood, lg.DEBUG)
+    return model, inum, converged
+
+
+class Reassignment(object):
+    """ Reassignment of fragments by every method, see
+    `TelescopeLikelihood.reassign`
+
+    The row maxima, best hits and number of best hits of z are found once, in
+    one pass over the collapsed rows, and shared by all methods. Values for
+    each method are calculated for the collapsed rows and expanded to
+    fragments only when needed.
+
+    Args:
+        z (csr_matrix_plus): Assignment weights for collapsed rows
+        rowclass (ndarray): Collapsed row for each fragment
+        ambig (ndarray): Ambiguity indicator for each collapsed row (N x 1)
+        thresh (float): Threshold for "conf"
+    """
+    METHODS = ('exclude', 'choose', 'average', 'conf', 'unique', 'all')
+
+    def __init__(self, z, rowclass, ambig, thresh=0.9):
+        self.z = z
+        self.rowclass = rowclass
+        self.ambig = ambig
+        self.thresh = thresh
+        self._values = {}
+
+        ''' Best hits and number of best hits in each row '''
+        self._rows = z._row_index()
+        self._best = z.data == z._row_max()[self._rows]
+        self._nbest = np.bincount(self._rows[self._best],
+                                  minlength=z.shape[0])
+
+    def values(self, method):
+        """ Values for each nonzero of z, for methods other than "choose" """
+        if method not in self._values:
+            _rows, data = self._rows, self.z.data
+            if method == 'exclude':
+                # Best hit of rows with exactly one best hit
+                ret = (self._best & (self._nbest[_rows] == 1)).astype(np.int8)
+            elif method == 'average':
+                # Best hits divided by number of best hits
+                ret = np.where(self._best,
+                               1. / np.maximum(self._nbest, 1)[_rows], 0.)
+            elif method == 'conf':
+                # Values greater than threshold, divided by row sum
+                ret = np.where(data >= self.thresh, data, 0)
+                _rowsum = np.bincount(_rows, ret, minlength=self.z.shape[0])
+                ret = ret * _recip0(_rowsum)[_rows]
+            elif method == 'unique':
+                # Rows that are not ambiguous
+                ret = np.ceil(data * (1 - self.ambig[_rows, 0]))
+                ret = ret.astype(np.uint8)
+            elif method == 'all':
+                ret = (data > 0).astype(np.uint8)
+            else:
+                raise ValueError('Argument "method" should be one of (%s)'
+                                 % ', '.join(self.METHODS))
+            self._values[method] = ret
+        return self._values[method]
+
+    def _choose(self):
+        """ Randomly choose one best hit for each fragment
+
+        Random numbers are drawn in the same order as choosing for each row of
+        the expanded matrix with `csr_matrix_plus.choose_random`.
+
+        Returns:
+            (ndarray, ndarray): Fragments and positions of the chosen values
+                in the data array of z.
+        """
+        _nbest = self._nbest[self.rowclass]
+        _offset = np.zeros(len(self.rowclass), dtype=np.int64)
+        _multi = _nbest > 1
+        if _multi.any():
+            _offset[_multi] = np.random.randint(0, _nbest[_multi])
+        _bestpos = np.flatnonzero(self._best)
+        _bestptr = np.concatenate([[0], np.cumsum(self._nbest)])
+        _frags = np.flatnonzero(_nbest > 0)
+        _pos = _bestpos[_bestptr[self.rowclass[_frags]] + _offset[_frags]]
+        return _frags, _pos
+
+    def counts(self, method):
+        """ Number of fragments assigned to each transcript
+
+        Same as `assignments(method).sum(0).A1`. Fractional values are summed
+        over fragments in order, so the sums are identical.
+        """
+        _ncol = self.z.shape[1]
+        if method == 'choose':
+            _, _pos = self._choose()
+            return np.bincount(self.z.indices[_pos], minlength=_ncol)
+        _vals = self.values(method)
+        if _vals.dtype.kind in 'iu':
+            _nfrags = np.bincount(self.rowclass, minlength=self.z.shape[0])
+            return np.bincount(self.z.indices, _vals * _nfrags[self._rows],
+                               minlength=_ncol).astype(np.int64)
+        _pos = _data_index(self.z.indptr, self.rowclass)
+        return np.bincount(self.z.indices[_pos], _vals[_pos], minlength=_ncol)
+
+    def assignments(self, method):
+        """ Matrix where m[i,j] > 0 iff fragment i is reassigned to j """
+        _shape = (len(self.rowclass), self.z.shape[1])
+        if method == 'choose':
+            _frags, _pos = self._choose()
+            _indptr = np.zeros(_shape[0] + 1, dtype=np.int64)
+            _indptr[_frags + 1] = 1
+            return csr_matrix((np.ones(len(_pos), dtype=np.int8),
+                               self.z.indices[_pos], np.cumsum(_indptr)),
+                              shape=_shape)
+        m = csr_matrix((self.values(method), self.z.indices, self.z.indptr),
+                       shape=self.z.shape)
+        return csr_matrix(m[self.rowclass])
+
+
 class TelescopeLikelihood(object):
     """
 
@@ -642,6 +1027,15 @@ class TelescopeLikelihood(object):
         # N fragments x K transcripts
         self.N, self.K = self.raw_scores.shape
 
+        # Fragments with identical scores for the same transcripts always have
+        # identical expected values. Each set of identical fragments is
+        # represented by one row, weighted by the number of fragments in the
+        # set. _rowclass[i] is the row representing fragment i.
+        _scores, _nfrags, self._rowclass = self.raw_scores.collapse_rows()
+        self._nfrags = _nfrags[:, None]
+        lg.debug('collapsed {} fragments into {} rows'.format(
+            self.N, _scores.shape[0]))
+
         # Q[i,] is the set of mapping qualities for fragment i, where Q[i,j]
         # represents the evidence for fragment i being generated by fragment j.
         # In this case the evidence is represented by an alignment score, which
@@ -650,17 +1044,27 @@ class TelescopeLikelihood(object):
         # Scale the raw alignment score by the maximum alignment score
         # and multiply by a scale factor.
         self.scale_factor = 100.
-        self.Q = self.raw_scores.scale().multiply(self.scale_factor).expm1()
+        self.Q = _scores.scale().multiply(self.scale_factor).expm1()
 
         # z[i,] is the partial assignment weights for fragment i, where z[i,j]
         # is the expected value for fragment i originating from transcript j. The
         # initial estimate is the normalized mapping qualities:
         # z_init[i,] = Q[i,] / sum(Q[i,])
-        self.z = None # self.Q.norm(1)
+        # Only the rows for ambiguous fragments are stored (`_za`), see `z`.
+        self._za = None
+        self._z = None
+        self._zfull = None
 
         self.epsilon = opts.em_epsilon
         self.max_iter = opts.max_iter
 
+        # Run EM separately for each connected component
+        self.em_components = opts.em_components
+        # Acceleration method for EM iterations, "none" or "squarem"
+        self.em_accel = opts.em_accel
+        # Number of threads, or number of processes for components
+        self.ncpu = opts.ncpu
+
         # pi[j] is the proportion of fragments that originate from
         # transcript j. Initial value assumes that all transcripts contribute
         # equal proportions of fragments
@@ -687,79 +1091,264 @@ class TelescopeLikelihood(object):
         self.theta_prior = opts.theta_prior
 
         # Precalculated values
-        self._weights = self.Q.max(1)             # Weight assigned to each fragment
-        self._total_wt = self._weights.sum()      # Total weight
-        self._ambig_wt = self._weights.multiply(self.Y).sum() # Weight of ambig frags
-        self._unique_wt = self._weights.multiply(1-self.Y).sum()
+        self._weights = self.Q.max(1).toarray()   # Weight assigned to each fragment
+        self._rowwt = self._weights * self._nfrags  # Weight of each row
+        self._total_wt = self._rowwt.sum()        # Total weight
+        self._ambig_wt = (self._rowwt * self.Y).sum() # Weight of ambig frags
+        self._unique_wt = (self._rowwt * (1-self.Y)).sum()
 
         # Weighted prior values
         self._pi_prior_wt = self.pi_prior * self._weights.max()
         self._theta_prior_wt = self.theta_prior * self._weights.max()
         #
-        self._pisum0 = self.Q.multiply(1-self.Y).sum(0)
+        self._pisum0 = self.Q.multiply(1-self.Y).multiply(self._nfrags).sum(0)
+        self._ambig_rowwt = np.ascontiguousarray((self._rowwt * self.Y)[:, 0])
+        self._theta_denom = self._ambig_wt + self._theta_prior_wt * self.K
+        self._pi_denom = self._total_wt + self._pi_prior_wt * self.K
+        self._split_ambiguous()
         lg.debug('done initializing model')
 
-    def estep(self, pi, theta):
-        """ Calculate the expected values of z
+    def _split_ambiguous(self):
+        """ Split Q into ambiguous and unique rows
+
+        Unique rows always have z = 1 for their only transcript, so EM only
+        needs to update the rows of ambiguous fragments, `_qa`. The
+        contribution of unique rows to pi_hat is constant (`_pisum0`) and
+        their contribution to the log-likelihood only depends on pi.
+        """
+        self._qa = csr_matrix(self.Q[self._yslice])
+        self._qa_y = np.ones(len(self._yslice), dtype=np.uint8)
+        self._qa_rowwt = np.ascontiguousarray(self._ambig_rowwt[self._yslice])
+        self._qa_nfrags = self._nfrags[self._yslice, 0].astype(np.float64)
+
+        # Position of the only value in each unique row
+        _uslice = (self.Y[:, 0] == 0).nonzero()[0]
+        _upos = self.Q.indptr[_uslice]
+        self._qu_col = self.Q.indices[_upos]
+        self._qu_data = self.Q.data[_upos]
+        self._qu_nfrags = self._nfrags[_uslice, 0].astype(np.float64)
+
+    @property
+    def z(self):
+        """ Expected values of z with one row per fragment
+
+        The matrix is expanded from the collapsed rows when first requested.
+        """
+        if self._za is None:
+            return None
+        if self._zfull is None:
+            self._zfull = self.expand(self._collapsed_z())
+        return self._zfull
+
+    def _collapsed_z(self):
+        """ Expected values of z for all collapsed rows
+
+        Combines z for ambiguous rows with z = 1 for unique rows. The matrix
+        has the same indices and indptr as Q.
+        """
+        if self._z is None:
+            _zdata = np.ones_like(self.Q.data)
+            _zdata[_data_index(self.Q.indptr, self._yslice)] = self._za.data
+            self._z = csr_matrix((_zdata, self.Q.indices, self.Q.indptr),
+                                 shape=self.Q.shape)
+        return self._z
+
+    def _set_za(self, za):
+        """ Update z for ambiguous rows and clear matrices derived from it """
+        self._za, self._z, self._zfull = za, None, None
+
+    def expand(self, m):
+        """ Expand matrix with collapsed rows to one row per fragment """
+        return csr_matrix(m[self._rowclass])
+
+    def estep(self, pi, theta, out=None):
+        """ Calculate the expected values of z for ambiguous fragments
                 E(z[i,j]) = ( pi[j] * theta[j]**Y[i] * Q[i,j] ) /
+
+        Args:
+            pi: Estimate of pi
+            theta: Estimate of theta
+            out: Array for the values of z, with the same length as
+                `_qa.data`. A new array is allocated if not provided.
+
+        Returns:
+            csr_matrix_plus: z for ambiguous rows, sharing indices and indptr
+                with `_qa`
         """
         lg.debug('started e-step')
-
-        # New way:
-        # _n = self.Q.copy()
-        # _rowiter = zip(_n.indptr[:-1], _n.indptr[1:], self.Y[:, 0])
-        # for d_start, d_end, indicator in _rowiter:
-        #     _cidx = _n.indices[d_start:d_end]
-        #     if indicator == 1:
-        #         _n.data[d_start:d_end] *= (pi[_cidx] * theta[_cidx])
-        #     else:
-        #         _n.data[d_start:d_end] *= pi[_cidx]
-        # Newer way
-        _amb = csr_matrix(self.Q.multiply(self.Y)).multiply(pi * theta)
-        _uni = csr_matrix(self.Q.multiply(1 - self.Y)).multiply(pi)
-        _n = csr_matrix(_amb + _uni)
-
-        return _n.norm(1)
+        if out is None:
+            out = np.empty_like(self._qa.data)
+        cmodel.estep(self._qa.data, self._qa.indices, self._qa.indptr,
+                     self._qa_y, pi, theta, out, self.ncpu)
+        return csr_matrix((out, self._qa.indices, self._qa.indptr),
+                          shape=self._qa.shape)
 
     def mstep(self, z):
         """ Calculate the maximum a posteriori (MAP) estimates for pi and theta
 
         """
         lg.debug('started m-step')
-        # The expected values of z weighted by mapping score
-        _weighted = z.multiply(self._weights)
+        # The expected values of z for ambiguous fragments, weighted by
+        # mapping score
+        _thetasum = np.zeros(z.shape[1])
+        cmodel.weighted_colsum(z.data, z.indices, z.indptr, self._qa_rowwt,
+                               _thetasum, self.ncpu)
 
         # Estimate theta_hat
-        _thetasum = _weighted.multiply(self.Y).sum(0)
-        _theta_denom = self._ambig_wt + self._theta_prior_wt * self.K
-        _theta_hat = (_thetasum + self._theta_prior_wt) / _theta_denom
+        _theta_hat = (_thetasum + self._theta_prior_wt) / self._theta_denom
 
         # Estimate pi_hat
-        _pisum = self._pisum0 + _thetasum
-        _pi_denom = self._total_wt + self._pi_prior_wt * self.K
-        _pi_hat = (_pisum + self._pi_prior_wt) / _pi_denom
+        _pisum = self._pisum0.A1 + _thetasum
+        _pi_hat = (_pisum + self._pi_prior_wt) / self._pi_denom
 
-        return _pi_hat.A1, _theta_hat.A1
+        return _pi_hat, _theta_hat
 
     def calculate_lnl(self, z, pi, theta):
+        """ Calculate the log-likelihood
+
+        z is for ambiguous rows and must have the same indices and indptr as
+        `_qa`.
+        """
         lg.debug('started lnl')
-        # _inner = self.Q.copy()
-        # _rowiter = zip(_inner.indptr[:-1], _inner.indptr[1:], self.Y[:, 0])
-        # for d_start, d_end, indicator in _rowiter:
-        #     _cidx =  _inner.indices[d_start:d_end]
-        #     if indicator == 1:
-        #         _inner.data[d_start:d_end] *= (pi[_cidx] * theta[_cidx])
-        #     else:
-        #         _inner.data[d_start:d_end] *= pi[_cidx]
-        #
-        _amb = csr_matrix(self.Q.multiply(self.Y)).multiply(pi * theta)
-        _uni = csr_matrix(self.Q.multiply(1 - self.Y)).multiply(pi)
-        _inner = csr_matrix(_amb + _uni)
-        cur = z.multiply(_inner.log1p()).sum()
+        cur = cmodel.lnl(self._qa.data, z.data, self._qa.indices,
+                         self._qa.indptr, self._qa_y, pi, theta,
+                         self._qa_nfrags, self.ncpu)
+        # Unique rows have z = 1
+        cur += np.dot(self._qu_nfrags,
+                      np.log1p(self._qu_data * pi[self._qu_col]))
         lg.debug('completed lnl')
         return cur
 
     def em(self, use_likelihood=False, loglev=lg.WARNING, save_memory=True):
+        if self.em_components:
+            inum, converged = self._em_components(use_likelihood, loglev)
+            self.lnl = self.calculate_lnl(self._za, self.pi, self.theta)
+        else:
+            inum, converged = self._em_iterate(use_likelihood, loglev)
+            if not use_likelihood:
+                self.lnl = self.calculate_lnl(self._za, self.pi, self.theta)
+        self.use_likelihood = use_likelihood
+        self.num_iter, self.converged = inum, converged
+
+        _con = 'converged' if converged else 'terminated'
+        lg.log(loglev, 'EM {:s} after {:d} iterations.'.format(_con, inum))
+        lg.log(loglev, 'Final log-likelihood: {:f}.'.format(self.lnl))
+        return
+
+    def em_params(self, use_likelihood=False):
+        """ Parameters that determine the EM estimates """
+        return {
+            'pi_prior': self.pi_prior,
+            'theta_prior': self.theta_prior,
+            'em_epsilon': self.epsilon,
+            'max_iter': self.max_iter,
+            'use_likelihood': bool(use_likelihood),
+            'em_accel': self.em_accel,
+            'em_components': bool(self.em_components),
+        }
+
+    def em_state(self):
+        """ Estimates after EM, to be saved in a checkpoint
+
+        z is saved for the ambiguous rows only; its indices and indptr are
+        those of `_qa`, which are recalculated from the alignment scores.
+        """
+        return {
+            'params': self.em_params(self.use_likelihood),
+            'lnl': self.lnl,
+            'num_iter': self.num_iter,
+            'converged': self.converged,
+            'pi': self.pi,
+            'theta': self.theta,
+            'pi_init': self.pi_init,
+            'theta_init': self.theta_init,
+            'za_data': self._za.data,
+        }
+
+    def resume_em(self, state, use_likelihood=False, loglev=lg.WARNING):
+        """ Run EM starting from a saved state
+
+        If the saved parameters are the same as the current ones the saved
+        estimates are restored without running EM. If only the priors or
+        epsilon differ, EM starts from the saved pi and theta. Otherwise, or
+        if the state does not match the model, EM is run from the start.
+
+        Args:
+            state (dict): State from `em_state`, or None
+
+        Returns:
+            str: "restored", "warm" or "full"
+        """
+        if state is None or len(state['pi']) != self.K or \
+                len(state['za_data']) != self._qa.nnz:
+            self.em(use_likelihood, loglev)
+            return 'full'
+
+        _params = self.em_params(use_likelihood)
+        _changed = {k for k, v in _params.items()
+                    if state['params'].get(k) != v}
+        if not _changed:
+            self._set_za(csr_matrix(
+                (np.array(state['za_data']), self._qa.indices,
+                 self._qa.indptr), shape=self._qa.shape
+            ))
+            self.pi, self.theta = np.array(state['pi']), np.array(state['theta'])
+            self.pi_init = np.array(state['pi_init'])
+            self.theta_init = np.array(state['theta_init'])
+            self.lnl = state['lnl']
+            self.use_likelihood = use_likelihood
+            self.num_iter, self.converged = state['num_iter'], state['converged']
+            lg.log(loglev, 'EM estimates restored from checkpoint '
+                           '({:d} iterations).'.format(self.num_iter))
+            lg.log(loglev, 'Final log-likelihood: {:f}.'.format(self.lnl))
+            return 'restored'
+
+        if _changed <= {'pi_prior', 'theta_prior', 'em_epsilon'}:
+            lg.log(loglev, 'Starting EM from checkpoint estimates '
+                           '({:s} changed).'.format(', '.join(sorted(_changed))))
+            # Convergence is only tested on pi, so starting from a theta for
+            # another prior can stop EM before theta has moved
+            self.warm_start(state['pi'], None if 'theta_prior' in _changed
+                            else state['theta'])
+            self.em(use_likelihood, loglev)
+            return 'warm'
+
+        self.em(use_likelihood, loglev)
+        return 'full'
+
+    def warm_start(self, pi, theta=None):
+        """ Start EM from previous estimates of pi and theta
+
+        pi_init and theta_init are still the estimates after one iteration
+        from the uniform start, so the initial columns of the report do not
+        depend on where EM starts.
+
+        Args:
+            pi: Starting estimate of pi
+            theta: Starting estimate of theta. Uniform if None.
+        """
+        _z = self.estep(self.pi, self.theta)
+        self.pi_init, self.theta_init = self.mstep(_z)
+        self.pi = np.array(pi)
+        if theta is not None:
+            self.theta = np.array(theta)
+
+    def _em_iterate(self, use_likelihood=False, loglev=lg.WARNING):
+        """ Run EM iterations using the selected acceleration method
+
+        Returns:
+            (int, bool): Number of iterations and whether EM converged
+        """
+        if self.em_accel == 'squarem':
+            return self._em_squarem(use_likelihood, loglev)
+        return self._em_loop(use_likelihood, loglev)
+
+    def _em_loop(self, use_likelihood=False, loglev=lg.WARNING):
+        """ Iterate E-step and M-step until convergence
+
+        Returns:
+            (int, bool): Number of iterations and whether EM converged
+        """
         inum = 0               # Iteration number
         converged = False      # Has convergence been reached?
         reached_max = False    # Has max number of iterations been reached?
@@ -770,10 +1359,12 @@ class TelescopeLikelihood(object):
         from .helpers import format_minutes as fmtmins
         while not (converged or reached_max):
             xtime = perf_counter()
-            _z = self.estep(self.pi, self.theta)
+            # z from the previous iteration is overwritten
+            _z = self.estep(self.pi, self.theta,
+                            None if self._za is None else self._za.data)
             _pi, _theta = self.mstep(_z)
             inum += 1
-            if inum == 1:
+            if inum == 1 and self.pi_init is None:
                 self.pi_init = _pi
                 self.theta_init = _theta
 
@@ -792,18 +1383,231 @@ class TelescopeLikelihood(object):
                 converged = diff_est < self.epsilon
 
             reached_max = inum >= self.max_iter
-            self.z = _z
+            self._set_za(_z)
             self.pi, self.theta = _pi, _theta
             lg.debug("time: {}".format(perf_counter()-xtime))
 
-        _con = 'converged' if converged else 'terminated'
-        if not use_likelihood:
-            self.lnl = self.calculate_lnl(self.z, self.pi, self.theta)
+        return inum, converged
 
+    def _em_squarem(self, use_likelihood=False, loglev=lg.WARNING):
+        """ Iterate E-step and M-step with SQUAREM acceleration
 
-        lg.log(loglev, 'EM {:s} after {:d} iterations.'.format(_con, inum))
-        lg.log(loglev, 'Final log-likelihood: {:f}.'.format(self.lnl))
-        return
+        Each iteration takes two EM steps from the current estimates x0, giving
+        x1 and x2, and extrapolates along them (Varadhan and Roland 2008,
+        scheme S3):
+
+            x' = x0 + 2 * a * r + a**2 * v,  r = x1 - x0,  v = x2 - 2 * x1 + x0
+
+        where the step length a = |r| / |v| is limited to [1, step_max]. A
+        step of 1 gives x' = x2. step_max increases whenever the limit is
+        reached. The step is shortened until estimates that are positive in x2
+        are positive in x'. If the log-likelihood at x' is more than `lnl_tol`
+        below the log-likelihood at x0, x2 is used instead and step_max is
+        reset. As in the SQUAREM reference implementation, the tolerance of 1
+        allows small decreases.
+
+        Convergence is tested on the first EM step of each iteration, so the
+        fixed point is the same as for `_em_loop`.
+
+        Returns:
+            (int, bool): Number of iterations and whether EM converged
+        """
+        inum = 0               # Iteration number
+        nestep = 0             # Number of E-steps
+        converged = False      # Has convergence been reached?
+        reached_max = False    # Has max number of iterations been reached?
+        step_max, step_inc = 1., 4.
+        lnl_tol = 1.
+
+        msgD = 'Iteration {:d}, diff={:.5g}, step={:.4g}, E-steps={:d}, ' \
+               'time={:.3f}s'
+        msgL = 'Iteration {:d}, lnl= {:.5e}, diff={:.5g}, step={:.4g}, ' \
+               'E-steps={:d}, time={:.3f}s'
+        from time import perf_counter
+
+        K = len(self.pi)
+        _x0 = np.concatenate([self.pi, self.theta])
+        # z is stored in a single buffer, each E-step overwrites it
+        _z = self.estep(self.pi, self.theta,
+                        None if self._za is None else self._za.data)
+        nestep += 1
+        _lnl0 = self.calculate_lnl(_z, self.pi, self.theta)
+        _lnl_prev = self.lnl
+        while True:
+            xtime = perf_counter()
+            _pi, _theta = self.mstep(_z)
+            inum += 1
+            if inum == 1 and self.pi_init is None:
+                self.pi_init = _pi
+                self.theta_init = _theta
+
+            ''' Calculate absolute difference between estimates '''
+            diff_est = abs(_pi - self.pi).sum()
+            if use_likelihood:
+                converged = abs(_lnl0 - _lnl_prev) < self.epsilon
+                _lnl_prev = _lnl0
+            else:
+                converged = diff_est < self.epsilon
+            reached_max = inum >= self.max_iter
+            if converged or reached_max:
+                self._set_za(_z)
+                self.pi, self.theta = _pi, _theta
+                if use_likelihood:
+                    self.lnl = self.calculate_lnl(_z, _pi, _theta)
+                lg.log(loglev, 'Iteration {:d}, diff={:.5g}'.format(inum,
+                                                                    diff_est))
+                break
+
+            ''' Second EM step '''
+            _x1 = np.concatenate([_pi, _theta])
+            _z = self.estep(_pi, _theta, _z.data)
+            nestep += 1
+            _x2 = np.concatenate(self.mstep(_z))
+
+            ''' Extrapolate '''
+            _r = _x1 - _x0
+            _v = _x2 - _x1 - _r
+            _vnorm = np.sqrt(np.dot(_v, _v))
+            step = np.sqrt(np.dot(_r, _r)) / _vnorm if _vnorm > 0 else 1.
+            step = min(max(step, 1.), step_max)
+            if step == step_max:
+                step_max *= step_inc
+            _x = _x0 + 2 * step * _r + step**2 * _v
+            # Shorten the step until all estimates that are positive after
+            # two EM steps remain positive
+            _pos = _x2 > 0
+            while step > 1 and np.any(_x[_pos] <= 0):
+                step = max(1., step / 2)
+                _x = _x0 + 2 * step * _r + step**2 * _v
+            if step == 1:
+                _x = _x2
+
+            _z = self.estep(_x[:K], _x[K:], _z.data)
+            nestep += 1
+            _lnl = self.calculate_lnl(_z, _x[:K], _x[K:])
+            if step > 1 and _lnl < _lnl0 - lnl_tol:
+                ''' Log-likelihood decreased, use EM estimates '''
+                step, step_max, _x = 1., 1., _x2
+                _z = self.estep(_x[:K], _x[K:], _z.data)
+                nestep += 1
+                _lnl = self.calculate_lnl(_z, _x[:K], _x[K:])
+
+            if use_likelihood:
+                lg.log(loglev, msgL.format(inum, _lnl, diff_est, step, nestep,
+                                           perf_counter() - xtime))
+            else:
+                lg.log(loglev, msgD.format(inum, diff_est, step, nestep,
+                                           perf_counter() - xtime))
+            _x0, _lnl0 = _x, _lnl
+            self.pi, self.theta = _x[:K], _x[K:]
+
+        lg.log(loglev, 'SQUAREM used {:d} E-steps in {:d} iterations'.format(
+            nestep, inum))
+        return inum, converged
+
+    def _em_components(self, use_likelihood=False, loglev=lg.WARNING):
+        """ Run EM separately on each connected component
+
+        Fragments and transcripts form a bipartite graph where a fragment is
+        connected to each transcript it aligns to. Transcripts in different
+        components never share a fragment, so their estimates are independent.
+        Components without ambiguous fragments are solved directly; the others
+        are run in parallel, each with its own convergence test.
+
+        Returns:
+            (int, bool): Maximum number of iterations for any component and
+                whether all components converged
+        """
+        ncomp, rowlab, collab = self.Q.components()
+        _has_ambig = np.bincount(rowlab, weights=self.Y[:, 0],
+                                 minlength=ncomp) > 0
+
+        # Without ambiguous fragments, theta_hat is the prior and pi_hat only
+        # depends on unique fragments. Estimates for components with ambiguous
+        # fragments are replaced below.
+        _pi = (self._pisum0.A1 + self._pi_prior_wt) / self._pi_denom
+        _theta = np.repeat(self._theta_prior_wt / self._theta_denom, self.K)
+        _pi_init, _theta_init = _pi.copy(), _theta.copy()
+
+        _rows = np.split(np.argsort(rowlab, kind='stable'),
+                         np.cumsum(np.bincount(rowlab, minlength=ncomp))[:-1])
+        _cols = np.split(np.argsort(collab, kind='stable'),
+                         np.cumsum(np.bincount(collab, minlength=ncomp))[:-1])
+
+        # z for ambiguous rows, all of which are in components that run EM
+        _zdata = np.zeros_like(self._qa.data)
+
+        # Run largest components first
+        _todo = sorted(np.flatnonzero(_has_ambig),
+                       key=lambda c: len(_rows[c]), reverse=True)
+        lg.log(loglev, 'Running EM on {:d} of {:d} components'.format(
+            len(_todo), ncomp))
+        _tasks = [(self._subproblem(_rows[c], _cols[c]), use_likelihood)
+                  for c in _todo]
+        if self.ncpu > 1 and len(_tasks) > 1:
+            # Each process runs single-threaded EM
+            for sub, _ in _tasks:
+                sub.ncpu = 1
+            pool = Pool(processes=self.ncpu)
+            _results = pool.map(_em_subproblem, _tasks, chunksize=1)
+            pool.close()
+        else:
+            _results = list(map(_em_subproblem, _tasks))
+
+        inum, converged = 0, True
+        for c, (sub, _inum, _converged) in zip(_todo, _results):
+            cols = _cols[c]
+            _pi[cols], _theta[cols] = sub.pi, sub.theta
+            _pi_init[cols], _theta_init[cols] = sub.pi_init, sub.theta_init
+            _arows = np.searchsorted(self._yslice, _rows[c][sub._yslice])
+            _zdata[_data_index(self._qa.indptr, _arows)] = sub._za.data
+            inum = max(inum, _inum)
+            converged = converged and _converged
+        lg.log(loglev, 'EM converged for {:d} of {:d} components'.format(
+            sum(r[2] for r in _results), len(_results)))
+
+        self._set_za(csr_matrix((_zdata, self._qa.indices, self._qa.indptr),
+                                shape=self._qa.shape))
+        self.pi, self.theta = _pi, _theta
+        self.pi_init, self.theta_init = _pi_init, _theta_init
+        return inum, converged
+
+    def _subproblem(self, rows, cols):
+        """ Create model for one component
+
+        The model includes the given rows and columns of Q, which must contain
+        all nonzero values in those rows. Weights, priors and denominators are
+        shared with the full model so that the estimates are unchanged.
+        """
+        sub = type(self).__new__(type(self))
+        _pos = _data_index(self.Q.indptr, rows)
+        _colmap = np.zeros(self.K, dtype=self.Q.indices.dtype)
+        _colmap[cols] = np.arange(len(cols))
+        _indptr = np.zeros(len(rows) + 1, dtype=self.Q.indptr.dtype)
+        np.cumsum(np.diff(self.Q.indptr)[rows], out=_indptr[1:])
+        sub.Q = csr_matrix(
+            (self.Q.data[_pos], _colmap[self.Q.indices[_pos]], _indptr),
+            shape=(len(rows), len(cols))
+        )
+        sub.Y = self.Y[rows]
+        sub._yslice = sub.Y[:, 0].nonzero()[0]
+        sub._nfrags = self._nfrags[rows]
+        sub._rowwt = self._rowwt[rows]
+        sub._ambig_rowwt = self._ambig_rowwt[rows]
+        sub._pisum0 = self._pisum0[:, cols]
+        sub._split_ambiguous()
+        for attr in ['epsilon', 'max_iter', 'em_accel', 'ncpu', 'lnl',
+                     '_pi_prior_wt', '_theta_prior_wt', '_pi_denom',
+                     '_theta_denom']:
+            setattr(sub, attr, getattr(self, attr))
+        sub.pi, sub.theta = self.pi[cols], self.theta[cols]
+        if self.pi_init is None:
+            sub.pi_init = sub.theta_init = None
+        else:
+            sub.pi_init = self.pi_init[cols]
+            sub.theta_init = self.theta_init[cols]
+        sub._za = sub._z = sub._zfull = None
+        return sub
 
     def reassign(self, method, thresh=0.9, initial=False):
         """ Reassign fragments to expected transcripts
@@ -831,38 +1635,25 @@ class TelescopeLikelihood(object):
             matrix where m[i,j] == 1 iff read i is reassigned to transcript j
 
         """
-        if method not in ['exclude', 'choose', 'average', 'conf', 'unique', 'all']:
+        if method not in Reassignment.METHODS:
             raise ValueError('Argument "method" should be one of (exclude, choose, average, conf, unique, all)')
+        return self.reassignments(thresh, initial).assignments(method)
 
-        _z = self.Q.norm(1) if initial else self.z
-
-        if method == 'exclude':
-            # Identify best hit(s), then exclude rows with >1 best hits
-            v = _z.binmax(1)
-            assignments = v.multiply(v.sum(1) == 1)
-        elif method == 'choose':
-            # Identify best hit(s), then randomly choose reassignment
-            v = _z.binmax(1)
-            assignments = v.choose_random(1)
-        elif method == 'average':
-            # Identify best hit(s), then divide by row sum
-            v = _z.binmax(1)
-            assignments = v.norm(1)
-        elif method == 'conf':
-            # Zero out all values less than threshold
-            # If thresh > 0.5 then at most
-            v = _z.apply_func(lambda x: x if x >= thresh else 0)
-            # Average each row so each sums to 1.
-            assignments = v.norm(1)
-        elif method == 'unique':
-            # Zero all rows that are ambiguous
-            assignments = _z.multiply(1 - self.Y).ceil().astype(np.uint8)
-        elif method == 'all':
-            # Return all nonzero elements
-            assignments = _z.apply_func(lambda x: 1 if x > 0 else 0).astype(np.uint8)
-
-        assignments = csr_matrix(assignments)
-        return assignments
+    def reassignments(self, thresh=0.9, initial=False):
+        """ Reassignments for every method, see `Reassignment`
+
+        Reassignments are calculated for collapsed rows and expanded to
+        fragments, except for "choose" which is random for each fragment.
+
+        Args:
+            thresh: Threshold for "conf"
+            initial: Use the initial weights, Q normalized by row
+
+        Returns:
+            Reassignment
+        """
+        _z = self.Q.norm(1) if initial else self._collapsed_z()
+        return Reassignment(_z, self._rowclass, self.Y, thresh)
 
 class Assigner:
     def __init__(self, annotation,
@@ -872,20 +1663,22 @@ class Assigner:
         self.overlap_mode = overlap_mode
         self.overlap_threshold = overlap_threshold
         self.opts = opts
+        ''' Fragment strand for (is_paired, r1_is_reversed) '''
+        _paired_fwd = opts.stranded_mode[-1] == 'F'
+        _single_fwd = opts.stranded_mode[0] == 'F'
+        self.frag_strand = {
+            (True, True): '+' if _paired_fwd else '-',
+            (False, True): '-' if _single_fwd else '+',
+            (True, False): '-' if _paired_fwd else '+',
+            (False, False): '+' if _single_fwd else '-',
+        }
 
     def assign_func(self):
+        _frag_strand = self.frag_strand
+
         def _assign_pair_threshold(pair):
             blocks = pair.refblocks
-            if pair.r1_is_reversed:
-                if pair.is_paired:
-                    frag_strand = '+' if self.opts.stranded_mode[-1] == 'F' else '-'
-                else:
-                    frag_strand = '-' if self.opts.stranded_mode[0] == 'F' else '+'
-            else:
-                if pair.is_paired:
-                    frag_strand = '-' if self.opts.stranded_mode[-1] == 'F' else '+'
-                else:
-                    frag_strand = '+' if self.opts.stranded_mode[0] == 'F' else '-'
+            frag_strand = _frag_strand[(pair.is_paired, pair.r1_is_reversed)]
             f = self.annotation.intersect_blocks(pair.ref_name, blocks, frag_strand)
             if not f:
                 return self.no_feature_key
@@ -897,10 +1690,24 @@ class Assigner:
                 return self.no_feature_key
 
         def _assign_pair_intersection_strict(pair):
-            pass
+            frag_strand = _frag_strand[(pair.is_paired, pair.r1_is_reversed)]
+            steps = self.annotation.steps(pair.ref_name, frag_strand)
+            if steps is None:
+                return self.no_feature_key
+            f = steps.intersection_strict(pair.refblocks)
+            if len(f) != 1:
+                return self.no_feature_key
+            return self.annotation.locus_names[f.pop()]
 
         def _assign_pair_union(pair):
-            pass
+            frag_strand = _frag_strand[(pair.is_paired, pair.r1_is_reversed)]
+            steps = self.annotation.steps(pair.ref_name, frag_strand)
+            if steps is None:
+                return self.no_feature_key
+            f = steps.union(pair.refblocks)
+            if len(f) != 1:
+                return self.no_feature_key
+            return self.annotation.locus_names[f.pop()]
 
         ''' Return function depending on overlap mode '''
         if self.overlap_mode == 'threshold':
@@ -912,3 +1719,39 @@ class Assigner:
         else:
             assert False
 
+    def assign_batch(self, pairs):
+        """ Assign many fragments at once
+
+        Fragments are assigned with the same rules as `assign_func`. For the
+        "intersection-strict" and "union" modes, all fragments are assigned
+        together by the annotation.
+
+        Args:
+            pairs (list of AlignedPair): Fragments to assign
+
+        Returns:
+            list of str: Feature name for each fragment
+        """
+        if self.overlap_mode not in ('intersection-strict', 'union'):
+            _assign = self.assign_func()
+            return [_assign(pair) for pair in pairs]
+
+        frag, refs, bstart, bend, strand = [], [], [], [], []
+        for i, pair in enumerate(pairs):
+            blocks = pair.refblocks
+            _strand = self.frag_strand[(pair.is_paired, pair.r1_is_reversed)]
+            for b_start, b_end in blocks:
+                frag.append(i)
+                refs.append(pair.ref_name)
+                bstart.append(b_start)
+                bend.append(b_end)
+                strand.append(_strand)
+        lidx = self.annotation.assign_steps_batch(
+            self.overlap_mode, np.array(frag, dtype=np.int64), np.array(refs),
+            np.array(bstart, dtype=np.int64), np.array(bend, dtype=np.int64),
+            np.array(strand), nfrags=len(pairs)
+        )
+        _names = self.annotation.locus_names
+        return [_names[l] if l >= 0 else self.no_feature_key
+                for l in lidx.tolist()]
+
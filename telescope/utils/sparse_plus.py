@@ -6,9 +6,11 @@ from __future__ import division
 from future import standard_library
 standard_library.install_aliases()
 from builtins import range
+from array import array
 
 import numpy as np
 import scipy.sparse
+import scipy.sparse.csgraph
 
 __author__ = 'Matthew L. Bendall'
 __copyright__ = "Copyright (C) 2019 Matthew L. Bendall"
@@ -21,8 +23,35 @@ def _recip0(v):
     np.seterr(**old_settings)
     return ret
 
+def _data_index(indptr, rows):
+    """ Positions in the data array of a CSR matrix for the given rows """
+    _lens = np.diff(indptr)[rows]
+    _offsets = np.repeat(indptr[rows] - np.cumsum(_lens) + _lens, _lens)
+    return np.arange(_lens.sum()) + _offsets
+
 class csr_matrix_plus(scipy.sparse.csr_matrix):
 
+    def _row_index(self):
+        """ Row index of each value in the data array """
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def _row_max(self):
+        """ Maximum of each row, including implicit zeros
+
+        Same as `self.max(1).toarray()[:, 0]`, computed with one segmented
+        reduction over the data array.
+        """
+        _rowlen = np.diff(self.indptr)
+        ret = np.zeros(self.shape[0], dtype=self.data.dtype)
+        _nonempty = _rowlen > 0
+        if len(self.data):
+            ret[_nonempty] = np.maximum.reduceat(self.data,
+                                                 self.indptr[:-1][_nonempty])
+        # Rows with fewer values than columns have implicit zeros
+        _sparse = _nonempty & (_rowlen < self.shape[1])
+        ret[_sparse] = np.maximum(ret[_sparse], 0)
+        return ret
+
     def norm(self, axis=None):
         """ Normalize matrix along axis
 
@@ -94,7 +123,11 @@ class csr_matrix_plus(scipy.sparse.csr_matrix):
         elif axis == 0:
             raise NotImplementedError
         elif axis == 1:
-            return type(self)(self.multiply(_recip0(self.max(1).toarray())))
+            _data = self.data * _recip0(self._row_max())[self._row_index()]
+            ret = type(self)((_data, self.indices.copy(), self.indptr.copy()),
+                             shape=self.shape)
+            ret.eliminate_zeros()
+            return ret
 
     def binmax(self, axis=None):
         """ Set max values to 1 and others to 0
@@ -119,11 +152,9 @@ class csr_matrix_plus(scipy.sparse.csr_matrix):
         elif axis == 0:
             raise NotImplementedError
         elif axis == 1:
-            _data = np.zeros(self.data.shape, dtype=np.int8)
-            rit = zip(self.indptr[:-1], self.indptr[1:], self.max(1).toarray())
-            for d_start, d_end, d_max in rit:
-                _data[d_start:d_end] = (self.data[d_start:d_end] == d_max)
-            ret = type(self)((_data, self.indices.copy(), self.indptr.copy()),
+            _data = (self.data == self._row_max()[self._row_index()])
+            ret = type(self)((_data.astype(np.int8), self.indices.copy(),
+                              self.indptr.copy()),
                               shape=self.shape)
             ret.eliminate_zeros()
             return ret
@@ -138,30 +169,151 @@ class csr_matrix_plus(scipy.sparse.csr_matrix):
             return np.array(ret, ndmin=2).T
 
     def choose_random(self, axis=None):
+        """ Randomly choose one value in each row and set others to 0
+
+        One random integer is drawn from `numpy.random` for each row with
+        more than one value, in row order.
+
+        Examples:
+            >>> np.random.seed(1)
+            >>> M = csr_matrix_plus([[1, 0, 1],[0, 0, 1],[1, 1, 1]])
+            >>> print(M.choose_random(1).toarray())
+            [[0 0 1]
+             [0 0 1]
+             [1 0 0]]
+        """
         if axis is None:
             raise NotImplementedError
         elif axis == 0:
             raise NotImplementedError
         elif axis == 1:
             ret = self.copy()
-            for d_start, d_end in zip(ret.indptr[:-1], ret.indptr[1:]):
-                if d_end - d_start > 1:
-                    chosen = np.random.choice(range(d_start, d_end))
-                    for j in range(d_start, d_end):
-                        if j != chosen:
-                            ret.data[j] = 0
+            _rowlen = np.diff(ret.indptr)
+            _multi = np.flatnonzero(_rowlen > 1)
+            if len(_multi):
+                _chosen = ret.indptr[_multi] + \
+                    np.random.randint(0, _rowlen[_multi])
+                _keep = np.ones(len(ret.data), dtype=bool)
+                _keep[_data_index(ret.indptr, _multi)] = False
+                _keep[_chosen] = True
+                ret.data[~_keep] = 0
             ret.eliminate_zeros()
             return ret
 
+    def collapse_rows(self):
+        """ Collapse identical rows
+
+        Rows are identical if they have the same nonzero columns with the same
+        values. Unique rows are kept in order of first occurrence.
+
+        Returns:
+            (csr_matrix_plus, ndarray, ndarray): Matrix of unique rows, number
+                of times each unique row occurs, and index of the unique row
+                for each row in the original matrix.
+
+        Examples:
+            >>> M = csr_matrix_plus([[1, 0, 2],[0, 0, 3],[1, 0, 2],[0, 0, 3]])
+            >>> U, counts, inverse = M.collapse_rows()
+            >>> print(U.toarray())
+            [[1 0 2]
+             [0 0 3]]
+            >>> print(counts, inverse)
+            [2 2] [0 1 0 1]
+        """
+        m = self.copy()
+        m.sum_duplicates()
+        _rowlen = np.diff(m.indptr)
+        _first = np.empty(m.shape[0], dtype=np.intp)
+        _inverse = np.empty(m.shape[0], dtype=np.intp)
+        _offset = 0
+        # Rows can only be identical if they have the same length, so each
+        # length is compared separately using a fixed-width byte key per row
+        for rlen in np.unique(_rowlen):
+            _rows = np.flatnonzero(_rowlen == rlen)
+            if rlen == 0:
+                _first[_offset] = _rows[0]
+                _inverse[_rows] = _offset
+                _offset += 1
+                continue
+            _pos = m.indptr[_rows][:, None] + np.arange(rlen)
+            _key = np.hstack([
+                np.ascontiguousarray(m.indices[_pos]).view(np.uint8),
+                np.ascontiguousarray(m.data[_pos]).view(np.uint8),
+            ]).reshape(len(_rows), -1)
+            _key = np.ascontiguousarray(_key).view(
+                np.dtype((np.void, _key.shape[1]))
+            )[:, 0]
+            _, _uidx, _uinv = np.unique(_key, return_index=True,
+                                        return_inverse=True)
+            _first[_offset:_offset + len(_uidx)] = _rows[_uidx]
+            _inverse[_rows] = _offset + _uinv.ravel()
+            _offset += len(_uidx)
+
+        # Number unique rows by first occurrence
+        _first = _first[:_offset]
+        _order = np.argsort(_first, kind='stable')
+        _rank = np.empty(_offset, dtype=np.intp)
+        _rank[_order] = np.arange(_offset)
+        _inverse = _rank[_inverse]
+        _counts = np.bincount(_inverse, minlength=_offset)
+        return type(self)(m[_first[_order]]), _counts, _inverse
+
+    def components(self):
+        """ Find connected components of the bipartite row-column graph
+
+        A row and a column are connected if the matrix has a nonzero value at
+        (row, column).
+
+        Returns:
+            (int, ndarray, ndarray): Number of components, component label for
+                each row, and component label for each column.
+
+        Examples:
+            >>> M = csr_matrix_plus([[1, 0, 0],[0, 2, 3],[0, 0, 4]])
+            >>> n, rlab, clab = M.components()
+            >>> print(n, rlab, clab)
+            2 [0 1 1] [0 1 1]
+        """
+        _pattern = scipy.sparse.csr_matrix(
+            (np.ones(len(self.data), dtype=np.int8),
+             self.indices, self.indptr),
+            shape=self.shape
+        )
+        _graph = scipy.sparse.bmat([[None, _pattern], [_pattern.T, None]])
+        ncomp, labels = scipy.sparse.csgraph.connected_components(
+            _graph, directed=False
+        )
+        return ncomp, labels[:self.shape[0]], labels[self.shape[0]:]
+
     def check_equal(self, other):
         if self.shape != other.shape:
             return False
         return (self != other).nnz == 0
 
     def apply_func(self, func):
+        """ Apply function to each value
+
+        The function is called once with the whole data array if it accepts
+        arrays (for example a ufunc), otherwise once for each value.
+
+        Examples:
+            >>> M = csr_matrix_plus([[1, 0, 2],[0, 0, 3]])
+            >>> print(M.apply_func(np.negative).toarray())
+            [[-1  0 -2]
+             [ 0  0 -3]]
+            >>> print(M.apply_func(lambda x: x if x > 1 else 0).toarray())
+            [[0 0 2]
+             [0 0 3]]
+        """
         ret = self.copy()
-        ret.data = np.fromiter((func(v) for v in self.data),
-                               self.data.dtype, count=len(self.data))
+        try:
+            _data = np.asarray(func(self.data))
+        except (TypeError, ValueError):
+            _data = None
+        if _data is None or _data.shape != self.data.shape:
+            _data = np.fromiter((func(v) for v in self.data),
+                                self.data.dtype, count=len(self.data))
+        ret.data = _data.astype(self.data.dtype, copy=False)
         return ret
 
     def save(self, filename):
@@ -172,3 +324,74 @@ class csr_matrix_plus(scipy.sparse.csr_matrix):
         loader = np.load(filename)
         return cls((loader['data'], loader['indices'], loader['indptr']),
                    shape = loader['shape'])
+
+
+class CooBuilder(object):
+    """ Incrementally build a sparse matrix from (row, col, value) triplets
+
+    Triplets are appended to growable typed arrays, using 12 bytes per entry.
+    Cells that are set more than once are reduced to their maximum value when
+    the matrix is built.
+
+    Examples:
+        >>> b = CooBuilder()
+        >>> b.append(0, 2, 5)
+        >>> b.append(2, 1, 3)
+        >>> b.append(0, 2, 7)
+        >>> print(b.tocsr().toarray())
+        [[0 0 7]
+         [0 0 0]
+         [0 3 0]]
+    """
+    def __init__(self, dtype=np.uint16):
+        self.dtype = dtype
+        self._rows = array('i')
+        self._cols = array('i')
+        self._vals = array('I')
+
+    def __len__(self):
+        return len(self._rows)
+
+    def append(self, i, j, v):
+        self._rows.append(i)
+        self._cols.append(j)
+        self._vals.append(v)
+
+    def extend(self, rows, cols, vals):
+        """ Append triplets from arrays of rows, columns and values """
+        self._rows.frombytes(np.ascontiguousarray(rows, dtype=np.intc).tobytes())
+        self._cols.frombytes(np.ascontiguousarray(cols, dtype=np.intc).tobytes())
+        self._vals.frombytes(np.ascontiguousarray(vals, dtype=np.uintc).tobytes())
+
+    def tocsr(self, shape=None):
+        """ Build matrix, keeping the maximum value for duplicate cells
+
+        Args:
+            shape (tuple of int): Shape of matrix. Default is the smallest
+                shape containing all entries.
+
+        Returns:
+            csr_matrix_plus: Matrix with canonical (sorted, deduplicated)
+                indices.
+        """
+        _row = np.frombuffer(self._rows, dtype=np.intc)
+        _col = np.frombuffer(self._cols, dtype=np.intc)
+        _val = np.frombuffer(self._vals, dtype=np.uintc)
+        if shape is None:
+            shape = (int(_row.max()) + 1 if len(_row) else 0,
+                     int(_col.max()) + 1 if len(_col) else 0)
+
+        if len(_row):
+            # Sort by row then column, and find the first entry of each cell
+            _order = np.lexsort((_col, _row))
+            _row, _col, _val = _row[_order], _col[_order], _val[_order]
+            _first = np.ones(len(_row), dtype=bool)
+            _first[1:] = (_row[1:] != _row[:-1]) | (_col[1:] != _col[:-1])
+            _starts = np.flatnonzero(_first)
+            _val = np.maximum.reduceat(_val, _starts)
+            _row, _col = _row[_starts], _col[_starts]
+
+        _indptr = np.zeros(shape[0] + 1, dtype=np.intc)
+        np.cumsum(np.bincount(_row, minlength=shape[0]), out=_indptr[1:])
+        return csr_matrix_plus((_val.astype(self.dtype), _col.copy(), _indptr),
+                               shape=shape)